@@ -0,0 +1,255 @@
+"""
+Automatic rigid or similarity pre-alignment of a target mesh onto the template, so that the deformable
+registration starts close to its solution.
+
+Both meshes are decimated to a few thousand points. The principal axes of the two point sets give the initial
+rotations, one for each choice of axis signs, and with reflections allowed (e.g. for a knee of the other side)
+their mirror images as well. Each is refined by a few iterations of trimmed ICP, and the one that fits best is
+refined until it converges.
+
+The result takes target coordinates to template coordinates, in the convention of the transform.npy written by
+preprocess.py. Composed with the target's preprocessing transform, it is given to register.py as
+pretransform_file, which undoes it on the mapped meshes.
+"""
+
+import argparse
+import itertools
+import json
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+import telemetry
+from config import AlignConfig
+from multiresolution import coarsen
+from projection import nearest_nodes
+from utils import apply_matrix, read_vtp, save_json, save_vtp, transform_mesh
+
+# Point budget of the decimated meshes
+ALIGNMENT_POINTS = 2000
+# Iterations of ICP run from every initial rotation before the best one is refined
+CANDIDATE_ITERATIONS = 10
+# Pairs further apart than this multiple of the median pair distance are left out of each ICP step
+TRIM_FACTOR = 2.5
+
+
+@dataclass
+class Alignment:
+    """
+    :param matrix: 4x4 matrix taking target coordinates to template coordinates
+    :type matrix: np.ndarray
+    :param rms: Root mean square distance of the retained ICP pairs after alignment
+    :type rms: float
+    :param iterations: Number of ICP iterations run from the chosen initial rotation
+    :type iterations: int
+    :param reflection: Whether the alignment mirrors the target
+    :type reflection: bool
+    :param candidates: RMS distance reached from each initial rotation
+    :type candidates: list[float]
+    """
+
+    matrix: np.ndarray
+    rms: float
+    iterations: int
+    reflection: bool
+    candidates: list[float]
+
+
+def fit_transform(moving: np.ndarray, fixed: np.ndarray, scaling: bool = False) -> np.ndarray:
+    """
+    Least-squares rotation, translation and (optionally) uniform scale taking moving points onto the paired fixed
+    points (Umeyama, 1991).
+
+    :param moving: (N, 3) points.
+    :type moving: np.ndarray
+    :param fixed: (N, 3) points paired with moving.
+    :type fixed: np.ndarray
+    :param scaling: Whether to fit a uniform scale.
+    :type scaling: bool
+
+    :return: The 4x4 matrix.
+    :rtype: np.ndarray
+    """
+    moving_mean, fixed_mean = moving.mean(axis=0), fixed.mean(axis=0)
+    moving_centered = moving - moving_mean
+    covariance = (fixed - fixed_mean).T @ moving_centered / moving.shape[0]
+    u, singular_values, vt = np.linalg.svd(covariance)
+    signs = np.ones(3)
+    signs[-1] = np.sign(np.linalg.det(u) * np.linalg.det(vt)) or 1.0
+    rotation = (u * signs) @ vt
+    scale = 1.0
+    if scaling:
+        scale = (singular_values * signs).sum() / np.mean(np.einsum("ij,ij->i", moving_centered, moving_centered))
+    matrix = np.eye(4)
+    matrix[:3, :3] = scale * rotation
+    matrix[:3, 3] = fixed_mean - scale * rotation @ moving_mean
+    return matrix
+
+
+def principal_axes(points: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Centroid, principal axes (as columns, largest variance first) and variances of a point set.
+    """
+    centroid = points.mean(axis=0)
+    variances, axes = np.linalg.eigh(np.cov(points - centroid, rowvar=False))
+    return centroid, axes[:, ::-1], variances[::-1]
+
+
+def initial_transforms(moving: np.ndarray, fixed: np.ndarray, scaling: bool = False, reflection: bool = False) -> list[np.ndarray]:
+    """
+    Transforms matching the centroids and principal axes of two point sets, one for each choice of axis signs
+    that is a rotation, plus those that are reflections if reflection is set.
+
+    :return: The 4x4 matrices, rotations first.
+    :rtype: list[np.ndarray]
+    """
+    moving_centroid, moving_axes, moving_variances = principal_axes(moving)
+    fixed_centroid, fixed_axes, fixed_variances = principal_axes(fixed)
+    scale = np.sqrt(fixed_variances.sum() / moving_variances.sum()) if scaling else 1.0
+    rotations, reflections = [], []
+    for signs in itertools.product([1.0, -1.0], repeat=3):
+        rotation = (fixed_axes * signs) @ moving_axes.T
+        matrix = np.eye(4)
+        matrix[:3, :3] = scale * rotation
+        matrix[:3, 3] = fixed_centroid - scale * rotation @ moving_centroid
+        (rotations if np.linalg.det(rotation) > 0 else reflections).append(matrix)
+    return rotations + reflections if reflection else rotations
+
+
+def icp(
+    moving: np.ndarray,
+    fixed: np.ndarray,
+    matrix: np.ndarray,
+    scaling: bool = False,
+    iterations: int = 50,
+    tolerance: float = 1e-6,
+) -> tuple[np.ndarray, float, int]:
+    """
+    Refine a transform of moving onto fixed by trimmed iterative closest points: each step pairs every moving
+    point with its nearest fixed point, leaves out the pairs further apart than TRIM_FACTOR times the median
+    distance and fits a rotation (and scale) to the rest. The handedness of the initial matrix is kept.
+
+    :param moving: (N, 3) moving points.
+    :type moving: np.ndarray
+    :param fixed: (M, 3) fixed points.
+    :type fixed: np.ndarray
+    :param matrix: Initial 4x4 matrix.
+    :type matrix: np.ndarray
+    :param scaling: Whether to fit a uniform scale.
+    :type scaling: bool
+    :param iterations: Maximum number of iterations.
+    :type iterations: int
+    :param tolerance: Relative change of the RMS distance below which the iterations stop.
+    :type tolerance: float
+
+    :return: The refined matrix, the RMS distance of the retained pairs and the number of iterations run.
+    :rtype: tuple[np.ndarray, float, int]
+    """
+    rms = np.inf
+    iteration = 0
+    for iteration in range(1, iterations + 1):
+        transformed = apply_matrix(moving, matrix)
+        distances, indices = nearest_nodes(fixed, transformed)
+        distances, indices = distances[:, 0], indices[:, 0]
+        kept = distances <= TRIM_FACTOR * max(np.median(distances), np.finfo(float).tiny)
+        previous, rms = rms, float(np.sqrt(np.mean(distances[kept] ** 2)))
+        matrix = fit_transform(transformed[kept], fixed[indices[kept]], scaling) @ matrix
+        if previous - rms <= tolerance * rms:
+            break
+    return matrix, rms, iteration
+
+
+def align_points(
+    moving: np.ndarray,
+    fixed: np.ndarray,
+    scaling: bool = False,
+    reflection: bool = False,
+    iterations: int = 50,
+    tolerance: float = 1e-6,
+) -> Alignment:
+    """
+    Align moving points onto fixed points from their principal axes, see the module documentation. Both point
+    sets should already be decimated.
+
+    :param moving: (N, 3) moving (target) points.
+    :type moving: np.ndarray
+    :param fixed: (M, 3) fixed (template) points.
+    :type fixed: np.ndarray
+    :param scaling: Whether to fit a uniform scale (similarity) rather than a rigid transform.
+    :type scaling: bool
+    :param reflection: Whether to also try mirror images of the moving points.
+    :type reflection: bool
+    :param iterations: Maximum number of ICP iterations of the final refinement.
+    :type iterations: int
+    :param tolerance: Relative change of the RMS distance below which ICP stops.
+    :type tolerance: float
+
+    :return: The alignment.
+    :rtype: Alignment
+    """
+    moving, fixed = np.asarray(moving, dtype=np.float64), np.asarray(fixed, dtype=np.float64)
+    candidates = [icp(moving, fixed, matrix, scaling, CANDIDATE_ITERATIONS, tolerance) for matrix in initial_transforms(moving, fixed, scaling, reflection)]
+    best = int(np.argmin([rms for _, rms, _ in candidates]))
+    matrix, rms, iteration = icp(moving, fixed, candidates[best][0], scaling, iterations, tolerance)
+    return Alignment(
+        matrix=matrix,
+        rms=rms,
+        iterations=candidates[best][2] + iteration,
+        reflection=bool(np.linalg.det(matrix[:3, :3]) < 0),
+        candidates=[round(rms, 6) for _, rms, _ in candidates],
+    )
+
+
+def alignment_points(mesh: vtkPolyData, seed: int | None = None) -> np.ndarray:
+    """
+    The points of a mesh decimated to ALIGNMENT_POINTS points, on which it is aligned.
+    """
+    return coarsen(mesh, ALIGNMENT_POINTS, seed)[0]
+
+
+def main(config: AlignConfig):
+    with telemetry.span("read"):
+        template_mesh = read_vtp(config.template_mesh_file)
+        target_mesh = read_vtp(config.target_mesh_file)
+    with telemetry.span("align"):
+        alignment = align_points(
+            alignment_points(target_mesh, config.seed),
+            alignment_points(template_mesh, config.seed),
+            config.scaling,
+            config.reflection,
+            config.iterations,
+            config.tolerance,
+        )
+    # Composed with the transform that produced the target mesh, so that the result maps raw target coordinates
+    transform_matrix = alignment.matrix
+    if config.transform_file is not None:
+        transform_matrix = alignment.matrix @ np.load(config.transform_file)
+    aligned_mesh = transform_mesh(target_mesh, alignment.matrix)
+    with telemetry.span("write"):
+        output_dir = Path(config.output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        save_vtp(aligned_mesh, output_dir.joinpath("mesh.vtp"))
+        np.save(output_dir.joinpath("transform.npy"), transform_matrix)
+        save_json(
+            {
+                "rms": round(alignment.rms, 6),
+                "iterations": alignment.iterations,
+                "reflection": alignment.reflection,
+                "scale": round(float(np.cbrt(abs(np.linalg.det(alignment.matrix[:3, :3])))), 6),
+                "candidates": alignment.candidates,
+                "matrix": alignment.matrix.tolist(),
+            },
+            output_dir.joinpath("alignment.json"),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rigidly (or with a uniform scale) aligns a target mesh onto the template mesh.")
+    parser.add_argument("config", type=str, help="JSON configuration file")
+    args = parser.parse_args()
+    with open(args.config, "r") as f:
+        config = AlignConfig(**json.load(f))
+    with telemetry.session(config.telemetry_log, "align", config.profile):
+        main(config)
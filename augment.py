@@ -1,46 +1,44 @@
 import argparse
 import json
-from dataclasses import dataclass
+from collections.abc import Iterable, Iterator
 from pathlib import Path
 
 import numpy as np
-import vtkmodules.all as vtk
 from vtkmodules.util import numpy_support
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+from vtkmodules.vtkFiltersGeneral import vtkOBBTree
+from vtkmodules.vtkIOXML import vtkXMLPolyDataReader, vtkXMLPolyDataWriter
 
+import telemetry
+from config import AugmentConfig
+from deformation_stack import save_stack
+from streaming import BoundedExecutor
+from utils import numpy_to_points
 
-@dataclass
-class AugmentConfig:
-    base_mesh_file: str
-    output_dir: str | None = None
-    control_point_perturbation: float = 0.1
-    num_perturbations: int = 10
-    seed: int = 42
 
-
-def read_mesh(file_path: str) -> vtk.vtkPolyData:
+def read_mesh(file_path: str) -> vtkPolyData:
     assert file_path.endswith(".vtp"), "Only VTK XML polydata (.vtp) files are supported"
-    reader = vtk.vtkXMLPolyDataReader()
+    reader = vtkXMLPolyDataReader()
     reader.SetFileName(file_path)
     reader.Update()
     return reader.GetOutput()
 
 
-def center_mesh(poly: vtk.vtkPolyData) -> vtk.vtkPolyData:
-    center = vtk.vtkCenterOfMass()
-    center.SetInputData(poly)
-    center.Update()
-    center_point = center.GetCenter()
-    translate = vtk.vtkTransform()
-    translate.Translate(-center_point[0], -center_point[1], -center_point[2])
-    transform = vtk.vtkTransformPolyDataFilter()
-    transform.SetInputData(poly)
-    transform.SetTransform(translate)
-    transform.Update()
-    return transform.GetOutput()
+# Number of deformed point coordinates computed at once
+CHUNK_SIZE = 1 << 24
+
+
+def get_control_points(mesh: vtkPolyData) -> tuple[np.ndarray, float]:
+    """
+    Corners of the oriented bounding box of the mesh, used as thin-plate spline landmarks.
 
+    :param mesh: The template mesh.
+    :type mesh: vtkPolyData
 
-def elastic_deformation(mesh: vtk.vtkPolyData, control_point_perturbation: float, num_perturbations: int, seed: int):
-    obb = vtk.vtkOBBTree()
+    :return: The (8, 3) corners and the length of the shortest box axis.
+    :rtype: tuple[np.ndarray, float]
+    """
+    obb = vtkOBBTree()
     obb.SetDataSet(mesh)
     obb.BuildLocator()
 
@@ -50,55 +48,211 @@ def elastic_deformation(mesh: vtk.vtkPolyData, control_point_perturbation: float
     min = [0.0, 0.0, 0.0]
     size = [0.0, 0.0, 0.0]
     obb.ComputeOBB(mesh, corner, max, mid, min, size)
-    control_point_perturbation = control_point_perturbation * size[2]
 
-    poly = vtk.vtkPolyData()
+    poly = vtkPolyData()
     obb.GenerateRepresentation(0, poly)
+    return numpy_support.vtk_to_numpy(poly.GetPoints().GetData()).astype(np.float64), size[2]
+
+
+def perturb_control_points(control_points: np.ndarray, max_perturbation: float, seed: int, indices: range) -> np.ndarray:
+    """
+    Randomly displace the control points once per perturbation index. Perturbation i draws from its own stream,
+    spawned from seed, so any subset of the perturbations can be generated separately with identical results.
 
-    source_landmarks = poly.GetPoints()
-    source_array = numpy_support.vtk_to_numpy(source_landmarks.GetData())
-    new_meshes = []
-    for i in range(num_perturbations):
-        rand_normals = np.random.uniform(low=0, high=1, size=(8, 3))
+    :param control_points: (8, 3) control points.
+    :type control_points: np.ndarray
+    :param max_perturbation: Largest displacement of a control point.
+    :type max_perturbation: float
+    :param seed: Seed of the augmentation.
+    :type seed: int
+    :param indices: Indices of the perturbations to generate.
+    :type indices: range
+
+    :return: (len(indices), 8, 3) displaced control points.
+    :rtype: np.ndarray
+    """
+    perturbed = np.empty((len(indices), *control_points.shape))
+    for n, i in enumerate(indices):
+        # Same stream as the i-th child of np.random.SeedSequence(seed).spawn
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(i,)))
+        rand_normals = rng.uniform(low=0, high=1, size=control_points.shape)
         rand_normals /= np.linalg.norm(rand_normals, axis=1, keepdims=True)
-        scale = np.random.uniform(0.0, control_point_perturbation, size=(8, 1))
-        perturbation = rand_normals * scale
-        target_array = source_array + perturbation
-        target_landmarks = vtk.vtkPoints()
-        target_landmarks.SetData(numpy_support.numpy_to_vtk(target_array, deep=True, array_type=vtk.VTK_DOUBLE))
+        scale = rng.uniform(0.0, max_perturbation, size=(control_points.shape[0], 1))
+        perturbed[n] = control_points + rand_normals * scale
+    return perturbed
+
+
+def get_tps_basis(points: np.ndarray, control_points: np.ndarray) -> np.ndarray:
+    """
+    Thin-plate spline (U(r) = r, as vtkThinPlateSplineTransform with SetBasisToR) from the control points,
+    expressed as a linear map of the displaced control points. With all splines sharing their source landmarks,
+    the spline system is solved once for all of them, and each deformation is a single matrix product
+    deformed = basis @ target_control_points. The basis is centered so that the deformed points are centered
+    at the origin.
+
+    :param points: (M, 3) template points.
+    :type points: np.ndarray
+    :param control_points: (K, 3) source landmarks.
+    :type control_points: np.ndarray
+
+    :return: The (M, K) basis.
+    :rtype: np.ndarray
+    """
+    num_landmarks = control_points.shape[0]
+    affine = np.hstack([np.ones((num_landmarks, 1)), control_points])
+    system = np.zeros((num_landmarks + 4, num_landmarks + 4))
+    system[:num_landmarks, :num_landmarks] = np.linalg.norm(control_points[:, None] - control_points[None], axis=2)
+    system[:num_landmarks, num_landmarks:] = affine
+    system[num_landmarks:, :num_landmarks] = affine.T
+    # Spline coefficients per unit displacement of each target landmark: one solve with K right-hand sides
+    coefficients = np.linalg.solve(system, np.eye(num_landmarks + 4)[:, :num_landmarks])
+
+    basis = np.empty((points.shape[0], num_landmarks))
+    chunk = max(1, CHUNK_SIZE // (3 * num_landmarks))
+    for start in range(0, points.shape[0], chunk):
+        stop = start + chunk
+        kernel = np.linalg.norm(points[start:stop, None] - control_points[None], axis=2)
+        basis[start:stop] = kernel @ coefficients[:num_landmarks] + coefficients[num_landmarks] + points[start:stop] @ coefficients[num_landmarks + 1 :]
+    basis -= basis.mean(axis=0)
+    return basis
+
+
+def deform_points(basis: np.ndarray, target_control_points: np.ndarray, dtype: np.dtype = np.float64) -> np.ndarray:
+    """
+    Apply a batch of thin-plate splines, a few perturbations at a time to bound the temporary memory.
+
+    :param basis: (M, K) basis from get_tps_basis.
+    :type basis: np.ndarray
+    :param target_control_points: (N, K, 3) displaced control points.
+    :type target_control_points: np.ndarray
+    :param dtype: Type of the returned points.
+    :type dtype: np.dtype
+
+    :return: (N, M, 3) deformed and centered points.
+    :rtype: np.ndarray
+    """
+    num_points = basis.shape[0]
+    deformed = np.empty((target_control_points.shape[0], num_points, 3), dtype=dtype)
+    batch = max(1, CHUNK_SIZE // (3 * num_points))
+    for start in range(0, target_control_points.shape[0], batch):
+        deformed[start : start + batch] = np.matmul(basis, target_control_points[start : start + batch])
+    return deformed
+
+
+def create_deformed_mesh(mesh: vtkPolyData, points: np.ndarray) -> vtkPolyData:
+    deformed_mesh = vtkPolyData()
+    deformed_mesh.ShallowCopy(mesh)
+    deformed_mesh.SetPoints(numpy_to_points(points))
+    return deformed_mesh
 
-        tps = vtk.vtkThinPlateSplineTransform()
-        tps.SetSourceLandmarks(source_landmarks)
-        tps.SetTargetLandmarks(target_landmarks)
-        tps.SetBasisToR()
-        tps.Update()
 
-        txp = vtk.vtkTransformPolyDataFilter()
-        txp.SetInputData(mesh)
-        txp.SetTransform(tps)
-        txp.Update()
+def iter_elastic_deformation(
+    mesh: vtkPolyData, control_point_perturbation: float, num_perturbations: int, seed: int
+) -> Iterator[vtkPolyData]:
+    """
+    Generate the augmented meshes one at a time. The splines are evaluated a batch at a time, so at most a
+    batch of deformed point arrays is held in memory whatever the number of perturbations.
 
-        new_meshes.append(center_mesh(txp.GetOutput()))
+    :param mesh: The template mesh. The augmented meshes share its connectivity and point data.
+    :type mesh: vtkPolyData
+    :param control_point_perturbation: Largest control point displacement relative to the shortest side of the
+        template's oriented bounding box.
+    :type control_point_perturbation: float
+    :param num_perturbations: Number of augmented meshes.
+    :type num_perturbations: int
+    :param seed: Seed of the augmentation.
+    :type seed: int
 
-    return new_meshes
+    :return: An iterator over the augmented meshes.
+    :rtype: Iterator[vtkPolyData]
+    """
+    control_points, min_size = get_control_points(mesh)
+    max_perturbation = control_point_perturbation * min_size
+    target_control_points = perturb_control_points(control_points, max_perturbation, seed, range(num_perturbations))
 
+    template_points = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData())
+    with telemetry.span("basis", points=template_points.shape[0]):
+        basis = get_tps_basis(template_points.astype(np.float64), control_points)
+    batch = max(1, CHUNK_SIZE // (3 * basis.shape[0]))
+    for start in range(0, num_perturbations, batch):
+        with telemetry.span("deform", start=start, meshes=min(batch, num_perturbations - start)):
+            deformed_points = deform_points(basis, target_control_points[start : start + batch], dtype=template_points.dtype)
+        for points in deformed_points:
+            yield create_deformed_mesh(mesh, points)
 
-def main(config):
+
+def elastic_deformation(mesh: vtkPolyData, control_point_perturbation: float, num_perturbations: int, seed: int):
+    return list(iter_elastic_deformation(mesh, control_point_perturbation, num_perturbations, seed))
+
+
+def get_output_dir(config: AugmentConfig) -> Path:
     if config.output_dir is None:
-        output_dir = Path(config.base_mesh_file).parent.joinpath("augmented_meshes")
+        return Path(config.base_mesh_file).parent.joinpath("augmented_meshes")
+    else:
+        return Path(config.output_dir)
+
+
+def get_mesh_names(num_perturbations: int) -> list[str]:
+    padding = len(str(max(num_perturbations - 1, 0)))
+    return [f"mesh_{i:0{padding}d}" for i in range(num_perturbations)]
+
+
+def save_mesh(mesh: vtkPolyData, output_path: Path, points_only: bool = False):
+    """
+    Write an augmented mesh. With points_only, only the points and point data are written, as raw
+    LZ4-compressed binary appended to the file; the connectivity is that of the template. The coordinates of
+    a deformed mesh hardly compress, and LZ4 writes them much faster than the default zlib.
+    """
+    writer = vtkXMLPolyDataWriter()
+    writer.SetFileName(output_path.as_posix())
+    if points_only:
+        points_poly = vtkPolyData()
+        points_poly.SetPoints(mesh.GetPoints())
+        points_poly.GetPointData().ShallowCopy(mesh.GetPointData())
+        writer.SetInputData(points_poly)
+        writer.SetDataModeToAppended()
+        writer.EncodeAppendedDataOff()
+        writer.SetCompressorTypeToLZ4()
     else:
-        output_dir = Path(config.output_dir)
+        writer.SetInputData(mesh)
+    with telemetry.span("write", target=output_path.stem):
+        writer.Write()
+
+
+def save_meshes(
+    augmented_meshes: Iterable[vtkPolyData], num_meshes: int, output_dir: Path, writers: int = 1, points_only: bool = False
+):
+    """
+    Write the augmented meshes as they are produced, with up to writers meshes written at once. The producer
+    waits while all writers are busy, so the meshes do not accumulate in memory.
+
+    :param augmented_meshes: The augmented meshes, typically from iter_elastic_deformation.
+    :type augmented_meshes: Iterable[vtkPolyData]
+    :param num_meshes: Number of augmented meshes, which sets the zero padding of the file names.
+    :type num_meshes: int
+    :param output_dir: Directory in which the meshes are written.
+    :type output_dir: Path
+    :param writers: Number of writer threads.
+    :type writers: int
+    :param points_only: Whether to write only the points and point data of each mesh.
+    :type points_only: bool
+    """
     output_dir.mkdir(parents=True, exist_ok=True)
+    with BoundedExecutor(workers=writers, backlog=writers, name="writer") as executor:
+        for name, augmented_mesh in zip(get_mesh_names(num_meshes), augmented_meshes, strict=True):
+            executor.submit(save_mesh, augmented_mesh, output_dir.joinpath(f"{name}.vtp"), points_only)
+
+
+def main(config: AugmentConfig):
+    output_dir = get_output_dir(config)
     assert Path(config.base_mesh_file).exists(), f"Base mesh file {config.base_mesh_file} does not exist"
-    mesh = read_mesh(config.base_mesh_file)
-    augmented_meshes = elastic_deformation(mesh, config.control_point_perturbation, config.num_perturbations, config.seed)
-    padding = int(np.log10(config.num_perturbations))
-    for i, augmented_mesh in enumerate(augmented_meshes):
-        output_path = output_dir.joinpath(f"mesh_{i:0{padding}d}.vtp")
-        writer = vtk.vtkXMLPolyDataWriter()
-        writer.SetFileName(output_path.as_posix())
-        writer.SetInputData(augmented_mesh)
-        writer.Write()
+    with telemetry.span("read"):
+        mesh = read_mesh(config.base_mesh_file)
+    augmented_meshes = iter_elastic_deformation(mesh, config.control_point_perturbation, config.num_perturbations, config.seed)
+    if config.output_format == "stack":
+        save_stack(output_dir, get_mesh_names(config.num_perturbations), augmented_meshes)
+    else:
+        save_meshes(augmented_meshes, config.num_perturbations, output_dir, config.writers, config.points_only)
 
 
 if __name__ == "__main__":
@@ -109,4 +263,5 @@ if __name__ == "__main__":
     with open(args.config, "r") as f:
         config = AugmentConfig(**json.load(f))
 
-    main(config)
+    with telemetry.session(config.telemetry_log, "augment", config.profile):
+        main(config)
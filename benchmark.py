@@ -0,0 +1,565 @@
+"""
+Reproducible benchmark of the validation pipeline on synthetic bones, so that the effect of a change on speed
+can be measured without patient data.
+
+For every size, a closed femur-like surface (a shaft flaring into two condyles) with about that many points is
+generated, together with ACL and PCL insertion points scattered over two patches of the intercondylar notch.
+The bone is preprocessed, targets are made from the preprocessed template with augment.elastic_deformation,
+the template is registered to them and the registrations are postprocessed. Every stage is timed end to end
+and, through the telemetry spans of the scripts, step by step; with profile the slowest kneemorph functions of
+each stage are reported too. The results are written to output_dir/benchmark_results.json with the commit and
+library versions, and two results files are compared with the compare command. The parity command compares the
+numpy backend with the bcpd executable, and the reference command checks it against a known registration. The
+statistics command checks the streamed error statistics of postprocess.py against those of all errors at once.
+
+The registrations run with a fixed number of VB loops, so that their time does not depend on convergence.
+Without the bcpd executable they run on the in-process engine, or with stub on a stand-in for bcpd that returns
+the template points unchanged.
+"""
+
+import argparse
+import json
+import os
+import platform
+import pstats
+import shutil
+import stat
+import subprocess
+import sys
+import time
+from collections.abc import Callable
+from dataclasses import replace
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from vtkmodules.vtkCommonCore import vtkVersion
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+import augment
+import postprocess
+import preprocess
+import register_gbcpd
+import telemetry
+from config import BenchmarkConfig, GBCPDConfig, PostValidationConfig, PreprocessConfig
+from geodesic import clear_factor_cache
+from utils import numpy_to_polydata, read_vtp, save_json, save_vtp
+
+RESULTS_FILE = "benchmark_results.json"
+# Registration settings of the benchmark, under BenchmarkConfig.register
+REGISTRATION_SETTINGS = {"n_max": 30, "n_min": 30, "cache_dir": None}
+# Length of the synthetic femur and radii of its shaft and metaphysis, in mm
+FEMUR_LENGTH = 120.0
+SHAFT_RADIUS = 14.0
+METAPHYSIS_RADIUS = 30.0
+# Centres of the synthetic insertion patches: fraction of the length from the proximal end and angle around the
+# shaft (the posterior direction, -y, is -pi/2)
+INSERTION_SITES = {"acl": (0.9, -np.pi / 2 + 0.3), "pcl": (0.93, -np.pi / 2 - 0.3)}
+INSERTION_POINTS = 40
+# Number of kneemorph functions reported per profiled stage
+FUNCTION_TOP = 30
+# Slowdowns smaller than this many seconds are not reported as regressions, however large relative to the timing
+MIN_REGRESSION = 0.005
+# Registration configurations compared by the parity command
+DEMO_STUDIES = Path(__file__).parent.joinpath("studies", "demo")
+# Root mean square distance between the points mapped by the two backends, relative to the diagonal of the target's
+# bounding box, beyond which the backends disagree
+PARITY_TOLERANCE = 0.01
+# Reference registration: a synthetic femur of about this many points, mapped onto its image under a known affine
+# transform (a rotation about z in radians, a scale along each axis and a translation in mm) with each value of tau
+REFERENCE_POINTS = 500
+REFERENCE_ROTATION = 0.15
+REFERENCE_SCALE = (1.1, 0.95, 1.0)
+REFERENCE_TRANSLATION = (2.0, -3.0, 1.0)
+REFERENCE_TAUS = (0.0, 0.5)
+# Root mean square distance between the mapped points and their known positions, relative to the diagonal of the
+# target's bounding box, beyond which the reference registration fails. The points slide along the surface, so
+# about 0.01 is expected
+REFERENCE_TOLERANCE = 0.03
+# Fixture of the statistics command: number of meshes, and number of insertion nodes of each ligament
+STATISTICS_MESHES = 7
+STATISTICS_NODES = {1: 5, 2: 3}
+# Largest difference between the streamed statistics and those computed from all the errors at once
+STATISTICS_TOLERANCE = 1e-9
+
+
+def _angle_difference(a: np.ndarray, b: float) -> np.ndarray:
+    return np.angle(np.exp(1j * (a - b)))
+
+
+def femur_surface(t: np.ndarray, phi: np.ndarray) -> np.ndarray:
+    """
+    Points of the synthetic femur: a shaft along z that flares into a metaphysis, with two condyles bulging
+    posteriorly, an intercondylar notch between them and a shallow trochlear groove in front.
+
+    :param t: Position along the bone, 0 at the proximal and 1 at the distal end.
+    :type t: np.ndarray
+    :param phi: Angle around the shaft.
+    :type phi: np.ndarray
+
+    :return: The (..., 3) points.
+    :rtype: np.ndarray
+    """
+    flare = np.clip((t - 0.5) / 0.4, 0.0, 1.0)
+    flare = flare * flare * (3 - 2 * flare)
+    distal = np.clip((t - 0.6) / 0.4, 0.0, 1.0)
+    condyles = sum(np.exp(-((_angle_difference(phi, -np.pi / 2 + side * 0.55) / 0.45) ** 2)) for side in (-1, 1))
+    notch = np.exp(-((_angle_difference(phi, -np.pi / 2) / 0.25) ** 2))
+    groove = np.exp(-((_angle_difference(phi, np.pi / 2) / 0.3) ** 2))
+    radius = SHAFT_RADIUS + (METAPHYSIS_RADIUS - SHAFT_RADIUS) * flare + distal * (10 * condyles - 8 * notch - 3 * groove)
+    # Rounded ends: the cross-section shrinks to a point at both poles
+    theta = np.arccos(1 - 2 * t)
+    radius = radius * np.sqrt(np.sin(theta))
+    return np.stack([radius * np.cos(phi), radius * np.sin(phi), FEMUR_LENGTH * (1 - t)], axis=-1)
+
+
+def synthetic_femur(num_points: int) -> vtkPolyData:
+    """
+    Closed triangulated surface of the synthetic femur with about num_points points, on rings of equal angular
+    resolution closed by a node at each end.
+    """
+    num_angles = max(int(np.ceil(np.sqrt(num_points))), 3)
+    num_rings = max(int(round((num_points - 2) / num_angles)), 2)
+    theta = np.pi * np.arange(1, num_rings + 1) / (num_rings + 1)
+    t, phi = np.meshgrid((1 - np.cos(theta)) / 2, 2 * np.pi * np.arange(num_angles) / num_angles, indexing="ij")
+    points = np.concatenate([femur_surface(t, phi).reshape(-1, 3), [[0.0, 0.0, FEMUR_LENGTH], [0.0, 0.0, 0.0]]])
+
+    ring = np.arange(num_angles)
+    following = np.roll(ring, -1)
+    starts = num_angles * np.arange(num_rings - 1)[:, None]
+    a, b = starts + ring, starts + following
+    c, d = a + num_angles, b + num_angles
+    quads = np.concatenate([np.stack([a, c, b], axis=-1), np.stack([b, c, d], axis=-1)], axis=1).reshape(-1, 3)
+    proximal, distal = num_rings * num_angles, num_rings * num_angles + 1
+    last = (num_rings - 1) * num_angles
+    caps = np.concatenate(
+        [
+            np.stack([np.full(num_angles, proximal), following, ring], axis=-1),
+            np.stack([np.full(num_angles, distal), last + ring, last + following], axis=-1),
+        ]
+    )
+    triangles = np.concatenate([quads, caps])
+    # Outward normals: the signed volume of a closed, outward-oriented surface is positive
+    corners = points[triangles]
+    if np.einsum("ij,ij->i", corners[:, 0], np.cross(corners[:, 1], corners[:, 2])).sum() < 0:
+        triangles = triangles[:, ::-1]
+    return numpy_to_polydata(points, triangles=triangles)
+
+
+def synthetic_insertions(site: tuple[float, float], rng: np.random.Generator) -> np.ndarray:
+    """
+    Insertion points scattered over a patch of the synthetic femur around site (t, phi), slightly off the
+    surface like digitized points.
+    """
+    t = site[0] + rng.uniform(-0.02, 0.02, INSERTION_POINTS)
+    phi = site[1] + rng.uniform(-0.08, 0.08, INSERTION_POINTS)
+    return femur_surface(t, phi) + rng.normal(scale=0.3, size=(INSERTION_POINTS, 3))
+
+
+def write_synthetic_bone(directory: Path, num_points: int, seed: int) -> tuple[Path, dict[str, str]]:
+    """
+    Write a synthetic femur and its insertion point files, in the formats read by preprocess.py.
+
+    :return: The path to the bone and the paths to the insertion files by ligament.
+    :rtype: tuple[Path, dict[str, str]]
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    bone_file = directory.joinpath("femur.vtp")
+    save_vtp(synthetic_femur(num_points), bone_file)
+    rng = np.random.default_rng(seed)
+    ligament_insertions = {}
+    for ligament, site in INSERTION_SITES.items():
+        points = synthetic_insertions(site, rng)
+        filepath = directory.joinpath(f"{ligament}.txt")
+        np.savetxt(filepath, np.column_stack([np.arange(len(points)), points]), delimiter=",")
+        ligament_insertions[ligament] = filepath.as_posix()
+    return bone_file, ligament_insertions
+
+
+def write_bcpd_stub(filepath: Path):
+    """
+    Write an executable stand-in for bcpd that returns the source points unchanged.
+    """
+    filepath.write_text(
+        f"#!{sys.executable}\n"
+        '"""Stand-in for bcpd written by benchmark.py: returns the source points unchanged."""\n'
+        "import shutil, sys\n"
+        "args = {arg[:2]: arg[2:] for arg in sys.argv[1:]}\n"
+        'shutil.copyfile(args["-y"], "output_y.txt")\n'
+    )
+    filepath.chmod(filepath.stat().st_mode | stat.S_IXUSR)
+
+
+def function_times(profile_file: Path) -> dict[str, dict]:
+    """
+    Calls and cumulative time of the FUNCTION_TOP slowest functions defined in the kneemorph modules.
+    """
+    root = Path(__file__).resolve().parent
+    functions = []
+    for (filename, line, name), (_, calls, _, cumulative, _) in pstats.Stats(profile_file.as_posix()).stats.items():
+        if Path(filename).resolve().parent == root:
+            functions.append((cumulative, f"{Path(filename).stem}.{name}:{line}", calls))
+    functions.sort(reverse=True)
+    return {function: {"calls": calls, "seconds": round(cumulative, 6)} for cumulative, function, calls in functions[:FUNCTION_TOP]}
+
+
+def time_stage(run: Callable[[], None], name: str, log_dir: Path, repeats: int, profile: bool) -> dict:
+    """
+    Run a stage repeats times within a telemetry session and report its fastest run.
+
+    :param run: Runs the stage. It must be repeatable.
+    :type run: Callable[[], None]
+    :param name: Name of the stage, and of its telemetry log in log_dir.
+    :type name: str
+    :param log_dir: Directory of the telemetry logs.
+    :type log_dir: Path
+    :param repeats: Number of runs.
+    :type repeats: int
+    :param profile: Whether to profile the fastest run with cProfile.
+    :type profile: bool
+
+    :return: The duration of every run, and the steps and (with profile) functions of the fastest one.
+    :rtype: dict
+    """
+    log_path = log_dir.joinpath(f"{name}.jsonl")
+    runs = []
+    best = None
+    for _ in range(repeats):
+        log_path.unlink(missing_ok=True)
+        with telemetry.session(log_path.as_posix(), name, "cprofile" if profile else None):
+            start = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - start
+        runs.append(round(seconds, 6))
+        if best is None or seconds <= min(runs):
+            with open(log_path.with_name(f"{log_path.stem}_summary.json"), "r") as f:
+                best = {"steps": json.load(f)["stages"]}
+            if profile:
+                best["functions"] = function_times(log_path.with_suffix(".prof"))
+    return {"seconds": min(runs), "runs": runs} | best
+
+
+def _reset_dir(directory: Path):
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir(parents=True)
+
+
+def benchmark_size(config: BenchmarkConfig, num_points: int) -> dict:
+    """
+    Generate the synthetic bone of one size and time the stages of the pipeline on it.
+
+    :return: The mesh size, the timings of every stage and the mean insertion error of the registrations.
+    :rtype: dict
+    """
+    work_dir = Path(config.output_dir).joinpath(f"points_{num_points}")
+    log_dir = work_dir.joinpath("telemetry")
+    log_dir.mkdir(parents=True, exist_ok=True)
+    template_dir, targets_dir = work_dir.joinpath("template"), work_dir.joinpath("targets")
+    registered_dir, results_dir = work_dir.joinpath("registered"), work_dir.joinpath("postprocess")
+    template_file = template_dir.joinpath("mesh.vtp")
+    stages = {}
+
+    start = time.perf_counter()
+    bone_file, ligament_insertions = write_synthetic_bone(work_dir.joinpath("input"), num_points, config.seed)
+    stages["generate"] = {"seconds": round(time.perf_counter() - start, 6)}
+
+    preprocess_config = PreprocessConfig(
+        **{"bone": bone_file.as_posix(), "output_dir": template_dir.as_posix(), "ligament_insertions": ligament_insertions} | config.preprocess
+    )
+    stages["preprocess"] = time_stage(lambda: preprocess.main(preprocess_config), "preprocess", log_dir, config.repeats, config.profile)
+
+    def make_targets():
+        _reset_dir(targets_dir)
+        with telemetry.span("read"):
+            template = read_vtp(template_file)
+        targets = augment.elastic_deformation(template, 0.1, config.num_targets, config.seed)
+        augment.save_meshes(targets, config.num_targets, targets_dir)
+
+    stages["augment"] = time_stage(make_targets, "augment", log_dir, config.repeats, config.profile)
+
+    register_config = GBCPDConfig(
+        source_mesh_file=template_file.as_posix(),
+        target_mesh_path=targets_dir.as_posix(),
+        output_dir=registered_dir.as_posix(),
+        backend=config.backend,
+        **REGISTRATION_SETTINGS | config.register,
+    )
+
+    def register():
+        # Every run starts cold, like a new register.py process
+        _reset_dir(registered_dir)
+        clear_factor_cache()
+        register_gbcpd.main(register_config)
+
+    bcpd = register_gbcpd.bcpd
+    if register_config.backend == "cli" and config.stub:
+        register_gbcpd.bcpd = Path(config.output_dir).joinpath("bcpd_stub").as_posix()
+        write_bcpd_stub(Path(register_gbcpd.bcpd))
+    try:
+        stages["register"] = time_stage(register, "register", log_dir, config.repeats, config.profile)
+    finally:
+        register_gbcpd.bcpd = bcpd
+
+    postprocess_config = PostValidationConfig(
+        template_mesh_file=template_file.as_posix(),
+        ground_truth_path=targets_dir.as_posix(),
+        result_path=registered_dir.as_posix(),
+        output_dir=results_dir.as_posix(),
+        jobs=config.postprocess_jobs,
+    )
+    stages["postprocess"] = time_stage(lambda: postprocess.main(postprocess_config), "postprocess", log_dir, config.repeats, config.profile)
+
+    template = read_vtp(template_file)
+    errors = np.loadtxt(results_dir.joinpath("displacement_errors.csv"), delimiter=",", ndmin=2)
+    return {
+        "requested_points": num_points,
+        "points": template.GetNumberOfPoints(),
+        "cells": template.GetNumberOfCells(),
+        "seconds": round(sum(stage["seconds"] for stage in stages.values()), 6),
+        "stages": stages,
+        "mean_insertion_error": {str(int(row[0])): round(float(row[1]), 6) for row in errors},
+    } | telemetry.resource_usage()
+
+
+def get_environment() -> dict:
+    """
+    The commit, library versions and machine a benchmark ran on.
+    """
+    root = Path(__file__).resolve().parent
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True).stdout)
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "vtk": vtkVersion.GetVTKVersion(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main(config: BenchmarkConfig):
+    output_dir = Path(config.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    results = {"environment": get_environment(), "config": vars(config), "sizes": []}
+    for num_points in config.sizes:
+        results["sizes"].append(benchmark_size(config, num_points))
+        # Written after every size, so that the smaller sizes are kept if a larger one fails
+        save_json(results, output_dir.joinpath(RESULTS_FILE))
+        print(f"{num_points} points: " + ", ".join(f"{name} {stage['seconds']:.3f} s" for name, stage in results["sizes"][-1]["stages"].items()))
+
+
+def _flatten_timings(results: dict) -> dict[tuple[str, str, str], float]:
+    timings = {}
+    for size in results["sizes"]:
+        points = str(size["requested_points"])
+        timings[(points, "total", "")] = size["seconds"]
+        for name, stage in size["stages"].items():
+            timings[(points, name, "")] = stage["seconds"]
+            for step, stats in stage.get("steps", {}).items():
+                timings[(points, name, step)] = stats["total"]
+    return timings
+
+
+def compare(base_file: Path | str, new_file: Path | str, threshold: float = 0.1) -> list[tuple[str, str, str, float, float, bool]]:
+    """
+    Compare the timings of two benchmark results files, for the sizes, stages and steps found in both. A timing
+    regressed when it is more than threshold slower, relative to the reference, and at least MIN_REGRESSION
+    seconds slower.
+
+    :param base_file: Results of the reference commit.
+    :type base_file: Path | str
+    :param new_file: Results of the commit under test.
+    :type new_file: Path | str
+    :param threshold: Relative slowdown beyond which a timing has regressed.
+    :type threshold: float
+
+    :return: The (points, stage, step, base seconds, new seconds, regressed) of every timing, regressions first.
+    :rtype: list[tuple[str, str, str, float, float, bool]]
+    """
+    with open(base_file, "r") as f:
+        base = json.load(f)
+    with open(new_file, "r") as f:
+        new = json.load(f)
+    settings = [{key: value for key, value in results["config"].items() if key != "output_dir"} for results in (base, new)]
+    if settings[0] != settings[1]:
+        print("Warning: the benchmarks were run with different configurations", file=sys.stderr)
+    base, new = _flatten_timings(base), _flatten_timings(new)
+    rows = []
+    for key in base.keys() & new.keys():
+        regressed = new[key] > base[key] * (1 + threshold) and new[key] - base[key] >= MIN_REGRESSION
+        rows.append((*key, base[key], new[key], regressed))
+    rows.sort(key=lambda row: (not row[-1], int(row[0]), row[1], row[2]))
+    return rows
+
+
+def parity(study_files: list[Path], tolerance: float = PARITY_TOLERANCE) -> list[tuple[str, float | None, bool]]:
+    """
+    Register each study with the cli and numpy backends, in memory, and compare the mapped points. Studies whose
+    meshes are missing are skipped, and all of them are when the bcpd executable is absent.
+
+    :param study_files: GBCPDConfig files with a single target mesh, e.g. studies/demo/*.json.
+    :type study_files: list[Path]
+    :param tolerance: Relative root mean square distance beyond which the backends disagree.
+    :type tolerance: float
+
+    :return: The (study, relative root mean square distance or None if skipped, agreed) of every study.
+    :rtype: list[tuple[str, float | None, bool]]
+    """
+    if not Path(register_gbcpd.bcpd).is_file():
+        print(f"Skipping the parity check: {register_gbcpd.bcpd} not found", file=sys.stderr)
+        return [(study_file.stem, None, True) for study_file in study_files]
+    rows = []
+    for study_file in study_files:
+        with open(study_file, "r") as f:
+            config = GBCPDConfig(**json.load(f))
+        source_path, target_path = Path(config.source_mesh_file), Path(config.target_mesh_path)
+        if not source_path.is_file() or not target_path.is_file():
+            print(f"Skipping {study_file.stem}: {source_path} or {target_path} not found", file=sys.stderr)
+            rows.append((study_file.stem, None, True))
+            continue
+        source_mesh, target_mesh = read_vtp(source_path), read_vtp(target_path)
+        mapped = {}
+        for backend in ("cli", "numpy"):
+            backend_config = replace(config, backend=backend, cache_dir=None)
+            meshes = register_gbcpd.register_meshes(backend_config, source_mesh, {target_path.stem: target_mesh}, np.eye(4))
+            mapped[backend] = vtk_to_numpy(meshes[f"mapped_{target_path.stem}"].GetPoints().GetData())
+        bounds = np.asarray(target_mesh.GetBounds()).reshape(3, 2)
+        diagonal = np.linalg.norm(bounds[:, 1] - bounds[:, 0])
+        difference = np.sqrt(np.mean(np.sum((mapped["cli"] - mapped["numpy"]) ** 2, axis=1))) / diagonal
+        rows.append((study_file.stem, float(difference), bool(difference <= tolerance)))
+    return rows
+
+
+def reference_target(mesh: vtkPolyData) -> tuple[vtkPolyData, np.ndarray]:
+    """
+    Image of a mesh under the reference affine transform, with its points shuffled.
+
+    :return: The target mesh and the known position of every point of the input mesh in it.
+    :rtype: tuple[vtkPolyData, np.ndarray]
+    """
+    points = vtk_to_numpy(mesh.GetPoints().GetData()).astype(np.float64)
+    triangles = vtk_to_numpy(mesh.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    cos, sin = np.cos(REFERENCE_ROTATION), np.sin(REFERENCE_ROTATION)
+    matrix = np.array([[cos, -sin, 0.0], [sin, cos, 0.0], [0.0, 0.0, 1.0]]) * np.asarray(REFERENCE_SCALE)
+    positions = points @ matrix.T + np.asarray(REFERENCE_TRANSLATION)
+    order = np.random.default_rng(0).permutation(len(points))
+    return numpy_to_polydata(positions[order], triangles=np.argsort(order)[triangles]), positions
+
+
+def reference(tolerance: float = REFERENCE_TOLERANCE) -> list[tuple[float, float, bool]]:
+    """
+    Register a small synthetic femur with the numpy backend to the reference affine image of itself, with each of
+    REFERENCE_TAUS, and compare the mapped points with their known positions.
+
+    :param tolerance: Relative root mean square distance beyond which a registration fails.
+    :type tolerance: float
+
+    :return: The (tau, relative root mean square distance, passed) of every registration.
+    :rtype: list[tuple[float, float, bool]]
+    """
+    mesh = synthetic_femur(REFERENCE_POINTS)
+    target_mesh, positions = reference_target(mesh)
+    diagonal = np.linalg.norm(positions.max(axis=0) - positions.min(axis=0))
+    rows = []
+    for tau in REFERENCE_TAUS:
+        config = GBCPDConfig("", "", "", backend="numpy", tau=tau, cache_dir=None)
+        meshes = register_gbcpd.register_meshes(config, mesh, {"reference": target_mesh}, np.eye(4))
+        mapped = vtk_to_numpy(meshes["mapped_reference"].GetPoints().GetData())
+        difference = np.sqrt(np.mean(np.sum((mapped - positions) ** 2, axis=1))) / diagonal
+        rows.append((tau, float(difference), bool(difference <= tolerance)))
+    return rows
+
+
+def statistics(tolerance: float = STATISTICS_TOLERANCE) -> list[tuple[str, float, bool]]:
+    """
+    Compare the statistics of postprocess.ErrorAccumulator with np.mean and np.std of all the errors at once, as
+    postprocess computed them before it streamed the meshes, on a small random fixture. The meshes are split
+    between two accumulators, which are then merged, as the postprocessing workers' are.
+
+    :param tolerance: Largest difference between the two.
+    :type tolerance: float
+
+    :return: The (statistic, largest difference, passed) of every statistic.
+    :rtype: list[tuple[str, float, bool]]
+    """
+    rng = np.random.default_rng(0)
+    errors = {ligament_id: rng.gamma(2.0, 1.5, (STATISTICS_MESHES, nodes)) for ligament_id, nodes in STATISTICS_NODES.items()}
+    accumulator, other = postprocess.ErrorAccumulator(), postprocess.ErrorAccumulator()
+    for i in range(STATISTICS_MESHES):
+        (accumulator if i < STATISTICS_MESHES // 2 else other).update({key: value[[i]] for key, value in errors.items()})
+    accumulator.merge(other)
+    expected = {}
+    for ligament_id, error in errors.items():
+        count = error.shape[0]
+        expected[("pointwise", ligament_id)] = [np.mean(error, axis=0), np.std(error, axis=0), np.std(error, axis=0) / np.sqrt(count) * 1.96]
+        expected[("aggregate", ligament_id)] = [np.mean(error.ravel()), np.std(error.ravel()), np.std(error.ravel()) / np.sqrt(count) * 1.96]
+    actual = {("pointwise", row[0]): row[1:] for row in accumulator.pointwise_stats()}
+    actual |= {("aggregate", row[0]): row[1:] for row in accumulator.aggregate_stats()}
+    rows = []
+    for kind in ("pointwise", "aggregate"):
+        for i, statistic in enumerate(("mean", "std", "ci95")):
+            difference = max(float(np.max(np.abs(np.asarray(actual[key][i]) - expected[key][i]))) for key in expected if key[0] == kind)
+            rows.append((f"{kind} {statistic}", difference, difference <= tolerance))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the validation pipeline on synthetic bones of increasing size.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run the benchmark")
+    run_parser.add_argument("config", type=str, help="JSON configuration file")
+    compare_parser = subparsers.add_parser("compare", help="Compare the results of two benchmark runs")
+    compare_parser.add_argument("base", type=str, help="Results file of the reference run")
+    compare_parser.add_argument("new", type=str, help="Results file of the run under test")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown reported as a regression")
+    parity_parser = subparsers.add_parser("parity", help="Compare the numpy backend with the bcpd executable on the demo studies")
+    parity_parser.add_argument("studies", type=str, nargs="*", help="Registration configuration files (default: studies/demo/*.json)")
+    parity_parser.add_argument("--tolerance", type=float, default=PARITY_TOLERANCE, help="Relative RMS distance beyond which the backends disagree")
+    reference_parser = subparsers.add_parser("reference", help="Check the numpy backend against a known registration of a small synthetic femur")
+    reference_parser.add_argument("--tolerance", type=float, default=REFERENCE_TOLERANCE, help="Relative RMS distance beyond which a registration fails")
+    statistics_parser = subparsers.add_parser("statistics", help="Check the streamed error statistics against np.mean and np.std on a small fixture")
+    statistics_parser.add_argument("--tolerance", type=float, default=STATISTICS_TOLERANCE, help="Largest difference allowed")
+    args = parser.parse_args()
+    if args.command == "run":
+        with open(args.config, "r") as f:
+            main(BenchmarkConfig(**json.load(f)))
+    elif args.command == "parity":
+        study_files = [Path(study) for study in args.studies] or sorted(DEMO_STUDIES.glob("*.json"))
+        rows = parity(study_files, args.tolerance)
+        for study, difference, agreed in rows:
+            if difference is not None:
+                flag = "" if agreed else "  disagrees"
+                print(f"{study:<20} {difference:>10.2e}{flag}")
+        if not all(agreed for *_, agreed in rows):
+            sys.exit(1)
+    elif args.command == "reference":
+        rows = reference(args.tolerance)
+        for tau, difference, passed in rows:
+            flag = "" if passed else "  fails"
+            print(f"tau {tau:<6} {difference:>10.2e}{flag}")
+        if not all(passed for *_, passed in rows):
+            sys.exit(1)
+    elif args.command == "statistics":
+        rows = statistics(args.tolerance)
+        for statistic, difference, passed in rows:
+            flag = "" if passed else "  differs"
+            print(f"{statistic:<16} {difference:>10.2e}{flag}")
+        if not all(passed for *_, passed in rows):
+            sys.exit(1)
+    else:
+        rows = compare(args.base, args.new, args.threshold)
+        print(f"{'points':>9} {'stage':<12} {'step':<10} {'base (s)':>10} {'new (s)':>10} {'ratio':>7}")
+        for points, stage, step, base_seconds, new_seconds, regressed in rows:
+            ratio = new_seconds / base_seconds if base_seconds > 0 else float("inf")
+            flag = "  slower" if regressed else ""
+            print(f"{points:>9} {stage:<12} {step:<10} {base_seconds:>10.4f} {new_seconds:>10.4f} {ratio:>7.2f}{flag}")
+        if any(regressed for *_, regressed in rows):
+            sys.exit(1)
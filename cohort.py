@@ -0,0 +1,156 @@
+"""
+Preprocesses a cohort of bones in worker processes.
+
+Each specimen is preprocessed exactly as by preprocess.py, into its own mesh.vtp, transform.npy and
+ligament_ids.json. The workers import VTK once and preprocess specimen after specimen. A specimen that fails
+does not stop the others; the summary index, output_dir/cohort_index.json, records the point and cell counts,
+insertion node counts and time of every specimen, or its error, and is rewritten as each specimen finishes.
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from tempfile import mkstemp
+
+import numpy as np
+from vtkmodules.util.numpy_support import vtk_to_numpy
+
+import preprocess
+from config import CohortConfig, PreprocessConfig
+
+INDEX_FILE = "cohort_index.json"
+
+
+def _substitute(value, name: str, parent: str):
+    if isinstance(value, str):
+        return value.replace("{name}", name).replace("{parent}", parent)
+    elif isinstance(value, dict):
+        return {key: _substitute(item, name, parent) for key, item in value.items()}
+    return value
+
+
+def glob_name(pattern: str, path: str) -> str:
+    """
+    Name of a bone matched by a glob pattern: its path below the pattern's directories without wildcards, without
+    the extension and with "_" between directories, e.g. DU03_femur for dat/*/femur.stl matching dat/DU03/femur.stl.
+    """
+    parts = Path(pattern).parts
+    fixed = next((i for i, part in enumerate(parts) if any(c in part for c in "*?[")), len(parts) - 1)
+    relative = Path(path).relative_to(Path(*parts[:fixed])) if fixed > 0 else Path(path)
+    return "_".join(relative.with_suffix("").parts)
+
+
+def get_specimens(config: CohortConfig) -> dict[str, PreprocessConfig]:
+    """
+    The preprocessing configuration of every specimen of the cohort: the listed bones, then the bones matching
+    bone_glob that are not listed, each on top of the defaults.
+
+    :param config: The cohort configuration.
+    :type config: CohortConfig
+
+    :return: The configurations by specimen name.
+    :rtype: dict[str, PreprocessConfig]
+    """
+    entries = [dict(entry) for entry in config.bones]
+    if config.bone_glob is not None:
+        listed = {Path(entry["bone"]).resolve() for entry in entries}
+        matches = sorted(glob.glob(config.bone_glob, recursive=True))
+        entries.extend({"name": glob_name(config.bone_glob, path), "bone": path} for path in matches if Path(path).resolve() not in listed)
+    specimens = {}
+    for entry in entries:
+        name = entry.pop("name", None) or Path(entry["bone"]).stem
+        if name in specimens:
+            raise ValueError(f"Duplicate specimen name: {name}")
+        fields = _substitute(config.defaults, name, Path(entry["bone"]).parent.as_posix()) | entry
+        fields.setdefault("output_dir", Path(config.output_dir).joinpath(name).as_posix())
+        specimens[name] = PreprocessConfig(**fields)
+    return specimens
+
+
+def preprocess_specimen(config: PreprocessConfig) -> dict:
+    """
+    Preprocess one specimen and write its outputs, as preprocess.main does.
+
+    :return: The summary of the specimen: point and cell counts (and the point count of uniform subdivision, if refined adaptively), insertion nodes per ligament and time.
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    bone_poly = preprocess.read_bone(config.bone)
+    bone_poly, transform_matrix, ligament_lut = preprocess.preprocess_bone(bone_poly, config)
+    preprocess.save_outputs(Path(config.output_dir), bone_poly, transform_matrix, ligament_lut)
+    summary = {"points": bone_poly.GetNumberOfPoints(), "cells": bone_poly.GetNumberOfCells()}
+    uniform_points = preprocess.get_uniform_points(bone_poly)
+    if uniform_points is not None:
+        summary["uniform_points"] = uniform_points
+    if ligament_lut:
+        insertion_ids = vtk_to_numpy(bone_poly.GetPointData().GetArray("InsertionID"))
+        counts = np.bincount(insertion_ids, minlength=max(ligament_lut) + 1)
+        summary["insertion_nodes"] = {ligament: int(counts[i]) for i, ligament in ligament_lut.items()}
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def save_index(output_dir: Path, specimens: dict[str, dict], seconds: float):
+    data = {
+        "completed": sum(record["status"] == "completed" for record in specimens.values()),
+        "failed": sum(record["status"] == "failed" for record in specimens.values()),
+        "seconds": round(seconds, 3),
+        "specimens": specimens,
+    }
+    fid, filename = mkstemp(suffix=".json", dir=output_dir)
+    with os.fdopen(fid, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(filename, output_dir.joinpath(INDEX_FILE))
+
+
+def main(config: CohortConfig):
+    output_dir = Path(config.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    specimens = get_specimens(config)
+    start = time.perf_counter()
+    records = {
+        name: {"bone": specimen.bone, "output_dir": specimen.output_dir, "status": "pending"} for name, specimen in specimens.items()
+    }
+    save_index(output_dir, records, 0.0)
+
+    def record_result(name: str, summary: dict | None, error: BaseException | None):
+        if error is not None:
+            records[name] |= {"status": "failed", "error": f"{type(error).__name__}: {error}"}
+        else:
+            records[name] |= {"status": "completed"} | summary
+        save_index(output_dir, records, time.perf_counter() - start)
+
+    if config.jobs > 1:
+        with ProcessPoolExecutor(max_workers=min(config.jobs, max(len(specimens), 1))) as executor:
+            futures = {executor.submit(preprocess_specimen, specimen): name for name, specimen in specimens.items()}
+            for future in as_completed(futures):
+                error = future.exception()
+                record_result(futures[future], None if error is not None else future.result(), error)
+    else:
+        for name, specimen in specimens.items():
+            try:
+                summary = preprocess_specimen(specimen)
+            except Exception as error:
+                record_result(name, None, error)
+            else:
+                record_result(name, summary, None)
+
+    failures = [name for name, record in records.items() if record["status"] == "failed"]
+    if failures:
+        raise RuntimeError(f"Preprocessing failed for {len(failures)} specimen(s), see {output_dir.joinpath(INDEX_FILE)}: {', '.join(failures)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocesses a cohort of bones in parallel worker processes.")
+    parser.add_argument("config", type=str, help="JSON cohort manifest")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes (overrides the manifest)")
+    args = parser.parse_args()
+    with open(args.config, "r") as f:
+        config = CohortConfig(**json.load(f))
+    if args.jobs is not None:
+        config.jobs = args.jobs
+    main(config)
@@ -1,32 +1,286 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Literal
 
 
 @dataclass
 class AugmentConfig:
+    """
+    :param base_mesh_file: Path to the template mesh
+    :type base_mesh_file: str
+    :param output_dir: Path to output directory (if None, augmented_meshes next to the template mesh)
+    :type output_dir: str | None
+    :param control_point_perturbation: Largest control point displacement relative to the shortest side of the template's oriented bounding box
+    :type control_point_perturbation: float
+    :param num_perturbations: Number of augmented meshes
+    :type num_perturbations: int
+    :param seed: Random seed. Each augmented mesh draws from its own stream spawned from it.
+    :type seed: int
+    :param writers: Number of meshes written concurrently
+    :type writers: int
+    :param points_only: Whether to write only the points and point data of the augmented meshes (the connectivity is the template's)
+    :type points_only: bool
+    :param output_format: "vtp" (one file per augmented mesh) or "stack" (the points of all meshes in one array next to the template, see deformation_stack.py)
+    :type output_format: Literal["vtp", "stack"]
+    :param telemetry_log: Path to a JSON-lines log of the run's timings and resource use (if None nothing is recorded)
+    :type telemetry_log: str | None
+    :param profile: Profiler run alongside the telemetry, its output written next to telemetry_log
+    :type profile: Literal["cprofile", "tracemalloc"] | None
+    """
+
     base_mesh_file: str
     output_dir: str | None = None
     control_point_perturbation: float = 0.1
     num_perturbations: int = 10
     seed: int = 42
+    writers: int = 2
+    points_only: bool = False
+    output_format: Literal["vtp", "stack"] = "vtp"
+    telemetry_log: str | None = None
+    profile: Literal["cprofile", "tracemalloc"] | None = None
 
 
 @dataclass
 class PostValidationConfig:
+    """
+    :param template_mesh_file: Path to the template mesh, on which the errors are visualized
+    :type template_mesh_file: str
+    :param ground_truth_path: Path to the directory (or deformation stack) of ground truth (augmented) meshes
+    :type ground_truth_path: str
+    :param result_path: Path to the directory (or deformation stack) of registered meshes, named mapped_<ground truth mesh name>
+    :type result_path: str
+    :param output_dir: Path to output directory
+    :type output_dir: str
+    :param jobs: Number of processes reading mesh pairs
+    :type jobs: int
+    :param plot: Whether to save the box plot of the errors (matplotlib and seaborn are only imported for it)
+    :type plot: bool
+    :param surface_metrics: Whether to also measure the distances between the whole surfaces of the registered and ground truth meshes
+    :type surface_metrics: bool
+    :param surface_tolerance: Surface distance (mm) within which a registered node counts as matching the ground truth surface
+    :type surface_tolerance: float
+    :param telemetry_log: Path to a JSON-lines log of the run's timings and resource use (if None nothing is recorded)
+    :type telemetry_log: str | None
+    :param profile: Profiler run alongside the telemetry, its output written next to telemetry_log
+    :type profile: Literal["cprofile", "tracemalloc"] | None
+    """
+
     template_mesh_file: str
     ground_truth_path: str
     result_path: str
     output_dir: str
+    jobs: int = 1
+    plot: bool = True
+    surface_metrics: bool = True
+    surface_tolerance: float = 1.0
+    telemetry_log: str | None = None
+    profile: Literal["cprofile", "tracemalloc"] | None = None
 
 
 @dataclass
 class PreprocessConfig:
+    """
+    :param bone: Path to the bone mesh (STL or VTP)
+    :type bone: str
+    :param output_dir: Path to output directory of mesh.vtp, transform.npy and ligament_ids.json
+    :type output_dir: str
+    :param ligament_insertions: Paths to the insertion point text files by ligament name (if None no insertions are assigned)
+    :type ligament_insertions: dict[str, str] | None
+    :param subdivisions: Number of subdivision levels
+    :type subdivisions: int
+    :param refinement: "uniform" (Loop subdivision of the whole mesh) or "adaptive" (subdivision of the triangles near the insertion points only, see refinement.py)
+    :type refinement: Literal["uniform", "adaptive"]
+    :param refinement_radius: Distance (mm) from the insertion points within which adaptive refinement subdivides the triangles
+    :type refinement_radius: float
+    :param refinement_distance: Whether refinement_radius is measured in a straight line ("euclidean") or along mesh edges ("geodesic")
+    :type refinement_distance: Literal["euclidean", "geodesic"]
+    :param mirror: Whether to mirror the mesh after centering it
+    :type mirror: bool
+    :param mirror_axis: Axis the mesh is mirrored along
+    :type mirror_axis: Literal["x", "y", "z"]
+    :param insertion_projection: Whether each insertion point marks its nearest node ("node") or is projected onto the surface, marking the nodes within insertion_radius of it ("surface")
+    :type insertion_projection: Literal["node", "surface"]
+    :param insertion_radius: Geodesic distance (mm) from a projected insertion point within which nodes are marked, with "surface" projection
+    :type insertion_radius: float
+    :param telemetry_log: Path to a JSON-lines log of the run's timings and resource use (if None nothing is recorded)
+    :type telemetry_log: str | None
+    :param profile: Profiler run alongside the telemetry, its output written next to telemetry_log
+    :type profile: Literal["cprofile", "tracemalloc"] | None
+    """
+
     bone: str
     output_dir: str
     ligament_insertions: dict[str, str] | None = None
     subdivisions: int = 0
+    refinement: Literal["uniform", "adaptive"] = "uniform"
+    refinement_radius: float = 0.0
+    refinement_distance: Literal["euclidean", "geodesic"] = "euclidean"
     mirror: bool = False
     mirror_axis: Literal["x", "y", "z"] = "x"
+    insertion_projection: Literal["node", "surface"] = "node"
+    insertion_radius: float = 0.0
+    telemetry_log: str | None = None
+    profile: Literal["cprofile", "tracemalloc"] | None = None
+
+
+@dataclass
+class CohortConfig:
+    """
+    :param output_dir: Directory of the summary index. Specimens without an output_dir are written to output_dir/<name>.
+    :type output_dir: str
+    :param bones: Specimens, each given by PreprocessConfig fields (output_dir may be omitted) and an optional name (if None the bone file name without extension)
+    :type bones: list[dict]
+    :param bone_glob: Glob pattern of further bone files, preprocessed with the defaults and named by their path below the pattern's directories without wildcards
+    :type bone_glob: str | None
+    :param defaults: PreprocessConfig fields shared by all specimens. "{name}" in their strings is replaced by the specimen name and "{parent}" by the directory of its bone file.
+    :type defaults: dict
+    :param jobs: Number of specimens preprocessed concurrently, each in its own process
+    :type jobs: int
+    """
+
+    output_dir: str
+    bones: list[dict] = field(default_factory=list)
+    bone_glob: str | None = None
+    defaults: dict = field(default_factory=dict)
+    jobs: int = 1
+
+
+@dataclass
+class BenchmarkConfig:
+    """
+    :param output_dir: Directory of the synthetic meshes, the outputs of every stage and benchmark_results.json
+    :type output_dir: str
+    :param sizes: Approximate numbers of points of the synthetic bones, one benchmark per size
+    :type sizes: list[int]
+    :param num_targets: Number of targets augmented from each synthetic template
+    :type num_targets: int
+    :param repeats: Number of runs of each stage, of which the fastest is reported
+    :type repeats: int
+    :param backend: Registration backend: "numpy" (in-process engine) or "cli" (bcpd executable)
+    :type backend: Literal["cli", "numpy"]
+    :param stub: Whether the cli backend runs a stand-in for bcpd that returns the template points unchanged, so that only the surrounding pipeline is timed
+    :type stub: bool
+    :param preprocess: PreprocessConfig fields applied to the synthetic bones, e.g. subdivisions or insertion_projection
+    :type preprocess: dict
+    :param register: GBCPDConfig fields overriding the benchmark's registration settings (a fixed number of VB loops and no result cache)
+    :type register: dict
+    :param postprocess_jobs: Number of processes reading mesh pairs in the postprocessing
+    :type postprocess_jobs: int
+    :param profile: Whether to profile every stage with cProfile and report the cumulative time of its slowest kneemorph functions
+    :type profile: bool
+    :param seed: Seed of the synthetic insertion points and of the augmentation
+    :type seed: int
+    """
+
+    output_dir: str
+    sizes: list[int] = field(default_factory=lambda: [10_000, 100_000])
+    num_targets: int = 4
+    repeats: int = 1
+    backend: Literal["cli", "numpy"] = "numpy"
+    stub: bool = True
+    preprocess: dict = field(default_factory=dict)
+    register: dict = field(default_factory=dict)
+    postprocess_jobs: int = 1
+    profile: bool = False
+    seed: int = 0
+
+
+@dataclass
+class SweepConfig:
+    """
+    :param register: GBCPDConfig of the registrations, as a path to its JSON file or the configuration itself. Its target_mesh_path is the validation set (augmented meshes with their InsertionID arrays), which is both registered to and the ground truth.
+    :type register: str | dict
+    :param output_dir: Directory of sweep_results.json and sweep_results.csv
+    :type output_dir: str
+    :param parameters: GBCPDConfig fields to search and their values: a list of values, or for random search a range {"low": ..., "high": ..., "log": false} (integer if both bounds are)
+    :type parameters: dict[str, list | dict]
+    :param search: "grid" (every combination of the listed values) or "random" (samples configurations drawn from the values and ranges)
+    :type search: Literal["grid", "random"]
+    :param samples: Number of configurations of a random search
+    :type samples: int
+    :param min_targets: Number of targets every configuration is first evaluated on. After each round only the best 1/eta of the configurations go on, evaluated on eta times as many targets, until the survivors have seen every target. If None every configuration is evaluated on every target.
+    :type min_targets: int | None
+    :param eta: Factor by which successive halving cuts the configurations and grows the targets in each round
+    :type eta: int
+    :param max_targets: Number of targets of the validation set used, drawn at random (if None all of them)
+    :type max_targets: int | None
+    :param jobs: Number of targets registered concurrently, overriding the registration configuration's jobs
+    :type jobs: int
+    :param seed: Seed of the random configurations and of the order of the targets
+    :type seed: int
+    :param telemetry_log: Path to a JSON-lines log of the run's timings and resource use (if None nothing is recorded)
+    :type telemetry_log: str | None
+    :param profile: Profiler run alongside the telemetry, its output written next to telemetry_log
+    :type profile: Literal["cprofile", "tracemalloc"] | None
+    """
+
+    register: str | dict
+    output_dir: str
+    parameters: dict[str, list | dict]
+    search: Literal["grid", "random"] = "grid"
+    samples: int = 16
+    min_targets: int | None = None
+    eta: int = 3
+    max_targets: int | None = None
+    jobs: int = 1
+    seed: int = 0
+    telemetry_log: str | None = None
+    profile: Literal["cprofile", "tracemalloc"] | None = None
+
+
+@dataclass
+class AlignConfig:
+    """
+    :param template_mesh_file: Path to the template mesh file the target is aligned onto
+    :type template_mesh_file: str
+    :param target_mesh_file: Path to the target mesh file
+    :type target_mesh_file: str
+    :param output_dir: Directory of the aligned mesh, its transform.npy and alignment.json
+    :type output_dir: str
+    :param transform_file: transform.npy of the preprocessing that produced the target mesh, composed with the alignment so that the written transform maps the original target (if None the alignment alone is written)
+    :type transform_file: str | None
+    :param scaling: Whether to also fit a uniform scale (similarity) rather than only a rotation and translation
+    :type scaling: bool
+    :param reflection: Whether to also try mirror images of the target, e.g. for a knee of the other side
+    :type reflection: bool
+    :param iterations: Maximum number of ICP iterations refining the best initial alignment
+    :type iterations: int
+    :param tolerance: Relative change of the ICP distance below which the iterations stop
+    :type tolerance: float
+    :param seed: Seed of the subsampling of point clouds
+    :type seed: int
+    :param telemetry_log: Path to a JSON-lines log of the run's timings and resource use (if None nothing is recorded)
+    :type telemetry_log: str | None
+    :param profile: Profiler run alongside the telemetry, its output written next to telemetry_log
+    :type profile: Literal["cprofile", "tracemalloc"] | None
+    """
+
+    template_mesh_file: str
+    target_mesh_file: str
+    output_dir: str
+    transform_file: str | None = None
+    scaling: bool = False
+    reflection: bool = False
+    iterations: int = 50
+    tolerance: float = 1e-6
+    seed: int = 0
+    telemetry_log: str | None = None
+    profile: Literal["cprofile", "tracemalloc"] | None = None
+
+
+@dataclass
+class ResolutionLevel:
+    """
+    :param points: Point budget of the decimated source and target meshes
+    :type points: int
+    :param n_max: Maximum number of VB loops at this level
+    :type n_max: int
+    :param n_min: Minimum number of VB loops at this level
+    :type n_min: int
+    """
+
+    points: int
+    n_max: int = 500
+    n_min: int = 30
 
 
 @dataclass
@@ -34,7 +288,7 @@ class GBCPDConfig:
     """
     :param source_mesh_file: Path to source mesh file
     :type source_mesh_file: str
-    :param target_mesh_path: Path to target mesh file or directory containing multiple target meshes
+    :param target_mesh_path: Path to target mesh file, directory containing multiple target meshes or deformation stack
     :type target_mesh_path: str
     :param output_dir: Path to output directory
     :type output_dir: str
@@ -69,6 +323,36 @@ class GBCPDConfig:
     :param tau: Weight controlling balance between geodesic and Gaussian kernels
     :type tau: float
 
+    :param levels: Coarse resolution levels registered before the full-resolution template, coarsest first.
+        The full-resolution refinement uses n_max and n_min.
+    :type levels: list[ResolutionLevel] | None
+    :param backend: Registration backend: "cli" (bcpd executable) or "numpy" (in-process engine)
+    :type backend: Literal["cli", "numpy"]
+    :param cache_dir: Directory of the on-disk cache of template geodesic distances, kernel factors (numpy backend) and registration results (if None nothing is cached on disk)
+    :type cache_dir: str | None
+    :param jobs: Number of targets registered concurrently
+    :type jobs: int
+    :param threads: Number of OpenMP threads per bcpd process (if None the available cores are split evenly between jobs)
+    :type threads: int | None
+    :param prefetch: Number of targets read and converted ahead of the running registrations
+    :type prefetch: int
+    :param scratch_dir: Directory for files exchanged with bcpd (if None a tmpfs directory is used when available)
+    :type scratch_dir: str | None
+    :param output_format: "vtp" (one mapped mesh file per target) or "stack" (the mapped points of all targets in a deformation stack in output_dir)
+    :type output_format: Literal["vtp", "stack"]
+    :param telemetry_log: Path to a JSON-lines log of the run's timings and resource use (if None nothing is recorded)
+    :type telemetry_log: str | None
+    :param profile: Profiler run alongside the telemetry, its output written next to telemetry_log
+    :type profile: Literal["cprofile", "tracemalloc"] | None
+    :param warm_start: Start each target from the template registered to another target: "sequential" (the previous target, with targets ordered by similarity), "nearest" (the most similar target registered so far) or "previous" (the target's own result of a previous run in output_dir). If None every target starts from the template.
+    :type warm_start: Literal["previous", "nearest", "sequential"] | None
+    :param warm_start_check: Number of warm-started targets also registered from the template, to measure the VB loops saved and the difference between warm and cold results
+    :type warm_start_check: int
+    :param prealign: Align every target onto the template before registering it: "rigid" (rotation and translation) or "similarity" (also a uniform scale). The alignment is undone on the mapped meshes. If None targets are registered as given.
+    :type prealign: Literal["rigid", "similarity"] | None
+    :param prealign_reflection: Whether the pre-alignment also tries mirror images of the targets, e.g. for knees of the other side
+    :type prealign_reflection: bool
+
     """
 
     source_mesh_file: str
@@ -89,3 +373,56 @@ class GBCPDConfig:
     n_max: int = 500
     n_min: int = 30
     tau: float = 0.5
+    levels: list[ResolutionLevel] | None = None
+    backend: Literal["cli", "numpy"] = "cli"
+    cache_dir: str | None = None
+    jobs: int = 1
+    threads: int | None = None
+    prefetch: int = 2
+    scratch_dir: str | None = None
+    output_format: Literal["vtp", "stack"] = "vtp"
+    telemetry_log: str | None = None
+    profile: Literal["cprofile", "tracemalloc"] | None = None
+    warm_start: Literal["previous", "nearest", "sequential"] | None = None
+    warm_start_check: int = 0
+    prealign: Literal["rigid", "similarity"] | None = None
+    prealign_reflection: bool = False
+
+    def __post_init__(self):
+        if self.levels is not None:
+            self.levels = [ResolutionLevel(**level) if isinstance(level, dict) else level for level in self.levels]
+
+
+@dataclass
+class StudyStage:
+    """
+    :param stage: Which script the stage runs
+    :type stage: Literal["preprocess", "augment", "register", "postprocess"]
+    :param config: Path to the stage's JSON configuration file, or the configuration itself
+    :type config: str | dict
+    :param name: Name of the stage in the study state (if None the configuration file name, or the stage and its index)
+    :type name: str | None
+    """
+
+    stage: Literal["preprocess", "augment", "register", "postprocess"]
+    config: str | dict
+    name: str | None = None
+
+
+@dataclass
+class StudyConfig:
+    """
+    :param output_dir: Directory in which the study state is kept
+    :type output_dir: str
+    :param stages: The stages of the study. Stages are ordered by the files they read and produce, not by their position.
+    :type stages: list[StudyStage]
+    :param write_intermediates: Whether to write the outputs of stages consumed by other stages (outputs of final stages are always written)
+    :type write_intermediates: bool
+    """
+
+    output_dir: str
+    stages: list[StudyStage]
+    write_intermediates: bool = False
+
+    def __post_init__(self):
+        self.stages = [StudyStage(**stage) if isinstance(stage, dict) else stage for stage in self.stages]
@@ -0,0 +1,259 @@
+"""
+Compact storage of many meshes that share the connectivity of one template and differ only in their point
+coordinates, such as augmented meshes or meshes mapped from the same template.
+
+A stack is a directory holding:
+
+- stack.json: the names of the meshes, one per row of the stack, and the content hash of the template.
+- template.vtp: the shared template, with its connectivity and point data (e.g. InsertionID).
+- points.npy: the (N, P, 3) float32 coordinates, readable as a memory map so that a single mesh (or a single
+  node across all meshes) is read without loading the rest.
+- filled.npy: the (N,) mask of the rows written so far. The other rows, e.g. of targets whose registration failed,
+  hold no mesh and are left out when the stack is read.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from collections.abc import Iterable, Iterator
+from functools import lru_cache
+from pathlib import Path
+from tempfile import mkstemp
+
+import numpy as np
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+from utils import numpy_to_points, read_vtp, save_vtp
+
+INDEX_FILE = "stack.json"
+TEMPLATE_FILE = "template.vtp"
+POINTS_FILE = "points.npy"
+FILLED_FILE = "filled.npy"
+
+
+def is_stack(path: Path | str) -> bool:
+    return Path(path).joinpath(INDEX_FILE).is_file()
+
+
+def mesh_with_points(template: vtkPolyData, points: np.ndarray) -> vtkPolyData:
+    """
+    Copy of the template sharing its connectivity and point data, with the given coordinates.
+    """
+    mesh = vtkPolyData()
+    mesh.ShallowCopy(template)
+    # Copied, so that the mesh does not hold on to a memory-mapped row
+    mesh.SetPoints(numpy_to_points(np.array(points)))
+    return mesh
+
+
+def template_hash(template: vtkPolyData) -> str:
+    """
+    SHA-256 of the points, connectivity and point data of a template.
+    """
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(vtk_to_numpy(template.GetPoints().GetData())).tobytes())
+    for cells in (template.GetVerts(), template.GetLines(), template.GetPolys(), template.GetStrips()):
+        digest.update(vtk_to_numpy(cells.GetOffsetsArray()).tobytes())
+        digest.update(vtk_to_numpy(cells.GetConnectivityArray()).tobytes())
+    point_data = template.GetPointData()
+    for i in range(point_data.GetNumberOfArrays()):
+        array = point_data.GetArray(i)
+        if array is not None:
+            digest.update(str(array.GetName()).encode())
+            digest.update(np.ascontiguousarray(vtk_to_numpy(array)).tobytes())
+    return digest.hexdigest()
+
+
+def _write_index(directory: Path, names: list[str], template: str):
+    fid, filename = mkstemp(suffix=".json", dir=directory)
+    with os.fdopen(fid, "w") as f:
+        json.dump({"names": names, "template": template}, f, indent=4)
+    os.replace(filename, directory.joinpath(INDEX_FILE))
+
+
+class StackWriter:
+    """
+    Creates a stack for a known list of names and fills its rows in any order. An existing stack with the same
+    names and template is reopened instead, so that an interrupted run can fill the remaining rows; created tells
+    which of the two happened.
+    """
+
+    def __init__(self, directory: Path | str, template: vtkPolyData, names: list[str]):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.names = list(names)
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        if len(self.rows) != len(self.names):
+            raise ValueError("Stack names must be unique")
+        shape = (len(self.names), template.GetNumberOfPoints(), 3)
+        points_file = self.directory.joinpath(POINTS_FILE)
+        filled_file = self.directory.joinpath(FILLED_FILE)
+        template_digest = template_hash(template)
+        index = {"names": self.names, "template": template_digest}
+        if is_stack(self.directory) and points_file.is_file() and filled_file.is_file() and _read_index(self.directory) == index:
+            self.points = np.load(points_file, mmap_mode="r+")
+            self.filled = np.load(filled_file, mmap_mode="r+")
+            if self.points.shape == shape and self.filled.shape == shape[:1]:
+                self.created = False
+                return
+        save_vtp(template, self.directory.joinpath(TEMPLATE_FILE))
+        self.points = np.lib.format.open_memmap(points_file, mode="w+", dtype=np.float32, shape=shape)
+        self.filled = np.lib.format.open_memmap(filled_file, mode="w+", dtype=bool, shape=shape[:1])
+        _write_index(self.directory, self.names, template_digest)
+        self.created = True
+
+    def write(self, name: str, points: np.ndarray):
+        row = self.rows[name]
+        self.points[row] = points
+        self.filled[row] = True
+
+    def is_filled(self, name: str) -> bool:
+        return bool(self.filled[self.rows[name]])
+
+    def read(self, name: str) -> np.ndarray:
+        return np.array(self.points[self.rows[name]])
+
+    def close(self):
+        self.points.flush()
+        self.filled.flush()
+        self.points = None
+        self.filled = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _read_index(directory: Path | str) -> dict:
+    with open(Path(directory).joinpath(INDEX_FILE), "r") as f:
+        return json.load(f)
+
+
+def _read_filled(directory: Path | str, size: int) -> np.ndarray:
+    filled_file = Path(directory).joinpath(FILLED_FILE)
+    # Stacks written before the mask was kept have all their rows filled
+    return np.load(filled_file) if filled_file.is_file() else np.ones(size, dtype=bool)
+
+
+def read_names(directory: Path | str) -> list[str]:
+    """
+    Names of the filled rows of a stack, in row order.
+    """
+    names = _read_index(directory)["names"]
+    return [name for name, filled in zip(names, _read_filled(directory, len(names))) if filled]
+
+
+class DeformationStack:
+    """
+    Read access to the filled rows of a stack. The coordinates are memory-mapped, so opening a stack reads only its
+    index, mask and template.
+    """
+
+    def __init__(self, directory: Path | str):
+        self.directory = Path(directory)
+        if not is_stack(self.directory):
+            raise FileNotFoundError(f"File not found: {self.directory.joinpath(INDEX_FILE)}")
+        names = _read_index(self.directory)["names"]
+        filled = _read_filled(self.directory, len(names))
+        self.rows = {name: row for row, name in enumerate(names) if filled[row]}
+        self.names = list(self.rows)
+        self.template = read_vtp(self.directory.joinpath(TEMPLATE_FILE))
+        self.points = np.load(self.directory.joinpath(POINTS_FILE), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def get_points(self, name: str) -> np.ndarray:
+        return self.points[self.rows[name]]
+
+    def get_mesh(self, name: str) -> vtkPolyData:
+        return mesh_with_points(self.template, self.get_points(name))
+
+    def iter_meshes(self) -> Iterator[tuple[str, vtkPolyData]]:
+        for name in self.names:
+            yield name, self.get_mesh(name)
+
+
+@lru_cache(maxsize=8)
+def _open_stack(directory: Path, stamps: tuple[tuple[int, int, int], ...]) -> DeformationStack:
+    return DeformationStack(directory)
+
+
+def open_stack(directory: Path) -> DeformationStack:
+    """
+    Stack opened once per process, for readers of many rows. It is opened again when one of its files has been
+    rewritten since.
+    """
+    stats = [Path(directory).joinpath(filename).stat() for filename in (INDEX_FILE, TEMPLATE_FILE, POINTS_FILE)]
+    filled_file = Path(directory).joinpath(FILLED_FILE)
+    if filled_file.is_file():
+        stats.append(filled_file.stat())
+    return _open_stack(directory, tuple((stat.st_ino, stat.st_size, stat.st_mtime_ns) for stat in stats))
+
+
+def save_stack(directory: Path | str, names: list[str], meshes: Iterable[vtkPolyData]):
+    """
+    Write meshes sharing the connectivity of the first one as a stack, one mesh at a time.
+
+    :param directory: The stack directory.
+    :type directory: Path | str
+    :param names: Names of the meshes.
+    :type names: list[str]
+    :param meshes: The meshes, in the order of names. Only the points of all but the first mesh are used.
+    :type meshes: Iterable[vtkPolyData]
+    """
+    writer = None
+    for name, mesh in zip(names, meshes, strict=True):
+        if writer is None:
+            writer = StackWriter(directory, mesh, names)
+        writer.write(name, vtk_to_numpy(mesh.GetPoints().GetData()))
+    if writer is None:
+        raise ValueError("Cannot save an empty stack")
+    writer.close()
+
+
+def export_vtp(directory: Path | str, output_dir: Path | str, names: list[str] | None = None):
+    """
+    Write the meshes of a stack as individual .vtp files, <name>.vtp, for viewing.
+
+    :param directory: The stack directory.
+    :type directory: Path | str
+    :param output_dir: Directory in which the meshes are written.
+    :type output_dir: Path | str
+    :param names: Names of the meshes to export (if None all of them).
+    :type names: list[str] | None
+    """
+    stack = DeformationStack(directory)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for name in names if names is not None else stack.names:
+        save_vtp(stack.get_mesh(name), output_dir.joinpath(f"{name}.vtp"))
+
+
+def pack_vtp(input_dir: Path | str, directory: Path | str):
+    """
+    Store the .vtp meshes of a directory, which must share their connectivity, as a stack named by file stem.
+    """
+    mesh_paths = sorted(Path(input_dir).glob("*.vtp"))
+    save_stack(directory, [path.stem for path in mesh_paths], (read_vtp(path) for path in mesh_paths))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts between deformation stacks and directories of .vtp meshes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Write the meshes of a stack as .vtp files")
+    export_parser.add_argument("stack", type=str, help="Stack directory")
+    export_parser.add_argument("output", type=str, help="Output directory")
+    export_parser.add_argument("--names", type=str, nargs="+", default=None, help="Names of the meshes to export")
+    pack_parser = subparsers.add_parser("pack", help="Store a directory of .vtp meshes sharing their connectivity as a stack")
+    pack_parser.add_argument("input", type=str, help="Directory of .vtp meshes")
+    pack_parser.add_argument("stack", type=str, help="Stack directory")
+    args = parser.parse_args()
+    if args.command == "export":
+        export_vtp(args.stack, args.output, args.names)
+    else:
+        pack_vtp(args.input, args.stack)
@@ -0,0 +1,358 @@
+"""
+In-process implementation of (geodesic-based) Bayesian coherent point drift.
+
+Follows the variational Bayes loop of Hirose, "A Bayesian formulation of coherent point drift" (TPAMI 2021),
+with the acceleration of its Section 5: the kernel matrix G is replaced by a rank-K Nystrom approximation and
+the matching probabilities P by a rank-J Nystrom approximation, which is swapped for a local nearest-neighbour
+evaluation once the residual variance becomes small. With tau > 0 the geodesic kernel of GBCPD is mixed into G.
+"""
+
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from config import GBCPDConfig
+from geodesic import kernel_factors, landmark_distances, mesh_hash, squared_distances
+
+# P is evaluated exactly (in chunks) when the M x N problem has at most this many entries
+DENSE_LIMIT = 25_000_000
+# Number of entries of each M x chunk block of the exact evaluation
+CHUNK_SIZE = 4_000_000
+# P uses the Nystrom approximation while sigma (in normalized units) is above this value
+NYSTROM_MIN_SIGMA = 0.2
+# Number of nearest source points used by the local evaluation of P
+LOCAL_NEIGHBOURS = 32
+# Relative cutoff below which eigenvalues of the Nystrom landmark block of P are discarded
+EIGENVALUE_CUTOFF = 1e-10
+
+
+@dataclass
+class BCPDResult:
+    """
+    Deformed source points and the number of VB loops run. The bcpd executable may not report its loop count
+    and final residual variance, which are then None.
+    """
+
+    points: np.ndarray
+    iterations: int | None
+    sigma2: float | None
+
+
+def register(
+    target_points: np.ndarray,
+    source_points: np.ndarray,
+    config: GBCPDConfig,
+    triangles: np.ndarray | None = None,
+    template_points: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Register the source points to the target points.
+
+    :param target_points: (N, D) target points (X in bcpd).
+    :type target_points: np.ndarray
+    :param source_points: (M, D) source points (Y in bcpd).
+    :type source_points: np.ndarray
+    :param config: Registration parameters. Only the algorithm parameters are used.
+    :type config: GBCPDConfig
+    :param triangles: (F, 3) zero-based source triangles, required when config.tau > 0.
+    :type triangles: np.ndarray | None
+    :param template_points: (M, D) undeformed points of the source mesh, when source_points are the template itself
+        or a deformed copy of it with the same triangles (e.g. a warm start). The kernel G and its geodesic distances
+        are then computed on the template and cached in config.cache_dir, so that every registration against it
+        reuses them. If None they are computed on the source points and not cached on disk.
+    :type template_points: np.ndarray | None
+
+    :return: The (M, D) deformed source points in target coordinates, as written by bcpd to output_y.txt.
+    :rtype: np.ndarray
+    """
+    return solve(target_points, source_points, config, triangles, template_points).points
+
+
+def solve(
+    target_points: np.ndarray,
+    source_points: np.ndarray,
+    config: GBCPDConfig,
+    triangles: np.ndarray | None = None,
+    template_points: np.ndarray | None = None,
+) -> BCPDResult:
+    """
+    Run the variational Bayes loop of BCPD. See register for the parameters.
+
+    :return: The deformed source points, the number of loops run and the final residual variance.
+    :rtype: BCPDResult
+    """
+    rng = np.random.default_rng(config.r)
+    source_points = np.asarray(source_points, dtype=np.float64)
+    x, y, center, scale = _normalize(np.asarray(target_points, dtype=np.float64), source_points, config.nrm)
+    n, dim = x.shape
+    m = y.shape[0]
+
+    landmarks = _sample(m, config.K, rng)
+    if not np.isclose(config.tau, 0.0) and triangles is None:
+        raise ValueError("Source triangles are required for the geodesic kernel (tau > 0)")
+    # G is evaluated on the template normalized by its own location and scale, whatever the target, so that its
+    # factors only depend on the template, the landmarks, beta and tau
+    kernel_points = source_points if template_points is None else np.asarray(template_points, dtype=np.float64)
+    kernel_cache_dir = None if template_points is None else config.cache_dir
+    _, kernel_y, _, kernel_scale = _normalize(kernel_points, kernel_points, "y")
+
+    def geodesic_distances() -> np.ndarray:
+        return landmark_distances(kernel_points, triangles, landmarks, kernel_cache_dir) / kernel_scale
+
+    factor_key = f"{mesh_hash(kernel_points, triangles)}-{mesh_hash(landmarks)}"
+    basis, eigenvalues = kernel_factors(kernel_y, landmarks, config.beta, config.tau, geodesic_distances, factor_key, kernel_cache_dir)
+
+    outlier_density = 1.0 / np.prod(np.maximum(np.ptp(x, axis=0), np.finfo(float).eps))
+    x_squared = np.einsum("ij,ij->i", x, x)
+    alpha = np.full(m, 1.0 / m)
+    s = 1.0
+    rotation = np.eye(dim)
+    translation = np.zeros(dim)
+    v = np.zeros_like(y)
+    sigma_m2 = np.ones(m)
+    sigma2 = config.gamma * _mean_squared_distance(x, y)
+
+    iteration = 0
+    for iteration in range(1, config.n_max + 1):
+        u = y + v
+        y_hat = s * u @ rotation.T + translation
+        weights = alpha * np.exp(-(s**2) * dim * sigma_m2 / (2 * sigma2))
+        nu, nu_x, px = _expectation(x, y_hat, sigma2, weights, config.omega, outlier_density, config.J, rng)
+        n_hat = max(nu.sum(), np.finfo(float).tiny)
+
+        # Update the displacement field and its posterior covariance
+        precision = s**2 / sigma2 * nu
+        residual = (px - nu[:, None] * translation) @ rotation / s - nu[:, None] * y
+        v = _posterior_mean(basis, eigenvalues, config.lambda_, precision, s**2 / sigma2 * residual)
+        sigma_m2 = _posterior_variance(basis, eigenvalues, config.lambda_, precision)
+
+        # Update the mixing coefficients
+        if config.kappa is not None:
+            alpha = np.exp(_digamma(config.kappa + nu) - _digamma(config.kappa * m + n_hat))
+
+        # Update the similarity transform
+        u = y + v
+        x_bar = px.sum(axis=0) / n_hat
+        u_bar = nu @ u / n_hat
+        sigma_bar2 = nu @ sigma_m2 / n_hat
+        u_centered = u - u_bar
+        s_xu = (px - nu[:, None] * x_bar).T @ u_centered / n_hat
+        s_uu = (nu[:, None] * u_centered).T @ u_centered / n_hat + sigma_bar2 * np.eye(dim)
+        phi, _, psi_t = np.linalg.svd(s_xu)
+        correction = np.ones(dim)
+        correction[-1] = np.linalg.det(phi @ psi_t)
+        rotation = (phi * correction) @ psi_t
+        s = np.trace(rotation.T @ s_xu) / np.trace(s_uu)
+        translation = x_bar - s * rotation @ u_bar
+
+        # Update the residual variance
+        y_previous = y_hat
+        y_hat = s * u @ rotation.T + translation
+        sigma2_new = (nu_x @ x_squared - 2 * np.sum(px * y_hat) + nu @ np.einsum("ij,ij->i", y_hat, y_hat)) / (n_hat * dim)
+        sigma2_new = max(sigma2_new + s**2 * sigma_bar2, np.finfo(float).eps)
+
+        # Converged when either the residual variance or the deformed shape (in normalized units) stops changing;
+        # the latter catches exact matches, where sigma2 keeps shrinking geometrically
+        sigma2_change = abs(sigma2_new - sigma2) / sigma2
+        shape_change = np.sqrt(np.mean(np.sum((y_hat - y_previous) ** 2, axis=1)))
+        sigma2 = sigma2_new
+        if iteration >= config.n_min and min(sigma2_change, shape_change) < config.c:
+            break
+
+    y_hat = s * (y + v) @ rotation.T + translation
+    return BCPDResult(y_hat * scale + center, iteration, sigma2 * scale**2)
+
+
+def _normalize(x: np.ndarray, y: np.ndarray, nrm: str) -> tuple[np.ndarray, np.ndarray, np.ndarray, float]:
+    """
+    Center and scale both point sets with the location and scale of the target ("x") or source ("y").
+    """
+    reference = x if nrm == "x" else y
+    center = reference.mean(axis=0)
+    scale = np.sqrt(np.mean(np.sum((reference - center) ** 2, axis=1)))
+    return (x - center) / scale, (y - center) / scale, center, scale
+
+
+def _mean_squared_distance(x: np.ndarray, y: np.ndarray) -> float:
+    """
+    Mean of ||x_n - y_m||^2 / D over all pairs, computed without forming the pairs.
+    """
+    x_mean = x.mean(axis=0)
+    y_mean = y.mean(axis=0)
+    return (np.mean(np.sum(x**2, axis=1)) + np.mean(np.sum(y**2, axis=1)) - 2 * x_mean @ y_mean) / x.shape[1]
+
+
+def _sample(size: int, count: int | None, rng: np.random.Generator) -> np.ndarray:
+    if count is None or count >= size:
+        return np.arange(size)
+    return np.sort(rng.choice(size, count, replace=False))
+
+
+def _posterior_mean(basis: np.ndarray, eigenvalues: np.ndarray, lambda_: float, precision: np.ndarray, rhs: np.ndarray) -> np.ndarray:
+    """
+    Compute (lambda G^-1 + diag(precision))^-1 @ rhs with the Woodbury identity on the low-rank G.
+    """
+    inner = lambda_ * np.diag(1 / eigenvalues) + basis.T @ (precision[:, None] * basis)
+    corrected = rhs - precision[:, None] * (basis @ np.linalg.solve(inner, basis.T @ rhs))
+    return basis @ (eigenvalues[:, None] * (basis.T @ corrected)) / lambda_
+
+
+def _posterior_variance(basis: np.ndarray, eigenvalues: np.ndarray, lambda_: float, precision: np.ndarray) -> np.ndarray:
+    """
+    Diagonal of (lambda G^-1 + diag(precision))^-1 with the Woodbury identity on the low-rank G.
+    """
+    projected = basis.T @ (precision[:, None] * basis)
+    inner = lambda_ * np.diag(1 / eigenvalues) + projected
+    correction = eigenvalues[:, None] * np.linalg.solve(inner.T, projected.T).T
+    variance = np.einsum("ij,ij->i", basis * eigenvalues, basis) - np.einsum("ij,ij->i", basis @ correction, basis)
+    return np.maximum(variance / lambda_, 0.0)
+
+
+def _expectation(
+    x: np.ndarray,
+    y_hat: np.ndarray,
+    sigma2: float,
+    weights: np.ndarray,
+    omega: float,
+    outlier_density: float,
+    num_samples: int | None,
+    rng: np.random.Generator,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Statistics of the matching probabilities P (M x N) without storing P.
+
+    :return: nu = P 1 (M), nu' = P^T 1 (N) and P X (M, D).
+    :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+    m, n = y_hat.shape[0], x.shape[0]
+    dim = x.shape[1]
+    normalization = (1 - omega) * (2 * np.pi * sigma2) ** (-dim / 2)
+    if m * n <= DENSE_LIMIT:
+        operator = _DenseGaussian(x, y_hat, sigma2)
+    elif np.sqrt(sigma2) > NYSTROM_MIN_SIGMA and num_samples is not None:
+        operator = _NystromGaussian(x, y_hat, sigma2, num_samples, rng)
+    else:
+        operator = _LocalGaussian(x, y_hat, sigma2)
+    return operator.expectation(x, normalization * weights, omega * outlier_density)
+
+
+class _GaussianOperator(ABC):
+    """
+    Products with the Gaussian affinity matrix E (M x N), E_mn = exp(-||x_n - y_m||^2 / (2 sigma^2)).
+    """
+
+    @abstractmethod
+    def left(self, weights: np.ndarray) -> np.ndarray:
+        """E.T @ weights"""
+
+    @abstractmethod
+    def right(self, values: np.ndarray) -> np.ndarray:
+        """E @ values"""
+
+    def expectation(self, x: np.ndarray, weights: np.ndarray, outlier: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        inlier = np.maximum(self.left(weights), 0.0)
+        denominator = inlier + outlier
+        denominator[denominator <= 0] = np.finfo(float).tiny
+        scaled = self.right(np.hstack([1 / denominator[:, None], x / denominator[:, None]]))
+        # Approximate products can be slightly negative where the true ones are close to zero
+        nu = weights * np.maximum(scaled[:, 0], 0.0)
+        px = weights[:, None] * scaled[:, 1:]
+        return nu, inlier / denominator, px
+
+
+class _DenseGaussian(_GaussianOperator):
+    """
+    Exact products, evaluated in blocks of target points so that E is never stored.
+    """
+
+    def __init__(self, x: np.ndarray, y_hat: np.ndarray, sigma2: float):
+        self.x = x
+        self.y_hat = y_hat
+        self.sigma2 = sigma2
+        self.chunk = max(1, CHUNK_SIZE // y_hat.shape[0])
+
+    def _blocks(self):
+        for start in range(0, self.x.shape[0], self.chunk):
+            stop = start + self.chunk
+            yield start, stop, np.exp(-squared_distances(self.y_hat, self.x[start:stop]) / (2 * self.sigma2))
+
+    def left(self, weights: np.ndarray) -> np.ndarray:
+        return np.concatenate([weights @ block for _, _, block in self._blocks()])
+
+    def right(self, values: np.ndarray) -> np.ndarray:
+        return sum(block @ values[start:stop] for start, stop, block in self._blocks())
+
+    def expectation(self, x: np.ndarray, weights: np.ndarray, outlier: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Single pass: each block gives the denominators of its targets, then its contribution to nu and P X
+        nu = np.zeros(self.y_hat.shape[0])
+        px = np.zeros_like(self.y_hat)
+        nu_x = np.zeros(x.shape[0])
+        for start, stop, block in self._blocks():
+            inlier = weights @ block
+            denominator = inlier + outlier
+            denominator[denominator <= 0] = np.finfo(float).tiny
+            nu += block @ (1 / denominator)
+            px += block @ (x[start:stop] / denominator[:, None])
+            nu_x[start:stop] = inlier / denominator
+        return weights * nu, nu_x, weights[:, None] * px
+
+
+class _NystromGaussian(_GaussianOperator):
+    """
+    Rank-J approximation E ~= E_yz E_zz^+ E_zx with J landmarks drawn from both point sets.
+    """
+
+    def __init__(self, x: np.ndarray, y_hat: np.ndarray, sigma2: float, num_samples: int, rng: np.random.Generator):
+        combined = np.vstack([x, y_hat])
+        landmarks = combined[_sample(combined.shape[0], num_samples, rng)]
+        self.e_yz = np.exp(-squared_distances(y_hat, landmarks) / (2 * sigma2))
+        self.e_xz = np.exp(-squared_distances(x, landmarks) / (2 * sigma2))
+        e_zz = np.exp(-squared_distances(landmarks, landmarks) / (2 * sigma2))
+        eigenvalues, eigenvectors = np.linalg.eigh((e_zz + e_zz.T) / 2)
+        keep = eigenvalues > EIGENVALUE_CUTOFF * eigenvalues.max()
+        self.inverse = (eigenvectors[:, keep] / eigenvalues[keep]) @ eigenvectors[:, keep].T
+
+    def left(self, weights: np.ndarray) -> np.ndarray:
+        return self.e_xz @ (self.inverse @ (self.e_yz.T @ weights))
+
+    def right(self, values: np.ndarray) -> np.ndarray:
+        return self.e_yz @ (self.inverse @ (self.e_xz.T @ values))
+
+
+class _LocalGaussian(_GaussianOperator):
+    """
+    Truncated products using only the nearest source points of each target point.
+    """
+
+    def __init__(self, x: np.ndarray, y_hat: np.ndarray, sigma2: float):
+        self.size = y_hat.shape[0]
+        distances, self.indices = cKDTree(y_hat).query(x, k=min(LOCAL_NEIGHBOURS, self.size))
+        self.affinity = np.exp(-(distances**2) / (2 * sigma2))
+
+    def left(self, weights: np.ndarray) -> np.ndarray:
+        return np.sum(self.affinity * weights[self.indices], axis=1)
+
+    def right(self, values: np.ndarray) -> np.ndarray:
+        flat_indices = self.indices.ravel()
+        return np.stack(
+            [np.bincount(flat_indices, weights=(self.affinity * column[:, None]).ravel(), minlength=self.size) for column in values.T],
+            axis=1,
+        )
+
+
+def _digamma(values: np.ndarray) -> np.ndarray:
+    """
+    Digamma function for positive arguments, by recurrence up to 6 and the asymptotic series beyond.
+    """
+    values = np.array(values, dtype=np.float64)
+    result = np.zeros_like(values)
+    for _ in range(6):
+        small = values < 6
+        if not small.any():
+            break
+        result[small] -= 1 / values[small]
+        values[small] += 1
+    inverse2 = 1 / values**2
+    return result + np.log(values) - 0.5 / values - inverse2 * (1 / 12 - inverse2 * (1 / 120 - inverse2 / 252))
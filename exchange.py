@@ -0,0 +1,143 @@
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+# Rows formatted per % operation when writing, bounds the size of the intermediate string
+CHUNK_ROWS = 65536
+
+# Number of significant digits needed to round-trip each floating point type through text
+SIGNIFICANT_DIGITS = {
+    np.dtype(np.float16): 5,
+    np.dtype(np.float32): 9,
+    np.dtype(np.float64): 17,
+}
+
+TMPFS_ROOTS = ("/dev/shm",)
+
+
+def scratch_root(required_bytes: int = 0) -> str | None:
+    """
+    Choose a memory-backed directory for files exchanged with the bcpd binary.
+
+    bcpd reads its inputs more than once and writes its outputs to the working directory, so it needs
+    regular files rather than pipes. Placing them on tmpfs keeps them off the disk.
+
+    :param required_bytes: Free space needed in the directory.
+    :type required_bytes: int
+
+    :return: A writable tmpfs directory with enough free space, or None to use the system default.
+    :rtype: str | None
+    """
+    for root in TMPFS_ROOTS:
+        if not (os.path.isdir(root) and os.access(root, os.W_OK)):
+            continue
+        if shutil.disk_usage(root).free > required_bytes:
+            return root
+    return None
+
+
+def estimate_text_size(num_values: int, dtype: np.dtype | type = np.float64) -> int:
+    """
+    Upper bound of the number of bytes needed to write num_values values of the given type as text.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        # sign, leading digit, decimal point, exponent and separator
+        return num_values * (SIGNIFICANT_DIGITS.get(dtype, 17) + 8)
+    return num_values * 21
+
+
+def _get_format(dtype: np.dtype) -> str:
+    if dtype.kind == "f":
+        return f"%.{SIGNIFICANT_DIGITS.get(dtype, 17)}g"
+    elif dtype.kind in "iub":
+        return "%d"
+    raise TypeError(f"Unsupported data type: {dtype}")
+
+
+def write_array(filepath: Path | str, array: np.ndarray, offset: int = 0):
+    """
+    Write a 2D array as whitespace-delimited text, one row per line, without loss of precision.
+
+    Rows are formatted in chunks with a single % operation instead of row by row as numpy.savetxt does.
+
+    :param filepath: Output file path.
+    :type filepath: Path | str
+    :param array: The (N, D) array to write.
+    :type array: np.ndarray
+    :param offset: Value added to every element before writing (e.g. 1 for one-based indices).
+    :type offset: int
+    """
+    array = np.asarray(array)
+    if array.ndim == 1:
+        array = array.reshape(-1, 1)
+    row_format = " ".join([_get_format(array.dtype)] * array.shape[1]) + "\n"
+    with open(Path(filepath).as_posix(), "w") as fid:
+        for start in range(0, array.shape[0], CHUNK_ROWS):
+            chunk = array[start : start + CHUNK_ROWS]
+            if offset:
+                chunk = chunk + offset
+            fid.write((row_format * chunk.shape[0]) % tuple(chunk.ravel().tolist()))
+
+
+def read_array(filepath: Path | str, dtype: np.dtype | type = np.float64, columns: int | None = None) -> np.ndarray:
+    """
+    Read a whitespace- or comma-delimited text file of numbers, as written by bcpd, into a 2D array.
+
+    The whole file is read at once and parsed by numpy.fromstring in a single pass, without the per-line
+    tokenizing of numpy.loadtxt. The number of values per row is taken from the first line.
+
+    :param filepath: Input file path.
+    :type filepath: Path | str
+    :param dtype: Data type of the returned array.
+    :type dtype: np.dtype | type
+    :param columns: Expected number of values per row (if None it is taken from the file).
+    :type columns: int | None
+
+    :return: The (N, columns) array.
+    :rtype: np.ndarray
+    """
+    filepath = Path(filepath)
+    if not filepath.exists():
+        raise FileNotFoundError(f"File not found: {filepath}")
+    with open(filepath.as_posix(), "r") as fid:
+        text = fid.read()
+    if "," in text:
+        text = text.replace(",", " ")
+    row_size = len(text[: text.find("\n")].split()) if "\n" in text else len(text.split())
+    if columns is not None and row_size > 0 and row_size != columns:
+        raise ValueError(f"Expected {columns} values per row in {filepath}, found {row_size}")
+    row_size = row_size if columns is None else columns
+    values = np.fromstring(text, dtype=np.dtype(dtype), sep=" ")
+    if values.size == 0:
+        return values.reshape(0, row_size)
+    if row_size == 0 or values.size % row_size != 0:
+        raise ValueError(f"The rows of {filepath} do not all have {row_size} values")
+    return values.reshape(-1, row_size)
+
+
+def write_points(filepath: Path | str, points: np.ndarray):
+    write_array(filepath, points)
+
+
+def read_points(filepath: Path | str, dtype: np.dtype | type = np.float32) -> np.ndarray:
+    return read_array(filepath, dtype=dtype, columns=3)
+
+
+def write_triangles(filepath: Path | str, triangles: np.ndarray):
+    """
+    Write zero-based triangle connectivity in the one-based format expected by bcpd.
+    """
+    write_array(filepath, triangles, offset=1)
+
+
+def read_triangles(filepath: Path | str) -> np.ndarray:
+    """
+    Read triangle connectivity, returning zero-based indices whether the file is zero- or one-based.
+    """
+    triangles = read_array(filepath, dtype=np.int64, columns=3)
+    if triangles.size > 0 and triangles.min() == 1:
+        triangles -= 1
+    return triangles
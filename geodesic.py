@@ -0,0 +1,202 @@
+"""
+Geodesic distances and low-rank kernel factors of a template mesh, cached so that registering many targets
+to the same template computes them once.
+
+Geodesic distances from the Nystrom landmark nodes are approximated by shortest paths along mesh edges
+(Dijkstra) and stored on disk, keyed by the mesh content and the landmarks. They are computed in template
+units, so they are reused whatever normalization a registration applies. The kernel factors are computed on the
+template normalized by its own location and scale, so they depend on the template, the landmarks, beta and tau
+only; they are stored on disk as well, and the most recent ones are also kept in memory.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+from pathlib import Path
+from tempfile import mkstemp
+from typing import IO
+
+import numpy as np
+from scipy.sparse import coo_array
+from scipy.sparse.csgraph import dijkstra
+
+# Relative cutoff below which eigenvalues of the Nystrom landmark block are discarded
+EIGENVALUE_CUTOFF = 1e-10
+# Number of kernel factorizations kept in memory
+FACTOR_CACHE_SIZE = 8
+
+_factor_cache: OrderedDict[tuple, tuple[np.ndarray, np.ndarray]] = OrderedDict()
+_factor_lock = threading.Lock()
+_key_locks: dict[str, threading.Lock] = {}
+_key_locks_lock = threading.Lock()
+
+
+def _key_lock(key: str) -> threading.Lock:
+    """
+    Lock of a cache entry, so that concurrent registrations against the same template wait for the first one
+    instead of repeating the work.
+    """
+    with _key_locks_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def _save_atomic(filepath: Path, save: Callable[[IO[bytes]], None]):
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    fid, filename = mkstemp(suffix=filepath.suffix, dir=filepath.parent)
+    with os.fdopen(fid, "wb") as f:
+        save(f)
+    os.replace(filename, filepath)
+
+
+def mesh_hash(points: np.ndarray, triangles: np.ndarray | None = None) -> str:
+    """
+    Content hash of a mesh's points and (optionally) triangle connectivity.
+    """
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(points, dtype=np.float64).tobytes())
+    if triangles is not None:
+        digest.update(np.ascontiguousarray(triangles, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def squared_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    (len(a), len(b)) matrix of squared Euclidean distances, computed with a single matrix product.
+    """
+    distances = np.einsum("ij,ij->i", a, a)[:, None] + np.einsum("ij,ij->i", b, b)[None, :] - 2 * a @ b.T
+    return np.maximum(distances, 0.0, out=distances)
+
+
+def mesh_graph(points: np.ndarray, triangles: np.ndarray):
+    """
+    Sparse, symmetric edge-length graph of a triangle mesh.
+    """
+    edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    lengths = np.linalg.norm(points[edges[:, 0]] - points[edges[:, 1]], axis=1)
+    size = points.shape[0]
+    return coo_array((lengths, (edges[:, 0], edges[:, 1])), shape=(size, size)).tocsr()
+
+
+def landmark_distances(
+    points: np.ndarray, triangles: np.ndarray, landmarks: np.ndarray, cache_dir: Path | str | None = None
+) -> np.ndarray:
+    """
+    Geodesic distances from the landmark nodes to every node of the mesh, read from the cache when available.
+
+    :param points: (M, 3) mesh points.
+    :type points: np.ndarray
+    :param triangles: (F, 3) zero-based triangle connectivity.
+    :type triangles: np.ndarray
+    :param landmarks: Indices of the K landmark nodes.
+    :type landmarks: np.ndarray
+    :param cache_dir: Cache directory (if None the distances are not cached on disk).
+    :type cache_dir: Path | str | None
+
+    :return: (K, M) distances in the units of points; nodes not connected to a landmark are at infinity.
+    :rtype: np.ndarray
+    """
+    digest = hashlib.sha256(mesh_hash(points, triangles).encode())
+    digest.update(np.ascontiguousarray(landmarks, dtype=np.int64).tobytes())
+    key = digest.hexdigest()
+    if cache_dir is None:
+        return _compute_landmark_distances(points, triangles, landmarks)
+
+    cache_file = Path(cache_dir).joinpath("geodesic", f"{key}.npy")
+    with _key_lock(key):
+        if cache_file.is_file():
+            return np.load(cache_file)
+        distances = _compute_landmark_distances(points, triangles, landmarks)
+        _save_atomic(cache_file, lambda f: np.save(f, distances))
+    return distances
+
+
+def _compute_landmark_distances(points: np.ndarray, triangles: np.ndarray, landmarks: np.ndarray) -> np.ndarray:
+    return dijkstra(mesh_graph(points, triangles), directed=False, indices=landmarks)
+
+
+def kernel_factors(
+    points: np.ndarray,
+    landmarks: np.ndarray,
+    beta: float,
+    tau: float,
+    geodesic_distances: Callable[[], np.ndarray] | None = None,
+    key: str | None = None,
+    cache_dir: Path | str | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Nystrom factors of the kernel matrix G = tau * G_geodesic + (1 - tau) * G_gaussian, such that
+    G ~= basis @ diag(eigenvalues) @ basis.T. With as many landmarks as points the factorization is exact.
+
+    :param points: (M, D) normalized source points.
+    :type points: np.ndarray
+    :param landmarks: Indices of the K landmark points.
+    :type landmarks: np.ndarray
+    :param beta: Kernel width.
+    :type beta: float
+    :param tau: Weight of the geodesic kernel.
+    :type tau: float
+    :param geodesic_distances: Returns the (K, M) geodesic distances from the landmarks in normalized units,
+        required when tau > 0. It is only called when the factors are not cached.
+    :type geodesic_distances: Callable[[], np.ndarray] | None
+    :param key: Identifies the normalized points and landmarks (if None the factors are not memoized).
+    :type key: str | None
+    :param cache_dir: Cache directory (if None the factors are only memoized in memory).
+    :type cache_dir: Path | str | None
+
+    :return: The (M, k) basis and the k retained eigenvalues.
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    if key is None:
+        return _compute_kernel_factors(points, landmarks, beta, tau, geodesic_distances)
+    cache_key = (key, float(beta), float(tau))
+    with _factor_lock:
+        if cache_key in _factor_cache:
+            _factor_cache.move_to_end(cache_key)
+            return _factor_cache[cache_key]
+
+    if cache_dir is None:
+        factors = _compute_kernel_factors(points, landmarks, beta, tau, geodesic_distances)
+    else:
+        file_key = hashlib.sha256(repr(cache_key).encode()).hexdigest()
+        cache_file = Path(cache_dir).joinpath("kernel", f"{file_key}.npz")
+        with _key_lock(file_key):
+            if cache_file.is_file():
+                with np.load(cache_file) as data:
+                    factors = (data["basis"], data["eigenvalues"])
+            else:
+                factors = _compute_kernel_factors(points, landmarks, beta, tau, geodesic_distances)
+                _save_atomic(cache_file, lambda f: np.savez(f, basis=factors[0], eigenvalues=factors[1]))
+
+    with _factor_lock:
+        _factor_cache[cache_key] = factors
+        while len(_factor_cache) > FACTOR_CACHE_SIZE:
+            _factor_cache.popitem(last=False)
+    return factors
+
+
+def _compute_kernel_factors(
+    points: np.ndarray, landmarks: np.ndarray, beta: float, tau: float, geodesic_distances: Callable[[], np.ndarray] | None
+) -> tuple[np.ndarray, np.ndarray]:
+    columns = np.exp(-squared_distances(points, points[landmarks]) / (2 * beta**2))
+    if geodesic_distances is not None and not np.isclose(tau, 0.0):
+        columns = tau * np.exp(-(geodesic_distances().T ** 2) / (2 * beta**2)) + (1 - tau) * columns
+    block = columns[landmarks]
+    block = (block + block.T) / 2
+    eigenvalues, eigenvectors = np.linalg.eigh(block)
+    keep = eigenvalues > EIGENVALUE_CUTOFF * eigenvalues.max()
+    eigenvalues, eigenvectors = eigenvalues[keep], eigenvectors[:, keep]
+    # Rescaled so that the basis columns approximate unit-norm eigenvectors of G
+    ratio = points.shape[0] / landmarks.size
+    return columns @ eigenvectors / eigenvalues / np.sqrt(ratio), eigenvalues * ratio
+
+
+def clear_factor_cache():
+    """
+    Forget the kernel factors memoized in memory, e.g. to time a registration as the first of its process. Those
+    stored in a cache directory are kept.
+    """
+    with _factor_lock:
+        _factor_cache.clear()
@@ -0,0 +1,154 @@
+"""
+Single entry point of the kneemorph scripts:
+
+    python kneemorph.py <command> [arguments of the script]
+
+Each command runs its script exactly as `python <script>.py [arguments]` would, importing only that script and
+what it needs. The scripts import the VTK modules they use (vtkmodules.vtkCommonDataModel, vtkmodules.vtkIOXML,
+...) rather than vtkmodules.all, and postprocess.py imports matplotlib and seaborn only when it plots, so that
+short jobs started by a scheduler do not spend most of their time importing.
+
+`python kneemorph.py startup` measures the import time of every command's script with `python -X importtime`
+and fails if one exceeds its budget in STARTUP_BUDGETS.
+"""
+
+import argparse
+import runpy
+import subprocess
+import sys
+from pathlib import Path
+
+# Script module and description of each command
+COMMANDS = {
+    "preprocess": ("preprocess", "Subdivide, mirror and center a bone and mark its ligament insertions"),
+    "cohort": ("cohort", "Preprocess many bones in worker processes"),
+    "augment": ("augment", "Make augmented meshes from a template by elastic deformation"),
+    "align": ("align", "Rigidly align a target mesh onto the template"),
+    "register": ("register_gbcpd", "Register the template to target meshes with GBCPD"),
+    "queue": ("workqueue", "Register targets with workers on several nodes, or report their progress"),
+    "postprocess": ("postprocess", "Evaluate the insertion errors of registered validation meshes"),
+    "sweep": ("sweep", "Search registration parameters on the validation set"),
+    "study": ("study", "Run the stages of a study in a single process"),
+    "txt-to-vtp": ("txt_to_vtp", "Convert bcpd point and triangle text files to a .vtp mesh"),
+}
+# Import time budgets in seconds, about twice the times measured with warm bytecode caches on a single core
+STARTUP_BUDGETS = {
+    "preprocess": 0.8,
+    "cohort": 0.8,
+    "augment": 0.4,
+    "align": 0.8,
+    "register": 0.7,
+    "queue": 0.7,
+    "postprocess": 0.4,
+    "sweep": 0.8,
+    "study": 0.8,
+    "txt-to-vtp": 0.3,
+}
+# Runs of each import measurement, of which the fastest is kept
+STARTUP_REPEATS = 3
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, float]]:
+    """
+    The modules listed by `python -X importtime`, in its order (each module after the modules it imported).
+
+    :return: The name, nesting depth (0 for modules imported at the top level) and cumulative import time in
+        seconds of each module.
+    :rtype: list[tuple[str, int, float]]
+    """
+    modules = []
+    for line in stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), depth, int(fields[1]) / 1e6))
+    return modules
+
+
+def import_time(module: str) -> tuple[float, dict[str, float]]:
+    """
+    Time to import a module in a fresh interpreter, and the largest imports within it.
+
+    :return: The fastest import time in seconds of STARTUP_REPEATS runs, and the cumulative times of the modules it
+        imported directly, slowest first.
+    :rtype: tuple[float, dict[str, float]]
+    """
+    best, breakdown = float("inf"), {}
+    for _ in range(STARTUP_REPEATS):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        children = {}
+        for name, depth, seconds in parse_importtime(process.stderr):
+            if depth == 1:
+                children[name] = seconds
+            elif depth == 0 and name != module:
+                children = {}
+            elif depth == 0:
+                if seconds < best:
+                    best, breakdown = seconds, children
+                break
+    return best, dict(sorted(breakdown.items(), key=lambda item: item[1], reverse=True))
+
+
+def check_startup(commands: list[str], scale: float = 1.0) -> bool:
+    """
+    Print the import time of each command's script against its budget.
+
+    :param commands: The commands to measure.
+    :type commands: list[str]
+    :param scale: Factor applied to the budgets, for slower machines.
+    :type scale: float
+
+    :return: Whether every command is within its budget.
+    :rtype: bool
+    """
+    within = True
+    print(f"{'command':<12} {'import (s)':>10} {'budget (s)':>10}  largest imports")
+    for command in commands:
+        seconds, breakdown = import_time(COMMANDS[command][0])
+        budget = STARTUP_BUDGETS[command] * scale
+        largest = ", ".join(f"{name} {time:.3f}" for name, time in list(breakdown.items())[:3])
+        flag = "" if seconds <= budget else "  OVER BUDGET"
+        within &= seconds <= budget
+        print(f"{command:<12} {seconds:>10.3f} {budget:>10.3f}  {largest}{flag}")
+    return within
+
+
+def main(argv: list[str] | None = None):
+    commands = "\n".join(f"  {name:<12} {description}" for name, (_, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(
+        prog="kneemorph",
+        description="Runs a kneemorph script.",
+        epilog=f"commands:\n{commands}\n  {'startup':<12} Check the import time of the commands against their budgets",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("command", choices=[*COMMANDS, "startup"], metavar="command", help="Script to run, see below")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments of the script (--help for its own help)")
+    args = parser.parse_args(argv)
+
+    if args.command == "startup":
+        startup_parser = argparse.ArgumentParser(prog="kneemorph startup", description="Checks the import time of the commands.")
+        startup_parser.add_argument("commands", nargs="*", help="Commands to measure (default: all)")
+        startup_parser.add_argument("--scale", type=float, default=1.0, help="Factor applied to the budgets, for slower machines")
+        startup_args = startup_parser.parse_args(args.args)
+        unknown = [command for command in startup_args.commands if command not in COMMANDS]
+        if unknown:
+            startup_parser.error(f"unknown command(s): {', '.join(unknown)}")
+        if not check_startup(startup_args.commands or list(COMMANDS), startup_args.scale):
+            sys.exit(1)
+        return
+
+    module, _ = COMMANDS[args.command]
+    sys.argv = [f"kneemorph {args.command}", *args.args]
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+
+
+if __name__ == "__main__":
+    main()
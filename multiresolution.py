@@ -0,0 +1,91 @@
+import numpy as np
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+from vtkmodules.vtkFiltersCore import vtkQuadricDecimation
+from vtkmodules.vtkFiltersPoints import vtkPointInterpolator, vtkShepardKernel
+
+from utils import numpy_to_array, numpy_to_points
+
+# Number of coarse points blended when carrying a displacement field up to a finer level
+INTERPOLATION_NEIGHBOURS = 8
+
+
+def decimate_mesh(mesh: vtkPolyData, num_points: int) -> vtkPolyData:
+    """
+    Reduce a triangle mesh to approximately num_points points with quadric decimation.
+
+    :param mesh: The mesh to decimate. It is not modified.
+    :type mesh: vtkPolyData
+    :param num_points: Point budget of the decimated mesh.
+    :type num_points: int
+
+    :return: The decimated mesh, or the input mesh if it already fits the budget.
+    :rtype: vtkPolyData
+    """
+    if mesh.GetNumberOfPoints() <= num_points:
+        return mesh
+    decimate = vtkQuadricDecimation()
+    decimate.SetInputData(mesh)
+    decimate.SetTargetReduction(1.0 - num_points / mesh.GetNumberOfPoints())
+    decimate.VolumePreservationOn()
+    decimate.Update()
+    return decimate.GetOutput()
+
+
+def subsample_points(points: np.ndarray, num_points: int, seed: int | None = None) -> np.ndarray:
+    """
+    Random subset of num_points points, for targets without surface triangles.
+    """
+    if points.shape[0] <= num_points:
+        return points
+    rng = np.random.default_rng(seed)
+    return points[np.sort(rng.choice(points.shape[0], num_points, replace=False))]
+
+
+def coarsen(mesh: vtkPolyData, num_points: int, seed: int | None = None) -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    Points (and triangles, if the mesh has them) of a mesh reduced to the point budget of a resolution level.
+
+    :return: The (P, 3) coarse points and the (F, 3) zero-based triangles, or None for point clouds.
+    :rtype: tuple[np.ndarray, np.ndarray | None]
+    """
+    if mesh.GetNumberOfPolys() == 0:
+        return subsample_points(vtk_to_numpy(mesh.GetPoints().GetData()), num_points, seed), None
+    coarse = decimate_mesh(mesh, num_points)
+    points = vtk_to_numpy(coarse.GetPoints().GetData()).copy()
+    triangles = vtk_to_numpy(coarse.GetPolys().GetConnectivityArray()).reshape(-1, 3).copy()
+    return points, triangles
+
+
+def interpolate_displacements(coarse_points: np.ndarray, displacements: np.ndarray, points: np.ndarray) -> np.ndarray:
+    """
+    Carry a displacement field known at coarse points to other points by inverse-distance weighting of the
+    nearest coarse displacements.
+
+    :param coarse_points: (P, 3) points at which the displacements are known.
+    :type coarse_points: np.ndarray
+    :param displacements: (P, 3) displacements of the coarse points.
+    :type displacements: np.ndarray
+    :param points: (M, 3) points at which to evaluate the displacement field.
+    :type points: np.ndarray
+
+    :return: The (M, 3) interpolated displacements.
+    :rtype: np.ndarray
+    """
+    source = vtkPolyData()
+    source.SetPoints(numpy_to_points(np.asarray(coarse_points, dtype=np.float64)))
+    source.GetPointData().AddArray(numpy_to_array(np.asarray(displacements, dtype=np.float64), "Displacement"))
+
+    probe = vtkPolyData()
+    probe.SetPoints(numpy_to_points(np.asarray(points, dtype=np.float64)))
+
+    kernel = vtkShepardKernel()
+    kernel.SetKernelFootprintToNClosest()
+    kernel.SetNumberOfPoints(INTERPOLATION_NEIGHBOURS)
+    kernel.SetPowerParameter(2.0)
+    interpolator = vtkPointInterpolator()
+    interpolator.SetInputData(probe)
+    interpolator.SetSourceData(source)
+    interpolator.SetKernel(kernel)
+    interpolator.Update()
+    return vtk_to_numpy(interpolator.GetOutput().GetPointData().GetArray("Displacement")).copy()
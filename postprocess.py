@@ -1,26 +1,45 @@
 import argparse
+import csv
 import json
+import time
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import TypeVar
 
-import matplotlib.pyplot as plt
 import numpy as np
-import vtkmodules.all as vtk
-from seaborn import boxplot
-from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+from vtkmodules.vtkIOXML import vtkXMLPolyDataReader
 
+import telemetry
 from config import PostValidationConfig
-from utils import read_vtp, save_vtp
+from deformation_stack import is_stack, open_stack, read_names
+from streaming import bounded_map
+from utils import numpy_to_cells, numpy_to_polydata, read_vtp, save_vtp
 
+T = TypeVar("T")
+# A mesh file, or the directory of a deformation stack and the name of one of its meshes
+MeshSource = Path | tuple[Path, str]
 
-def read_mesh(file_path: Path) -> vtk.vtkPolyData:
+# Number of mesh pairs evaluated by a worker process per task
+PAIRS_PER_TASK = 16
+# Columns of surface_errors.csv after the mesh name, in the order of SurfaceMetrics.meshes
+SURFACE_COLUMNS = ["Mean", "RMS", "Hausdorff", "Within Tolerance (%)"]
+
+
+def read_mesh(file_path: Path) -> vtkPolyData:
     assert file_path.suffix == (".vtp"), "Only VTK XML polydata (.vtp) files are supported"
-    reader = vtk.vtkXMLPolyDataReader()
+    reader = vtkXMLPolyDataReader()
     reader.SetFileName(file_path.as_posix())
     reader.Update()
     return reader.GetOutput()
 
 
-def _get_insertion_lut(mesh: vtk.vtkPolyData) -> dict[int, np.ndarray]:
+def _get_insertion_lut(mesh: vtkPolyData) -> dict[int, np.ndarray]:
     insertion_ids = mesh.GetPointData().GetArray("InsertionID")
     insertion_ids = vtk_to_numpy(insertion_ids)
     unique_ids = sorted(list(np.unique(insertion_ids)))
@@ -30,99 +49,498 @@ def _get_insertion_lut(mesh: vtk.vtkPolyData) -> dict[int, np.ndarray]:
     return insertion_lut
 
 
+def _get_points(mesh: vtkPolyData) -> np.ndarray:
+    return vtk_to_numpy(mesh.GetPoints().GetData())
+
+
+def _get_triangles(mesh: vtkPolyData) -> np.ndarray:
+    return vtk_to_numpy(mesh.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+
+
+def _get_source_name(source: MeshSource) -> str:
+    return source[1] if isinstance(source, tuple) else source.stem
+
+
+def _read_points(source: MeshSource) -> np.ndarray:
+    """
+    Points of a mesh file, or of a row of a deformation stack without parsing any XML.
+    """
+    if isinstance(source, tuple):
+        directory, name = source
+        return open_stack(directory).get_points(name)
+    return _get_points(read_vtp(source))
+
+
+def _read_mesh_source(source: MeshSource) -> vtkPolyData:
+    if isinstance(source, tuple):
+        directory, name = source
+        return open_stack(directory).get_mesh(name)
+    return read_vtp(source)
+
+
 def _get_displacement_error(
-    truth_mesh: vtk.vtkPolyData, result_mesh: vtk.vtkPolyData, insertion_lut: dict[int, np.ndarray]
+    truth_points: np.ndarray, result_points: np.ndarray, insertion_lut: dict[int, np.ndarray]
 ) -> dict[int, np.ndarray]:
-    truth_points = vtk_to_numpy(truth_mesh.GetPoints().GetData())
-    result_points = vtk_to_numpy(result_mesh.GetPoints().GetData())
     errors = {}
     for ligament_id, node_ids in insertion_lut.items():
         errors[ligament_id] = np.linalg.norm(truth_points[node_ids] - result_points[node_ids], axis=1).reshape(1, -1)
     return errors
 
 
-def _get_pointwise_stats(errors: dict[int, np.ndarray]):
-    pointwise_stats = []
-    for ligament_id, error in errors.items():
-        pointwise_stats.append(
-            [ligament_id, np.mean(error, axis=0), np.std(error, axis=0), np.std(error, axis=0) / np.sqrt(error.shape[0]) * 1.96]
-        )
-    return pointwise_stats
+class ErrorAccumulator:
+    """
+    Running per-node mean and variance of the insertion errors over the validation meshes (Welford's
+    algorithm). Accumulators of disjoint sets of meshes are combined with merge (Chan et al.), so the
+    meshes can be evaluated in parallel and never need to be held in memory together.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean: dict[int, np.ndarray] = {}
+        self.m2: dict[int, np.ndarray] = {}
+
+    def update(self, errors: dict[int, np.ndarray]):
+        """
+        Add the errors of one mesh, as returned by _get_displacement_error.
+        """
+        self.count += 1
+        for ligament_id, error in errors.items():
+            error = error.ravel().astype(np.float64)
+            if ligament_id not in self.mean:
+                self.mean[ligament_id] = np.zeros_like(error)
+                self.m2[ligament_id] = np.zeros_like(error)
+            delta = error - self.mean[ligament_id]
+            self.mean[ligament_id] += delta / self.count
+            self.m2[ligament_id] += delta * (error - self.mean[ligament_id])
+
+    def merge(self, other: "ErrorAccumulator"):
+        """
+        Add the meshes accumulated by another accumulator.
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.mean = {key: value.copy() for key, value in other.mean.items()}
+            self.m2 = {key: value.copy() for key, value in other.m2.items()}
+            return
+        count = self.count + other.count
+        for ligament_id in other.mean:
+            delta = other.mean[ligament_id] - self.mean[ligament_id]
+            self.mean[ligament_id] = self.mean[ligament_id] + delta * (other.count / count)
+            self.m2[ligament_id] = self.m2[ligament_id] + other.m2[ligament_id] + delta**2 * (self.count * other.count / count)
+        self.count = count
+
+    def pointwise_stats(self) -> list[list]:
+        """
+        Per-node mean, standard deviation and 95% confidence interval half-width over the meshes, per ligament.
+        """
+        pointwise_stats = []
+        for ligament_id, mean in self.mean.items():
+            std = np.sqrt(self.m2[ligament_id] / self.count)
+            pointwise_stats.append([ligament_id, mean, std, std / np.sqrt(self.count) * 1.96])
+        return pointwise_stats
+
+    def aggregate_stats(self) -> list[list]:
+        """
+        Mean, standard deviation and 95% confidence interval half-width of the errors of all nodes of each ligament.
+        Every node has one error per mesh, so the overall variance is the mean of the node variances plus the
+        variance of the node means.
+        """
+        aggregate_stats = []
+        for ligament_id, mean in self.mean.items():
+            aggregate_mean = mean.mean()
+            std = np.sqrt(np.mean(self.m2[ligament_id] / self.count + (mean - aggregate_mean) ** 2))
+            aggregate_stats.append([ligament_id, aggregate_mean, std, std / np.sqrt(self.count) * 1.96])
+        return aggregate_stats
+
+
+def get_surface_distances(truth_points: np.ndarray, result_points: np.ndarray, triangles: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Distances from every node of a result mesh to the ground truth surface, and from every node of the ground truth
+    mesh to the result surface. Both meshes have the template's triangles, and all the nodes of a mesh are projected
+    onto the other surface at once (see projection.project_to_surface).
+
+    :param truth_points: (M, 3) ground truth points.
+    :type truth_points: np.ndarray
+    :param result_points: (M, 3) result points.
+    :type result_points: np.ndarray
+    :param triangles: (F, 3) triangles of the template.
+    :type triangles: np.ndarray
+
+    :return: The (M,) distances of the result nodes and the (M,) distances of the ground truth nodes.
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    # Imported here, as SciPy takes longer to import than the rest of the script
+    from projection import project_to_surface
+
+    truth_points, result_points = np.asarray(truth_points, dtype=np.float64), np.asarray(result_points, dtype=np.float64)
+    _, _, result_distances = project_to_surface(truth_points, triangles, result_points)
+    _, _, truth_distances = project_to_surface(result_points, triangles, truth_points)
+    return result_distances, truth_distances
+
+
+class SurfaceMetrics:
+    """
+    Distances between the whole surfaces of result and ground truth meshes: running per-node statistics of the
+    distances from the result nodes to the ground truth surface (an ErrorAccumulator with the single key 0), and
+    the summary of each mesh. Metrics of disjoint sets of meshes are combined with merge.
+
+    The mean, RMS and share of nodes within tolerance of a mesh are taken over the distances of its result nodes.
+    The Hausdorff distance is symmetric, the larger of the farthest result node from the ground truth surface and
+    the farthest ground truth node from the result surface.
+    """
+
+    def __init__(self, tolerance: float):
+        self.tolerance = tolerance
+        self.nodes = ErrorAccumulator()
+        self.meshes: dict[str, list[float]] = {}
+
+    def update(self, name: str, result_distances: np.ndarray, truth_distances: np.ndarray):
+        """
+        Add the distances of one mesh, as returned by get_surface_distances.
+        """
+        self.nodes.update({0: result_distances})
+        self.meshes[name] = [
+            float(result_distances.mean()),
+            float(np.sqrt(np.mean(result_distances**2))),
+            float(max(result_distances.max(), truth_distances.max())),
+            float(100 * np.mean(result_distances <= self.tolerance)),
+        ]
+
+    def merge(self, other: "SurfaceMetrics"):
+        self.nodes.merge(other.nodes)
+        self.meshes |= other.meshes
+
+    def pointwise_stats(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Per-node mean distance over the meshes and its upper 95% confidence bound.
+        """
+        _, mean, _, std_err = self.nodes.pointwise_stats()[0]
+        return mean, mean + std_err
+
+    def summary(self) -> dict[str, float]:
+        """
+        The metrics over all meshes: the mean and RMS distance of all result nodes, the largest Hausdorff distance
+        and the share of all result nodes within tolerance. Every mesh has the same number of nodes.
+        """
+        values = np.array(list(self.meshes.values()))
+        return {
+            "mean": float(values[:, 0].mean()),
+            "rms": float(np.sqrt(np.mean(values[:, 1] ** 2))),
+            "hausdorff": float(values[:, 2].max()),
+            "within_tolerance": float(values[:, 3].mean()),
+        }
+
+
+class ErrorStore:
+    """
+    The errors of every mesh, kept for the box plot, which needs their quantiles. With a directory they are
+    written to .npy files there instead of being held in memory.
+    """
+
+    def __init__(self, insertion_lut: dict[int, np.ndarray], num_meshes: int, directory: Path | None = None):
+        self.errors = {}
+        for ligament_id, node_ids in insertion_lut.items():
+            shape = (num_meshes, node_ids.size)
+            if directory is None:
+                self.errors[ligament_id] = np.empty(shape, dtype=np.float32)
+            else:
+                filepath = directory.joinpath(f"errors_{ligament_id}.npy")
+                self.errors[ligament_id] = np.lib.format.open_memmap(filepath, mode="w+", dtype=np.float32, shape=shape)
+
+    def write(self, start: int, errors: dict[int, np.ndarray]):
+        """
+        Store the errors of consecutive meshes, starting with mesh index start.
+        """
+        for ligament_id, error in errors.items():
+            self.errors[ligament_id][start : start + error.shape[0]] = error
+
+    def close(self):
+        # Releases the memory maps, so that their files can be removed
+        self.errors = {}
 
 
-def _get_aggregate_stats(errors: dict[int, np.ndarray]):
-    aggregate_stats = []
-    for ligament_id, error in errors.items():
-        flattened_error = error.ravel()
-        aggregate_stats.append(
-            [ligament_id, np.mean(flattened_error), np.std(flattened_error), np.std(flattened_error) / np.sqrt(error.shape[0]) * 1.96]
-        )
-    return aggregate_stats
+def visualize_error(
+    mesh: vtkPolyData, summary_stats: list[list[np.ndarray]], surface_stats: tuple[np.ndarray, np.ndarray] | None = None
+) -> vtkPolyData:
+    """
+    Point cloud of the insertion nodes of the template with the mean error and its upper confidence bound. With
+    surface statistics, the whole template instead, its insertion nodes also given as vertices, with the surface
+    distance arrays at every node and the insertion error arrays at the insertion nodes (NaN elsewhere).
 
+    :param mesh: The template mesh, with its InsertionID array.
+    :type mesh: vtkPolyData
+    :param summary_stats: [insertion ID, mean, standard deviation, confidence interval half-width] per ligament,
+        from ErrorAccumulator.pointwise_stats.
+    :type summary_stats: list[list[np.ndarray]]
+    :param surface_stats: Per-node mean surface distance and its upper confidence bound, from
+        SurfaceMetrics.pointwise_stats.
+    :type surface_stats: tuple[np.ndarray, np.ndarray] | None
 
-def visualize_error(mesh: vtk.vtkPolyData, summary_stats: list[list[np.ndarray]]) -> vtk.vtkPolyData:
+    :return: The point cloud, or the template mesh.
+    :rtype: vtkPolyData
+    """
     points = vtk_to_numpy(mesh.GetPoints().GetData())
-    point_ids = mesh.GetPointData().GetArray("InsertionID")
-    appended_polydata = vtk.vtkAppendPolyData()
-    for stat in summary_stats:
-        id, mean, _, std_err = stat
-        coords = points[point_ids == id]
-        id_array = numpy_to_vtk(np.full(coords.shape[0], id, dtype=int), deep=True, array_type=vtk.VTK_ID_TYPE)
-        id_array.SetName("InsertionID")
-        mean_array = numpy_to_vtk(mean, deep=True, array_type=vtk.VTK_FLOAT)
-        mean_array.SetName("Mean")
-        ci_array = numpy_to_vtk(mean + std_err, deep=True, array_type=vtk.VTK_FLOAT)
-        ci_array.SetName("Upper Confidence Interval Bound")
-        poly = vtk.vtkPolyData()
-        poly_points = vtk.vtkPoints()
-        poly_cells = vtk.vtkCellArray()
-        for i in range(coords.shape[0]):
-            poly_points.InsertNextPoint(coords[i])
-            poly_cells.InsertNextCell(1, [i])
-        poly.SetPoints(poly_points)
-        poly.SetVerts(poly_cells)
-        poly.GetPointData().AddArray(id_array)
-        poly.GetPointData().AddArray(mean_array)
-        poly.GetPointData().AddArray(ci_array)
-        appended_polydata.AddInputData(poly)
-    appended_polydata.Update()
-
-    return appended_polydata.GetOutput()
+    insertion_ids = vtk_to_numpy(mesh.GetPointData().GetArray("InsertionID"))
+    node_ids = [np.flatnonzero(insertion_ids == id) for id, *_ in summary_stats]
+    ids = np.concatenate([np.full(nodes.size, id) for nodes, (id, *_) in zip(node_ids, summary_stats)])
+    means = np.concatenate([mean for _, mean, _, _ in summary_stats]).astype(np.float32)
+    upper = np.concatenate([mean + std_err for _, mean, _, std_err in summary_stats]).astype(np.float32)
+    point_data = {"InsertionID": ids, "Mean": means, "Upper Confidence Interval Bound": upper}
+    if surface_stats is None:
+        return numpy_to_polydata(points[np.concatenate(node_ids)], verts=True, point_data=point_data)
+    nodes = np.concatenate(node_ids)
+    point_data["InsertionID"] = insertion_ids
+    for name in ("Mean", "Upper Confidence Interval Bound"):
+        values = np.full(points.shape[0], np.nan, dtype=np.float32)
+        values[nodes] = point_data[name]
+        point_data[name] = values
+    point_data["Surface Distance Mean"] = surface_stats[0].astype(np.float32)
+    point_data["Surface Distance Upper Confidence Interval Bound"] = surface_stats[1].astype(np.float32)
+    poly = numpy_to_polydata(points, triangles=_get_triangles(mesh), point_data=point_data)
+    poly.SetVerts(numpy_to_cells(nodes.reshape(-1, 1)))
+    return poly
+
+
+def match_pairs(truth: dict[str, T], results: dict[str, T]) -> list[tuple[T, T]]:
+    """
+    Match each ground truth mesh with the result mesh registered to it, named mapped_<ground truth name> by
+    register_gbcpd.py (or named as the ground truth mesh). Other results are ignored.
+
+    :param truth: Ground truth meshes (or paths) by name.
+    :type truth: dict[str, T]
+    :param results: Result meshes (or paths) by name.
+    :type results: dict[str, T]
+
+    :return: (ground truth, result) pairs, sorted by ground truth name.
+    :rtype: list[tuple[T, T]]
+    """
+    mesh_pairs = []
+    missing = []
+    for name in sorted(truth):
+        result = results.get(f"mapped_{name}", results.get(name))
+        if result is None:
+            missing.append(name)
+        else:
+            mesh_pairs.append((truth[name], result))
+    if missing:
+        raise KeyError(f"No result mesh for ground truth mesh(es): {', '.join(missing)}")
+    return mesh_pairs
+
+
+def _get_mesh_sources(path: Path) -> dict[str, MeshSource]:
+    if is_stack(path):
+        return {name: (path, name) for name in read_names(path)}
+    return {filepath.stem: filepath for filepath in path.glob("*.vtp")}
+
+
+def get_mesh_pairs(ground_truth_path: Path, result_path: Path) -> list[tuple[MeshSource, MeshSource]]:
+    return match_pairs(_get_mesh_sources(ground_truth_path), _get_mesh_sources(result_path))
+
+
+def accumulate_errors(
+    point_pairs: Iterable[tuple[np.ndarray, np.ndarray]], insertion_lut: dict[int, np.ndarray]
+) -> tuple[ErrorAccumulator, dict[int, np.ndarray]]:
+    """
+    Accumulate the displacement errors of the insertion nodes of each result mesh relative to its ground truth mesh.
+
+    :param point_pairs: (ground truth points, result points) pairs.
+    :type point_pairs: Iterable[tuple[np.ndarray, np.ndarray]]
+    :param insertion_lut: A dictionary mapping insertion IDs to node IDs, from _get_insertion_lut.
+    :type insertion_lut: dict[int, np.ndarray]
+
+    :return: The accumulated statistics, and a dictionary mapping insertion IDs to the (number of meshes, number of
+        insertion nodes) errors.
+    :rtype: tuple[ErrorAccumulator, dict[int, np.ndarray]]
+    """
+    accumulator = ErrorAccumulator()
+    all_displacement_errors = {ligament_id: [] for ligament_id in insertion_lut}
+    for truth_points, result_points in point_pairs:
+        displacement_errors = _get_displacement_error(truth_points, result_points, insertion_lut)
+        accumulator.update(displacement_errors)
+        for ligament_id, error in displacement_errors.items():
+            all_displacement_errors[ligament_id].append(error)
+    return accumulator, {key: np.concatenate(value, axis=0) for key, value in all_displacement_errors.items()}
+
+
+def evaluate_meshes(
+    truth_meshes: dict[str, vtkPolyData], result_meshes: dict[str, vtkPolyData]
+) -> tuple[ErrorAccumulator, ErrorStore]:
+    """
+    Evaluate result meshes held in memory against their ground truth meshes, matched by name as in match_pairs.
+
+    :return: The accumulated statistics and the errors of every mesh.
+    :rtype: tuple[ErrorAccumulator, ErrorStore]
+    """
+    mesh_pairs = match_pairs(truth_meshes, result_meshes)
+    assert mesh_pairs, "No ground truth meshes"
+    insertion_lut = _get_insertion_lut(mesh_pairs[0][0])
+    point_pairs = ((_get_points(truth_mesh), _get_points(result_mesh)) for truth_mesh, result_mesh in mesh_pairs)
+    accumulator, errors = accumulate_errors(point_pairs, insertion_lut)
+    store = ErrorStore(insertion_lut, len(mesh_pairs))
+    store.write(0, errors)
+    return accumulator, store
+
+
+def evaluate_surfaces(
+    truth_meshes: dict[str, vtkPolyData], result_meshes: dict[str, vtkPolyData], triangles: np.ndarray, tolerance: float, jobs: int = 1
+) -> SurfaceMetrics:
+    """
+    Surface distances of result meshes held in memory from their ground truth meshes, matched by name as in
+    match_pairs, with jobs mesh pairs measured at a time in threads.
+
+    :return: The surface metrics.
+    :rtype: SurfaceMetrics
+    """
+    names = sorted(truth_meshes)
+    point_pairs = [(_get_points(truth_mesh), _get_points(result_mesh)) for truth_mesh, result_mesh in match_pairs(truth_meshes, result_meshes)]
+    surface = SurfaceMetrics(tolerance)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        distances = executor.map(lambda pair: get_surface_distances(*pair, triangles), point_pairs)
+        for name, (result_distances, truth_distances) in zip(names, distances):
+            surface.update(name, result_distances, truth_distances)
+    return surface
+
+
+def _accumulate_mesh_files(
+    mesh_pairs: list[tuple[MeshSource, MeshSource]],
+    insertion_lut: dict[int, np.ndarray],
+    triangles: np.ndarray | None = None,
+    tolerance: float = 1.0,
+) -> tuple[ErrorAccumulator, dict[int, np.ndarray], SurfaceMetrics | None, dict[str, float]]:
+    # Timed here, as worker processes do not record telemetry themselves
+    start = time.perf_counter()
+    point_pairs = [(_read_points(truth), _read_points(result)) for truth, result in mesh_pairs]
+    read_time = time.perf_counter()
+    accumulator, errors = accumulate_errors(point_pairs, insertion_lut)
+    timings = {"read": read_time - start, "errors": time.perf_counter() - read_time}
+    surface = None
+    if triangles is not None:
+        surface_time = time.perf_counter()
+        surface = SurfaceMetrics(tolerance)
+        for (truth, _), (truth_points, result_points) in zip(mesh_pairs, point_pairs):
+            surface.update(_get_source_name(truth), *get_surface_distances(truth_points, result_points, triangles))
+        timings["surface"] = time.perf_counter() - surface_time
+    return accumulator, errors, surface, timings
+
+
+def evaluate_mesh_files(
+    mesh_pairs: list[tuple[MeshSource, MeshSource]],
+    insertion_lut: dict[int, np.ndarray],
+    store: ErrorStore,
+    jobs: int = 1,
+    triangles: np.ndarray | None = None,
+    tolerance: float = 1.0,
+) -> tuple[ErrorAccumulator, SurfaceMetrics | None]:
+    """
+    Accumulate the errors of the mesh pairs in tasks of PAIRS_PER_TASK pairs, run by jobs worker processes.
+    Partial results are merged in order, and only the tasks in flight hold meshes in memory. With the template's
+    triangles, the surface distances of every pair are measured in the same tasks.
+
+    :param mesh_pairs: (ground truth mesh, result mesh) pairs, each a mesh file or a row of a deformation stack.
+    :type mesh_pairs: list[tuple[MeshSource, MeshSource]]
+    :param insertion_lut: A dictionary mapping insertion IDs to node IDs, from _get_insertion_lut.
+    :type insertion_lut: dict[int, np.ndarray]
+    :param store: Receives the errors of every mesh.
+    :type store: ErrorStore
+    :param jobs: Number of worker processes (if 1, the pairs are read in this process).
+    :type jobs: int
+    :param triangles: (F, 3) triangles of the template (if None the surface distances are not measured).
+    :type triangles: np.ndarray | None
+    :param tolerance: Surface distance within which a node counts as matching the ground truth surface.
+    :type tolerance: float
+
+    :return: The accumulated statistics, and the surface metrics if they were measured.
+    :rtype: tuple[ErrorAccumulator, SurfaceMetrics | None]
+    """
+    starts = range(0, len(mesh_pairs), PAIRS_PER_TASK)
+    tasks = (mesh_pairs[start : start + PAIRS_PER_TASK] for start in starts)
+    accumulate = partial(_accumulate_mesh_files, insertion_lut=insertion_lut, triangles=triangles, tolerance=tolerance)
+    accumulator = ErrorAccumulator()
+    surface = SurfaceMetrics(tolerance) if triangles is not None else None
+    with ExitStack() as stack:
+        if jobs > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=jobs))
+            results = bounded_map(executor, accumulate, tasks, backlog=2 * jobs)
+        else:
+            results = map(accumulate, tasks)
+        for start, (partial_accumulator, errors, partial_surface, timings) in zip(starts, results):
+            accumulator.merge(partial_accumulator)
+            store.write(start, errors)
+            if surface is not None:
+                surface.merge(partial_surface)
+            for stage, seconds in timings.items():
+                telemetry.add_span(stage, seconds, start=start, pairs=partial_accumulator.count)
+    return accumulator, surface
+
+
+def save_box_plot(store: ErrorStore, filepath: Path):
+    """
+    Box plot of the errors of each ligament over all meshes, as seaborn draws it from the stored errors.
+    """
+    # Imported here, as matplotlib and seaborn take longer to import than the rest of the script
+    import matplotlib.pyplot as plt
+    from seaborn import boxplot
+
+    flattened_errors = {key: np.asarray(errors).ravel() for key, errors in store.errors.items()}
+    boxplot(data=flattened_errors, showfliers=False)
+    plt.savefig(filepath)
+    plt.close()
+
+
+def save_surface_errors(surface: SurfaceMetrics, filepath: Path):
+    """
+    The surface metrics of each mesh, and over all meshes in a last row named "all".
+    """
+    with open(filepath, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Mesh", *SURFACE_COLUMNS])
+        for name, values in sorted(surface.meshes.items()):
+            writer.writerow([name, *(f"{value:.6g}" for value in values)])
+        writer.writerow(["all", *(f"{value:.6g}" for value in surface.summary().values())])
+
+
+def save_statistics(
+    template_mesh: vtkPolyData,
+    accumulator: ErrorAccumulator,
+    store: ErrorStore,
+    output_dir: Path,
+    plot: bool = True,
+    surface: SurfaceMetrics | None = None,
+):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with telemetry.span("stats"):
+        pointwise_stats = accumulator.pointwise_stats()
+        aggregate_stats = accumulator.aggregate_stats()
+        surface_stats = surface.pointwise_stats() if surface is not None else None
+    with telemetry.span("write"):
+        np.savetxt(str(output_dir / "displacement_errors.csv"), aggregate_stats, delimiter=",", header="ID, Mean, STD, CI Upper Bound")
+        stats_polydata = visualize_error(template_mesh, pointwise_stats, surface_stats)
+        save_vtp(stats_polydata, output_dir / "error_visualization.vtp")
+        if surface is not None:
+            save_surface_errors(surface, output_dir / "surface_errors.csv")
+    if surface is not None:
+        telemetry.record("surface", tolerance=surface.tolerance, **{key: round(value, 6) for key, value in surface.summary().items()})
+    if plot:
+        with telemetry.span("plot"):
+            save_box_plot(store, output_dir / "error_boxplot.svg")
 
 
 def main(config: PostValidationConfig):
     output_dir = Path(config.output_dir)
-    template_mesh_path = Path(config.template_mesh_file)
-    ground_truth_path = Path(config.ground_truth_path)
-    result_path = Path(config.result_path)
     output_dir.mkdir(parents=True, exist_ok=True)
-    truth_mesh_paths = sorted(list(ground_truth_path.glob("*.vtp")))
-    result_mesh_paths = sorted(list(result_path.glob("*.vtp")))
-    assert len(truth_mesh_paths) == len(result_mesh_paths), "Number of ground truth and result meshes must match"
-    all_displacement_errors = {}
-    for i, (truth_mesh_path, result_mesh_path) in enumerate(zip(truth_mesh_paths, result_mesh_paths)):
-        truth_mesh = read_vtp(truth_mesh_path)
-        result_mesh = read_vtp(result_mesh_path)
-        if i == 0:
-            insertion_lut = _get_insertion_lut(truth_mesh)
-        displacement_errors = _get_displacement_error(truth_mesh, result_mesh, insertion_lut)  # pyright: ignore[reportPossiblyUnboundVariable]
-        for key, value in displacement_errors.items():
-            try:
-                all_displacement_errors[key].append(value)
-            except KeyError:
-                all_displacement_errors[key] = [value]
-    all_displacement_errors = {key: np.concatenate(value, axis=0) for key, value in all_displacement_errors.items()}
-    pointwise_stats = _get_pointwise_stats(all_displacement_errors)
-    aggregate_stats = _get_aggregate_stats(all_displacement_errors)
-    np.savetxt(str(output_dir / "displacement_errors.csv"), aggregate_stats, delimiter=",", header="ID, Mean, STD, CI Upper Bound")
-    template_mesh = read_vtp(template_mesh_path)
-    stats_polydata = visualize_error(template_mesh, pointwise_stats)
-    save_vtp(stats_polydata, output_dir / "error_visualization.vtp")
-
-    flattened_errors = {key: value.ravel() for key, value in all_displacement_errors.items()}
-
-    boxplot(data=flattened_errors, showfliers=False)
-    plt.savefig(output_dir / "error_boxplot.svg")
+    mesh_pairs = get_mesh_pairs(Path(config.ground_truth_path), Path(config.result_path))
+    assert mesh_pairs, f"No ground truth meshes found in {config.ground_truth_path}"
+    insertion_lut = _get_insertion_lut(_read_mesh_source(mesh_pairs[0][0]))
+    template_mesh = read_vtp(config.template_mesh_file)
+    triangles = _get_triangles(template_mesh) if config.surface_metrics else None
+    # The per-mesh errors are spilled next to the outputs rather than to a (possibly in-memory) temporary directory
+    with TemporaryDirectory(prefix="errors_", dir=output_dir) as errors_dir:
+        store = ErrorStore(insertion_lut, len(mesh_pairs), Path(errors_dir))
+        accumulator, surface = evaluate_mesh_files(mesh_pairs, insertion_lut, store, config.jobs, triangles, config.surface_tolerance)
+        save_statistics(template_mesh, accumulator, store, output_dir, config.plot, surface)
+        store.close()
 
 
 if __name__ == "__main__":
@@ -131,4 +549,5 @@ if __name__ == "__main__":
     args = parser.parse_args()
     with open(args.config, "r") as f:
         config = PostValidationConfig(**json.load(f))
-    main(config)
+    with telemetry.session(config.telemetry_log, "postprocess", config.profile):
+        main(config)
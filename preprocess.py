@@ -4,116 +4,204 @@ from pathlib import Path
 from typing import Literal
 
 import numpy as np
-import vtkmodules.all as vtk
-from vtkmodules.util.numpy_support import numpy_to_vtk
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+from vtkmodules.vtkFiltersModeling import vtkLoopSubdivisionFilter
 
+import telemetry
 from config import PreprocessConfig
-from utils import read_stl, read_vtp, save_json, save_vtp
+from projection import assign_nearest, geodesic_neighbourhoods, nearest_nodes, project_to_surface
+from refinement import adaptive_subdivision, uniform_point_count
+from utils import numpy_to_array, numpy_to_polydata, read_stl, read_vtp, save_json, save_vtp, transform_mesh
 
+# Field data array of an adaptively refined mesh, holding the number of points uniform subdivision would have given
+UNIFORM_POINTS_ARRAY = "UniformPoints"
 
-def refine_mesh(poly: vtk.vtkPolyData, subdivisions: int) -> vtk.vtkPolyData:
-    refine = vtk.vtkLoopSubdivisionFilter()
+
+def refine_mesh(poly: vtkPolyData, subdivisions: int) -> vtkPolyData:
+    refine = vtkLoopSubdivisionFilter()
     refine.SetInputData(poly)
     refine.SetNumberOfSubdivisions(subdivisions)
     refine.Update()
     return refine.GetOutput()
 
 
-def get_mirror_transform(axis: Literal["x", "y", "z"]) -> vtk.vtkTransform:
-    mirror = vtk.vtkTransform()
-    mirror.Scale(-1 if axis == "x" else 1, -1 if axis == "y" else 1, -1 if axis == "z" else 1)
-    return mirror
+def get_triangles(poly: vtkPolyData) -> np.ndarray:
+    return vtk_to_numpy(poly.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+
+
+def refine_mesh_adaptive(
+    poly: vtkPolyData,
+    subdivisions: int,
+    probes: np.ndarray,
+    radius: float,
+    distance: Literal["euclidean", "geodesic"] = "euclidean",
+) -> vtkPolyData:
+    """
+    Subdivide only the triangles within a radius of the probes, keeping the mesh conforming (see refinement.py).
+    The point data of the mesh is not carried over.
+
+    :param poly: The triangle mesh.
+    :type poly: vtkPolyData
+    :param subdivisions: Number of subdivision levels near the probes.
+    :type subdivisions: int
+    :param probes: (N, 3) probe points, e.g. the ligament insertion points.
+    :type probes: np.ndarray
+    :param radius: Radius around the probes, in mesh units.
+    :type radius: float
+    :param distance: "euclidean" or "geodesic" (along mesh edges) distance from the probes.
+    :type distance: Literal["euclidean", "geodesic"]
+
+    :return: The refined mesh.
+    :rtype: vtkPolyData
+    """
+    points = vtk_to_numpy(poly.GetPoints().GetData())
+    refined_points, triangles = adaptive_subdivision(points, get_triangles(poly), probes, subdivisions, radius, distance)
+    return numpy_to_polydata(refined_points.astype(points.dtype), triangles=triangles)
+
 
+def count_uniform_points(poly: vtkPolyData, subdivisions: int) -> int:
+    """
+    Number of points of the mesh after uniform subdivision, the budget adaptive refinement is compared with.
+    """
+    return uniform_point_count(poly.GetNumberOfPoints(), get_triangles(poly), subdivisions)
 
-def get_center_transform(poly: vtk.vtkPolyData) -> vtk.vtkTransform:
-    center = vtk.vtkCenterOfMass()
-    center.SetInputData(poly)
-    center.Update()
-    center_point = center.GetCenter()
-    translate = vtk.vtkTransform()
-    translate.Translate(-center_point[0], -center_point[1], -center_point[2])
-    return translate
 
+def get_uniform_points(poly: vtkPolyData) -> int | None:
+    """
+    Point count of uniform subdivision recorded on an adaptively refined mesh, or None if it was not refined adaptively.
+    """
+    array = poly.GetFieldData().GetArray(UNIFORM_POINTS_ARRAY)
+    return None if array is None else int(array.GetValue(0))
 
-def apply_transform(poly: vtk.vtkPolyData, transform: vtk.vtkTransform) -> vtk.vtkPolyData:
-    transform_filter = vtk.vtkTransformPolyDataFilter()
-    transform_filter.SetInputData(poly)
-    transform_filter.SetTransform(transform)
-    transform_filter.Update()
-    return transform_filter.GetOutput()
 
+def get_mirror_matrix(axis: Literal["x", "y", "z"]) -> np.ndarray:
+    return np.diag([-1.0 if axis == "x" else 1.0, -1.0 if axis == "y" else 1.0, -1.0 if axis == "z" else 1.0, 1.0])
 
-def save_transform(transform: vtk.vtkTransform, filename: Path):
-    tx_mat = transform.GetMatrix()
-    tx_numpy = np.zeros((4, 4), dtype=np.float64)
-    for i in range(4):
-        for j in range(4):
-            tx_numpy[i, j] = tx_mat.GetElement(i, j)
-    np.save(filename, tx_numpy)
 
+def get_center_matrix(poly: vtkPolyData) -> np.ndarray:
+    """
+    Translation taking the centroid of the mesh's points (their unweighted mean, as vtkCenterOfMass) to the origin.
+    """
+    matrix = np.eye(4)
+    matrix[:3, 3] = -vtk_to_numpy(poly.GetPoints().GetData()).mean(axis=0, dtype=np.float64)
+    return matrix
 
-def project_points(points: np.ndarray, locator: vtk.vtkStaticPointLocator) -> np.ndarray:
-    point_ids = np.zeros(points.shape[0], dtype=int)
-    for i in range(points.shape[0]):
-        point_ids[i] = locator.FindClosestPoint(list(points[i, :]))
-    return point_ids
 
+def project_points(points: np.ndarray, mesh_points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Nearest mesh node of every point, found in a single batched query.
 
-def define_ligament_insertions(bone_poly: vtk.vtkPolyData, ligament_insertions: dict[str, str]) -> dict[int, str]:
+    :return: The node IDs and the distances of the points from them.
+    :rtype: tuple[np.ndarray, np.ndarray]
     """
-    Define ligament insertions on the bone polydata by projecting points specified in text files.
+    distances, point_ids = nearest_nodes(mesh_points, points)
+    return point_ids[:, 0], distances[:, 0]
+
+
+def read_insertions(filepath: Path | str) -> np.ndarray:
+    return np.genfromtxt(Path(filepath).as_posix(), delimiter=",", usecols=[1, 2, 3]).reshape(-1, 3)
+
+
+def define_ligament_insertions(
+    bone_poly: vtkPolyData,
+    ligament_insertions: dict[str, str],
+    projection: Literal["node", "surface"] = "node",
+    radius: float = 0.0,
+) -> dict[int, str]:
+    """
+    Define ligament insertions on the bone polydata by projecting points specified in text files. The points of
+    all ligaments are projected at once, and a node claimed by several ligaments goes to the one with the nearest
+    point.
 
     :param bone_poly: The bone polydata.
-    :type bone_poly: vtk.vtkPolyData
+    :type bone_poly: vtkPolyData
     :param ligament_insertions: A dictionary mapping ligament names to text filepaths.
     :type ligament_insertions: dict[str, str]
+    :param projection: "node" assigns each point to its nearest node. "surface" projects each point onto the closest
+        point of the surface and assigns the nodes within the geodesic radius of it.
+    :type projection: Literal["node", "surface"]
+    :param radius: Geodesic radius of the "surface" projection, in mesh units. The node nearest to each projected
+        point is assigned whatever the radius.
+    :type radius: float
 
     :return:
         A dictionary mapping insertion IDs to ligament names. InsertionID array is
         added to the bone_poly inplace.
     :rtype: dict[int, str]
     """
-    locator = vtk.vtkStaticPointLocator()
-    locator.SetDataSet(bone_poly)
-    locator.BuildLocator()
-    insertion_ids = np.zeros(bone_poly.GetNumberOfPoints(), dtype=int)
-    ligament_lut = {}
-    for i, ligament in enumerate(sorted(ligament_insertions.keys())):
-        insertions = np.genfromtxt(Path(ligament_insertions[ligament]).as_posix(), delimiter=",", usecols=[1, 2, 3])
-        point_ids = project_points(insertions, locator)
-        insertion_ids[point_ids] = i + 1
-        ligament_lut[i + 1] = ligament
+    ligament_lut = {i + 1: ligament for i, ligament in enumerate(sorted(ligament_insertions.keys()))}
     if ligament_lut:
-        insertion_id_array = numpy_to_vtk(insertion_ids, deep=True, array_type=vtk.VTK_ID_TYPE)
-        insertion_id_array.SetName("InsertionID")
-        insertion_id_array.SetNumberOfComponents(1)
-        bone_poly.GetPointData().AddArray(insertion_id_array)
+        insertions = [read_insertions(ligament_insertions[ligament]) for ligament in ligament_lut.values()]
+        labels = np.concatenate([np.full(len(points), i) for i, points in zip(ligament_lut, insertions)])
+        insertions = np.concatenate(insertions)
+        mesh_points = vtk_to_numpy(bone_poly.GetPoints().GetData())
+        if projection == "surface":
+            triangles = vtk_to_numpy(bone_poly.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+            surface_points, cell_ids, _ = project_to_surface(mesh_points, triangles, insertions)
+            insertion_ids = geodesic_neighbourhoods(mesh_points, triangles, surface_points, cell_ids, labels, radius)
+        else:
+            point_ids, distances = project_points(insertions, mesh_points)
+            insertion_ids = assign_nearest(bone_poly.GetNumberOfPoints(), point_ids, labels, distances)
+        bone_poly.GetPointData().AddArray(numpy_to_array(insertion_ids, "InsertionID"))
     return ligament_lut
 
 
-def main(config: PreprocessConfig):
-    output_dir = Path(config.output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    if Path(config.bone).suffix == ".stl":
-        bone_poly = read_stl(Path(config.bone))
-    elif Path(config.bone).suffix == ".vtp":
-        bone_poly = read_vtp(Path(config.bone))
+def read_bone(filepath: Path | str) -> vtkPolyData:
+    if Path(filepath).suffix == ".stl":
+        return read_stl(Path(filepath))
+    elif Path(filepath).suffix == ".vtp":
+        return read_vtp(Path(filepath))
     else:
-        raise ValueError(f"Unsupported file format: {Path(config.bone).suffix}")
-    if config.subdivisions > 0:
-        bone_poly = refine_mesh(bone_poly, config.subdivisions)
+        raise ValueError(f"Unsupported file format: {Path(filepath).suffix}")
+
+
+def preprocess_bone(bone_poly: vtkPolyData, config: PreprocessConfig) -> tuple[vtkPolyData, np.ndarray, dict[int, str]]:
+    """
+    Refine the bone mesh, assign the ligament insertions and center (and mirror) it. The centering and mirror are
+    composed into one matrix, applied in a single pass over the points: in place on the refined mesh, or to a shallow
+    copy of an unrefined one, whose points stay as they were. Adaptive refinement subdivides the mesh around the
+    insertion points only, and stores the point count of uniform subdivision in the UniformPoints field data of the
+    mesh, so that it is saved with it.
+
+    :param bone_poly: The raw bone mesh.
+    :type bone_poly: vtkPolyData
+    :param config: The preprocessing configuration. Only output_dir is not used.
+    :type config: PreprocessConfig
+
+    :return: The preprocessed mesh, the 4x4 matrix applied to it and the ligament ID lookup table.
+    :rtype: tuple[vtkPolyData, np.ndarray, dict[int, str]]
+    """
+    if config.subdivisions > 0 and config.refinement == "adaptive":
+        if not config.ligament_insertions:
+            raise ValueError("Adaptive refinement needs ligament_insertions to refine around")
+        probes = np.concatenate([read_insertions(path) for path in config.ligament_insertions.values()])
+        uniform_points = count_uniform_points(bone_poly, config.subdivisions)
+        with telemetry.span("refine", subdivisions=config.subdivisions, refinement="adaptive"):
+            bone_poly = refine_mesh_adaptive(bone_poly, config.subdivisions, probes, config.refinement_radius, config.refinement_distance)
+        bone_poly.GetFieldData().AddArray(numpy_to_array(np.array([uniform_points]), UNIFORM_POINTS_ARRAY))
+        telemetry.record("refinement", points=bone_poly.GetNumberOfPoints(), uniform_points=uniform_points)
+    elif config.subdivisions > 0:
+        with telemetry.span("refine", subdivisions=config.subdivisions):
+            bone_poly = refine_mesh(bone_poly, config.subdivisions)
     ligament_lut = {}
     if config.ligament_insertions is not None:
-        ligament_lut = define_ligament_insertions(bone_poly, config.ligament_insertions)
-    transform_list = []
+        with telemetry.span("insertions", ligaments=len(config.ligament_insertions)):
+            ligament_lut = define_ligament_insertions(
+                bone_poly, config.ligament_insertions, config.insertion_projection, config.insertion_radius
+            )
+    # The mesh is centered, then mirrored
+    transform_matrix = get_center_matrix(bone_poly)
     if config.mirror:
-        transform_list.append(get_mirror_transform(config.mirror_axis))
-    transform_list.append(get_center_transform(bone_poly))
-    composite_transform = vtk.vtkTransform()
-    for transform in transform_list:
-        composite_transform.Concatenate(transform)
-    bone_poly = apply_transform(bone_poly, composite_transform)
-    save_transform(composite_transform, output_dir.joinpath("transform.npy"))
+        transform_matrix = get_mirror_matrix(config.mirror_axis) @ transform_matrix
+    with telemetry.span("transform"):
+        bone_poly = transform_mesh(bone_poly, transform_matrix, inplace=config.subdivisions > 0)
+    return bone_poly, transform_matrix, ligament_lut
+
+
+def save_outputs(output_dir: Path, bone_poly: vtkPolyData, transform_matrix: np.ndarray, ligament_lut: dict[int, str]):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    np.save(output_dir.joinpath("transform.npy"), transform_matrix)
 
     # Save the refined mesh with insertion IDs
     save_vtp(bone_poly, output_dir.joinpath("mesh.vtp"))
@@ -122,6 +210,17 @@ def main(config: PreprocessConfig):
         save_json(ligament_lut, output_dir.joinpath("ligament_ids.json"))
 
 
+def main(config: PreprocessConfig):
+    with telemetry.span("read", target=Path(config.bone).stem):
+        bone_poly = read_bone(config.bone)
+    bone_poly, transform_matrix, ligament_lut = preprocess_bone(bone_poly, config)
+    uniform_points = get_uniform_points(bone_poly)
+    if uniform_points is not None:
+        print(f"Adaptive refinement: {bone_poly.GetNumberOfPoints()} points, {uniform_points} with uniform subdivision")
+    with telemetry.span("write", points=bone_poly.GetNumberOfPoints()):
+        save_outputs(Path(config.output_dir), bone_poly, transform_matrix, ligament_lut)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Processes polygon surfaces -- subdivision, mapping insertion points (from text files) to refined mesh, mirroring, and centering."
@@ -132,4 +231,5 @@ if __name__ == "__main__":
     with open(args.config, "r") as f:
         config = PreprocessConfig(**json.load(f))
 
-    main(config)
+    with telemetry.session(config.telemetry_log, "preprocess", config.profile):
+        main(config)
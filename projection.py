@@ -0,0 +1,193 @@
+"""
+Batched projection of probe points (e.g. digitized ligament insertions) onto a triangle mesh.
+
+All probes are projected at once: onto their nearest mesh nodes with a KD-tree, or onto the closest point of the
+surface, from which the nodes within a geodesic
+radius are collected. When several groups of probes claim the same node, the group with the nearest probe
+keeps it.
+"""
+
+import numpy as np
+from scipy.sparse import coo_array
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from geodesic import mesh_graph
+
+# Number of nearest nodes whose incident triangles are searched for the closest surface point
+SURFACE_CANDIDATES = 4
+
+
+def nearest_nodes(points: np.ndarray, probes: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The k nearest points of every probe, from a single KD-tree query.
+
+    :param points: (M, 3) mesh points.
+    :type points: np.ndarray
+    :param probes: (N, 3) probe points.
+    :type probes: np.ndarray
+    :param k: Number of neighbours.
+    :type k: int
+
+    :return: The (N, k) distances and indices of the nearest points, nearest first.
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    k = min(k, points.shape[0])
+    distances, indices = cKDTree(points).query(probes, k=k)
+    return distances.reshape(-1, k), indices.reshape(-1, k)
+
+
+def incident_triangles(triangles: np.ndarray, num_points: int) -> np.ndarray:
+    """
+    (M, V) table of the triangles incident to each node, padded with -1, where V is the largest valence.
+    """
+    nodes = triangles.ravel()
+    order = np.argsort(nodes, kind="stable")
+    counts = np.bincount(nodes, minlength=num_points)
+    starts = np.cumsum(counts) - counts
+    slots = np.arange(nodes.size) - starts[nodes[order]]
+    table = np.full((num_points, max(counts.max(initial=0), 1)), -1, dtype=np.intp)
+    table[nodes[order], slots] = order // 3
+    return table
+
+
+def closest_points_on_triangles(p: np.ndarray, a: np.ndarray, b: np.ndarray, c: np.ndarray) -> np.ndarray:
+    """
+    Closest point to p on each triangle (a, b, c), for arrays of points and triangles of the same shape (..., 3).
+    The Voronoi regions of the vertices, edges and face are tested as in Ericson, Real-Time Collision Detection.
+    """
+    ab, ac = b - a, c - a
+    d1, d2 = np.einsum("...i,...i", ab, p - a), np.einsum("...i,...i", ac, p - a)
+    d3, d4 = np.einsum("...i,...i", ab, p - b), np.einsum("...i,...i", ac, p - b)
+    d5, d6 = np.einsum("...i,...i", ab, p - c), np.einsum("...i,...i", ac, p - c)
+    va, vb, vc = d3 * d6 - d5 * d4, d5 * d2 - d1 * d6, d1 * d4 - d3 * d2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denominator = va + vb + vc
+        closest = a + ab * (vb / denominator)[..., None] + ac * (vc / denominator)[..., None]
+        regions = [
+            ((va <= 0) & (d4 >= d3) & (d5 >= d6), b + (c - b) * ((d4 - d3) / ((d4 - d3) + (d5 - d6)))[..., None]),
+            ((vb <= 0) & (d2 >= 0) & (d6 <= 0), a + ac * (d2 / (d2 - d6))[..., None]),
+            ((d6 >= 0) & (d5 <= d6), c),
+            ((vc <= 0) & (d1 >= 0) & (d3 <= 0), a + ab * (d1 / (d1 - d3))[..., None]),
+            ((d3 >= 0) & (d4 <= d3), b),
+            ((d1 <= 0) & (d2 <= 0), a),
+        ]
+    # Applied from the face to the vertices, so that the first matching region in Ericson's order wins
+    for mask, point in regions:
+        closest = np.where(mask[..., None], point, closest)
+    return closest
+
+
+def project_to_surface(points: np.ndarray, triangles: np.ndarray, probes: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Closest surface point of every probe, searched among the triangles incident to its SURFACE_CANDIDATES
+    nearest nodes.
+
+    :param points: (M, 3) mesh points.
+    :type points: np.ndarray
+    :param triangles: (F, 3) zero-based triangle connectivity.
+    :type triangles: np.ndarray
+    :param probes: (N, 3) probe points.
+    :type probes: np.ndarray
+
+    :return: The (N, 3) projected points, the (N,) indices of the triangles they lie on and the (N,) distances
+        from the probes.
+    :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+    _, nodes = nearest_nodes(points, probes, SURFACE_CANDIDATES)
+    candidates = incident_triangles(triangles, points.shape[0])[nodes].reshape(probes.shape[0], -1)
+    # Only the (probe, triangle) pairs that exist are evaluated, the padding of high-valence nodes is skipped
+    probe_ids, columns = np.nonzero(candidates >= 0)
+    cell_ids = candidates[probe_ids, columns]
+    corners = points[triangles[cell_ids]]
+    p = probes[probe_ids]
+    closest = closest_points_on_triangles(p, corners[:, 0], corners[:, 1], corners[:, 2])
+    squared = np.einsum("ij,ij->i", closest - p, closest - p)
+    # Degenerate triangles are never the closest
+    squared[~np.isfinite(squared)] = np.inf
+    order = np.lexsort((squared, probe_ids))
+    _, first = np.unique(probe_ids[order], return_index=True)
+    best = order[first]
+    return closest[best], cell_ids[best], np.sqrt(squared[best])
+
+
+def assign_nearest(num_points: int, node_ids: np.ndarray, labels: np.ndarray, distances: np.ndarray) -> np.ndarray:
+    """
+    Label each node with the label of the nearest probe claiming it.
+
+    :param num_points: Number of mesh nodes.
+    :type num_points: int
+    :param node_ids: (N,) node claimed by each probe.
+    :type node_ids: np.ndarray
+    :param labels: (N,) positive label of each probe.
+    :type labels: np.ndarray
+    :param distances: (N,) distance of each probe from its node.
+    :type distances: np.ndarray
+
+    :return: (M,) labels, 0 for unclaimed nodes.
+    :rtype: np.ndarray
+    """
+    order = np.lexsort((distances, node_ids))
+    _, first = np.unique(node_ids[order], return_index=True)
+    nearest = order[first]
+    node_labels = np.zeros(num_points, dtype=labels.dtype)
+    node_labels[node_ids[nearest]] = labels[nearest]
+    return node_labels
+
+
+def geodesic_neighbourhoods(
+    points: np.ndarray,
+    triangles: np.ndarray,
+    surface_points: np.ndarray,
+    cell_ids: np.ndarray,
+    labels: np.ndarray,
+    radius: float,
+) -> np.ndarray:
+    """
+    Label the nodes within a geodesic radius of surface points with the label of the nearest one. Distances are
+    measured along mesh edges, starting from the vertices of the triangle each surface point lies on. The vertex
+    nearest to each surface point is labelled whatever the radius.
+
+    :param points: (M, 3) mesh points.
+    :type points: np.ndarray
+    :param triangles: (F, 3) zero-based triangle connectivity.
+    :type triangles: np.ndarray
+    :param surface_points: (N, 3) points on the surface, from project_to_surface.
+    :type surface_points: np.ndarray
+    :param cell_ids: (N,) triangles the surface points lie on.
+    :type cell_ids: np.ndarray
+    :param labels: (N,) positive label of each surface point.
+    :type labels: np.ndarray
+    :param radius: Geodesic radius, in the units of points.
+    :type radius: float
+
+    :return: (M,) labels, 0 for unlabelled nodes.
+    :rtype: np.ndarray
+    """
+    num_points, num_probes = points.shape[0], surface_points.shape[0]
+    corners = triangles[cell_ids]
+    corner_distances = np.linalg.norm(points[corners] - surface_points[:, None, :], axis=2)
+    # Each surface point is a virtual node joined to the corners of its triangle (zero weights would be dropped)
+    probe_nodes = np.repeat(num_points + np.arange(num_probes), 3)
+    probe_edges = coo_array(
+        (np.maximum(corner_distances.ravel(), np.finfo(float).tiny), (probe_nodes, corners.ravel())),
+        shape=(num_points + num_probes, num_points + num_probes),
+    )
+    graph = mesh_graph(points, triangles)
+    graph.resize((num_points + num_probes, num_points + num_probes))
+    graph = (graph + probe_edges).tocsr()
+
+    unique_labels = np.unique(labels)
+    distances = np.full((unique_labels.size, num_points), np.inf)
+    for row, label in enumerate(unique_labels):
+        sources = num_points + np.flatnonzero(labels == label)
+        distances[row] = dijkstra(graph, directed=False, indices=sources, limit=radius, min_only=True)[:num_points]
+        nearest_corner = np.argmin(corner_distances[labels == label], axis=1)
+        seeds = corners[labels == label, nearest_corner]
+        np.minimum.at(distances[row], seeds, corner_distances[labels == label, nearest_corner])
+    nearest = np.argmin(distances, axis=0)
+    nearest_distances = distances[nearest, np.arange(num_points)]
+    node_labels = np.zeros(num_points, dtype=labels.dtype)
+    claimed = np.isfinite(nearest_distances)
+    node_labels[claimed] = unique_labels[nearest[claimed]]
+    return node_labels
@@ -0,0 +1,197 @@
+"""
+Adaptive red-green refinement of a triangle mesh around probe points (e.g. digitized ligament insertions), so
+that the resolution of the template is raised only where insertions are marked.
+
+Each level splits the triangles near the probes into four (red refinement), at their edge midpoints. A triangle
+next to two split edges, or next to a neighbour two levels finer, is split as well, so that neighbouring
+triangles differ by at most one level. Once every level is done, each triangle left with a single split edge is
+bisected through its midpoint (green refinement), which makes the mesh conforming without hanging nodes. Green
+triangles are never split further, so the shape of the triangles does not degrade with the number of levels.
+
+Unlike Loop subdivision, the new points are edge midpoints: the refined region stays on the facets of the input
+surface, and the coarse region is left exactly as it was.
+"""
+
+from typing import Literal
+
+import numpy as np
+
+from projection import geodesic_neighbourhoods, nearest_nodes, project_to_surface
+
+
+def edge_keys(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Key of each undirected edge (a, b), the same whatever the order of its nodes.
+    """
+    a, b = a.astype(np.int64), b.astype(np.int64)
+    return np.minimum(a, b) << 32 | np.maximum(a, b)
+
+
+def triangle_edge_keys(triangles: np.ndarray) -> np.ndarray:
+    """
+    (F, 3) keys of the edges (v0, v1), (v1, v2) and (v2, v0) of each triangle.
+    """
+    return np.stack([edge_keys(triangles[:, i], triangles[:, (i + 1) % 3]) for i in range(3)], axis=1)
+
+
+def uniform_point_count(num_points: int, triangles: np.ndarray, subdivisions: int) -> int:
+    """
+    Number of points of a mesh after uniform subdivision (Loop or midpoint), which adds a point on every edge at
+    each level.
+    """
+    num_edges = np.unique(triangle_edge_keys(triangles)).size
+    num_triangles = triangles.shape[0]
+    for _ in range(subdivisions):
+        num_points, num_edges, num_triangles = num_points + num_edges, 2 * num_edges + 3 * num_triangles, 4 * num_triangles
+    return int(num_points)
+
+
+class _SplitEdges:
+    """
+    The edges split so far, each with the node at its midpoint, kept sorted by edge key.
+    """
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.nodes = np.empty(0, dtype=np.int64)
+
+    def lookup(self, keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Whether each edge is split, and its midpoint node (-1 if it is not).
+        """
+        if self.keys.size == 0:
+            return np.zeros(keys.shape, dtype=bool), np.full(keys.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.keys, keys), self.keys.size - 1)
+        found = self.keys[positions] == keys
+        return found, np.where(found, self.nodes[positions], -1)
+
+    def add(self, keys: np.ndarray, nodes: np.ndarray):
+        keys, nodes = np.concatenate([self.keys, keys]), np.concatenate([self.nodes, nodes])
+        order = np.argsort(keys)
+        self.keys, self.nodes = keys[order], nodes[order]
+
+
+def red_split(points: np.ndarray, triangles: np.ndarray, split: np.ndarray, edges: _SplitEdges) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Split the selected triangles into four at their edge midpoints, adding the midpoints of the edges not split yet.
+
+    :return: The points and the triangles, the children of the split triangles last.
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    parents = triangles[split]
+    keys = triangle_edge_keys(parents)
+    found, _ = edges.lookup(keys)
+    new_keys = np.unique(keys[~found])
+    # The two nodes of an edge are the halves of its key
+    new_points = (points[new_keys >> 32] + points[new_keys & 0xFFFFFFFF]) / 2
+    edges.add(new_keys, points.shape[0] + np.arange(new_keys.size))
+    _, midpoints = edges.lookup(keys)
+    a, b, c = parents.T
+    ab, bc, ca = midpoints.T
+    children = np.concatenate([np.stack(corners, axis=1) for corners in [(a, ab, ca), (ab, b, bc), (ca, bc, c), (ab, bc, ca)]])
+    return np.concatenate([points, new_points]), np.concatenate([triangles[~split], children])
+
+
+def closure_splits(triangles: np.ndarray, edges: _SplitEdges) -> np.ndarray:
+    """
+    Triangles that must be split for the refinement to stay conforming: those with two or more split edges, or
+    with a split edge whose halves are split too.
+    """
+    keys = triangle_edge_keys(triangles)
+    found, midpoints = edges.lookup(keys)
+    starts = triangles
+    ends = np.roll(triangles, -1, axis=1)
+    deep = np.zeros(triangles.shape[0], dtype=bool)
+    for halves in (edge_keys(starts, midpoints), edge_keys(midpoints, ends)):
+        deep |= (edges.lookup(halves)[0] & found).any(axis=1)
+    return (found.sum(axis=1) >= 2) | deep
+
+
+def green_closure(triangles: np.ndarray, edges: _SplitEdges) -> np.ndarray:
+    """
+    Bisect every triangle with a single split edge from its midpoint to the opposite node.
+    """
+    found, midpoints = edges.lookup(triangle_edge_keys(triangles))
+    green = found.sum(axis=1) == 1
+    # Nodes rotated so that the split edge is (v0, v1)
+    first = np.argmax(found[green], axis=1)
+    rotation = (first[:, None] + np.arange(3)) % 3
+    corners = np.take_along_axis(triangles[green], rotation, axis=1)
+    middle = midpoints[green, first]
+    children = np.concatenate([np.stack([corners[:, 0], middle, corners[:, 2]], axis=1), np.stack([middle, corners[:, 1], corners[:, 2]], axis=1)])
+    return np.concatenate([triangles[~green], children])
+
+
+def near_triangles(
+    points: np.ndarray,
+    triangles: np.ndarray,
+    probes: np.ndarray,
+    radius: float,
+    distance: Literal["euclidean", "geodesic"] = "euclidean",
+) -> np.ndarray:
+    """
+    Triangles with a node within the radius of a probe, plus those the probes project onto.
+
+    :param points: (M, 3) mesh points.
+    :type points: np.ndarray
+    :param triangles: (F, 3) zero-based triangle connectivity.
+    :type triangles: np.ndarray
+    :param probes: (N, 3) probe points.
+    :type probes: np.ndarray
+    :param radius: The radius, in the units of points.
+    :type radius: float
+    :param distance: "euclidean" measures straight distances from the probes. "geodesic" measures distances along
+        mesh edges from the points the probes project onto.
+    :type distance: Literal["euclidean", "geodesic"]
+
+    :return: (F,) mask of the triangles.
+    :rtype: np.ndarray
+    """
+    surface_points, cell_ids, _ = project_to_surface(points, triangles, probes)
+    if distance == "geodesic":
+        near = geodesic_neighbourhoods(points, triangles, surface_points, cell_ids, np.ones(probes.shape[0], dtype=np.int64), radius) > 0
+    else:
+        near = nearest_nodes(probes, points)[0][:, 0] <= radius
+    mask = near[triangles].any(axis=1)
+    mask[cell_ids] = True
+    return mask
+
+
+def adaptive_subdivision(
+    points: np.ndarray,
+    triangles: np.ndarray,
+    probes: np.ndarray,
+    subdivisions: int,
+    radius: float,
+    distance: Literal["euclidean", "geodesic"] = "euclidean",
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Refine a triangle mesh near probe points, see the module documentation. Triangles within the radius of a probe
+    are split at every level, so that they end up as fine as with uniform subdivision; the rest of the mesh only
+    takes the splits needed to stay conforming.
+
+    :param points: (M, 3) mesh points.
+    :type points: np.ndarray
+    :param triangles: (F, 3) zero-based triangle connectivity.
+    :type triangles: np.ndarray
+    :param probes: (N, 3) probe points.
+    :type probes: np.ndarray
+    :param subdivisions: Number of levels.
+    :type subdivisions: int
+    :param radius: Radius around the probes, in the units of points, measured again at every level.
+    :type radius: float
+    :param distance: How the radius is measured, see near_triangles.
+    :type distance: Literal["euclidean", "geodesic"]
+
+    :return: The refined points, the original points first, and the refined triangles, with the orientation of
+        the triangles they come from.
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    points, triangles = np.asarray(points, dtype=np.float64), np.asarray(triangles, dtype=np.int64)
+    edges = _SplitEdges()
+    for _ in range(subdivisions):
+        split = near_triangles(points, triangles, probes, radius, distance)
+        while split.any():
+            points, triangles = red_split(points, triangles, split, edges)
+            split = closure_splits(triangles, edges)
+    return points, green_closure(triangles, edges)
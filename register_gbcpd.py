@@ -1,22 +1,38 @@
 import argparse
 import json
+import os
 import platform
+import shutil
 import subprocess
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass, field, replace
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from tempfile import TemporaryDirectory, mkdtemp, mkstemp
 
 import numpy as np
-import vtkmodules.all as vtk
-from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from vtkmodules.vtkCommonDataModel import vtkPolyData
 
+import engine
+import telemetry
+from align import align_points, alignment_points
 from config import GBCPDConfig
-from utils import read_vtp, save_vtp
+from deformation_stack import POINTS_FILE, StackWriter, is_stack, open_stack, read_names
+from exchange import estimate_text_size, read_points, scratch_root, write_points, write_triangles
+from multiresolution import coarsen, interpolate_displacements
+from result_cache import Manifest, ResultCache, array_hash, backend_version, file_hash, result_key
+from streaming import BoundedExecutor, prefetch
+from utils import apply_matrix, numpy_to_points, numpy_to_polydata, read_vtp, save_json, save_vtp, transform_mesh
+from warm_start import WarmStarts, order_targets, shape_descriptor
 
 if platform.system() == "Windows":
     bcpd = ".\\bcpd.exe"
 else:
     bcpd = "./bcpd"
 
+# Record of how each target of a warm-started run started and how many VB loops it took
+WARM_START_FILE = "warm_start.json"
+
 CLI_LUT = {
     "omega": "-w",
     "lambda_": "-l",
@@ -32,133 +48,721 @@ CLI_LUT = {
 }
 
 
-def convert_mesh_points_to_text(mesh: vtk.vtkPolyData) -> str:
+def convert_mesh_points_to_text(mesh: vtkPolyData, directory: Path | str) -> str:
     points = vtk_to_numpy(mesh.GetPoints().GetData())
-    with NamedTemporaryFile(suffix=".txt", mode="wt", delete=False, delete_on_close=True) as fid:
-        np.savetxt(fid, points, fmt="%f")
-    return fid.name
+    fid, filename = mkstemp(suffix=".txt", dir=directory)
+    os.close(fid)
+    write_points(filename, points)
+    return filename
+
+
+def get_mesh_triangles(mesh: vtkPolyData) -> np.ndarray:
+    return vtk_to_numpy(mesh.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+
 
+def convert_mesh_tris_to_text(mesh: vtkPolyData, directory: Path | str) -> str:
+    tris = get_mesh_triangles(mesh)
+    fid, filename = mkstemp(suffix=".txt", dir=directory)
+    os.close(fid)
+    write_triangles(filename, tris)
+    return filename
 
-def convert_mesh_tris_to_text(mesh: vtk.vtkPolyData) -> str:
-    tris = vtk_to_numpy(mesh.GetPolys().GetData()).reshape(-1, 4)[:, 1:] + 1
-    with NamedTemporaryFile(suffix=".txt", mode="wt", delete=False, delete_on_close=True) as fid:
-        np.savetxt(fid, tris, fmt="%d")
-    return fid.name
 
+def create_mapped_mesh(mesh: vtkPolyData, points: np.ndarray) -> vtkPolyData:
+    """
+    Create a copy of the source mesh sharing its topology and point data, with the points
+    replaced by the deformed points.
 
-def map_source_mesh(mesh: vtk.vtkPolyData) -> vtk.vtkPolyData:
-    points = np.loadtxt("output_y.txt", dtype=np.float32)
-    vtk_array = numpy_to_vtk(points, deep=True, array_type=vtk.VTK_FLOAT)
-    mesh.GetPoints().SetData(vtk_array)
-    return mesh
+    :param mesh: The source mesh. It is not modified.
+    :type mesh: vtkPolyData
+    :param points: The (M, 3) deformed points.
+    :type points: np.ndarray
 
+    :return: The mapped source mesh.
+    :rtype: vtkPolyData
+    """
+    mapped_mesh = vtkPolyData()
+    mapped_mesh.ShallowCopy(mesh)
+    mapped_mesh.SetPoints(numpy_to_points(points.astype(np.float32)))
+    return mapped_mesh
 
-def extract_insertion_points(mesh: vtk.vtkPolyData) -> vtk.vtkPolyData:
+
+def extract_insertion_points(mesh: vtkPolyData) -> vtkPolyData:
+    """
+    Point cloud of the insertion nodes of a mesh (InsertionID > 0) with their InsertionID, ordered by insertion ID.
+    """
     points = vtk_to_numpy(mesh.GetPoints().GetData())
-    point_ids = mesh.GetPointData().GetArray("InsertionID")
-    unique_ids = sorted(list(np.unique(vtk_to_numpy(point_ids))))
-    appended_polydata = vtk.vtkAppendPolyData()
-    for id in unique_ids[1:]:
-        coords = points[point_ids == id]
-        id_array = numpy_to_vtk(np.full(coords.shape[0], id, dtype=int), deep=True, array_type=vtk.VTK_ID_TYPE)
-        id_array.SetName("InsertionID")
-        poly = vtk.vtkPolyData()
-        poly_points = vtk.vtkPoints()
-        poly_cells = vtk.vtkCellArray()
-        for i in range(coords.shape[0]):
-            poly_points.InsertNextPoint(coords[i])
-            poly_cells.InsertNextCell(1, [i])
-        poly.SetPoints(poly_points)
-        poly.SetVerts(poly_cells)
-        poly.GetPointData().AddArray(id_array)
-        appended_polydata.AddInputData(poly)
-    appended_polydata.Update()
-    return appended_polydata.GetOutput()
-
-
-def create_pretransform(config: GBCPDConfig) -> vtk.vtkTransform:
+    insertion_ids = vtk_to_numpy(mesh.GetPointData().GetArray("InsertionID"))
+    node_ids = np.flatnonzero(insertion_ids > 0)
+    node_ids = node_ids[np.argsort(insertion_ids[node_ids], kind="stable")]
+    return numpy_to_polydata(points[node_ids], verts=True, point_data={"InsertionID": insertion_ids[node_ids]})
+
+
+def load_pretransform_matrix(config: GBCPDConfig) -> np.ndarray:
     if config.pretransform_file is not None:
         pretransform_file = Path(config.pretransform_file)
         if pretransform_file.is_file():
-            pretransform_matrix = np.load(pretransform_file)
+            return np.load(pretransform_file)
         else:
             raise FileNotFoundError(f"File not found: {pretransform_file}")
-    else:
-        pretransform_matrix = np.eye(4)
-    pretransform = vtk.vtkTransform()
-    pretransform.SetMatrix(pretransform_matrix.ravel())
-    pretransform.Inverse()
-    return pretransform
+    return np.eye(4)
 
 
-def transform_polydata(polydata: vtk.vtkPolyData, tx: vtk.vtkTransform) -> vtk.vtkPolyData:
-    transform_filter = vtk.vtkTransformPolyDataFilter()
-    transform_filter.SetInputData(polydata)
-    transform_filter.SetTransform(tx)
-    transform_filter.Update()
-    return transform_filter.GetOutput()
+def undo_pretransform(mapped_mesh: vtkPolyData, inverse_matrix: np.ndarray) -> vtkPolyData:
+    """
+    Undo the pretransform on a mapped mesh, given the inverse of the pretransform matrix. The mapped mesh has its own
+    points array (see create_mapped_mesh), which is overwritten.
+    """
+    return transform_mesh(mapped_mesh, inverse_matrix, inplace=True)
 
 
-def main(config: GBCPDConfig):
-    output_dir = Path(config.output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    target_mesh_path = Path(config.target_mesh_path)
-    target_meshes = []
+def get_target_mesh_paths(target_mesh_path: Path) -> list[Path]:
+    """
+    Paths of the target meshes. The meshes of a deformation stack are given as <stack directory>/<name>.vtp,
+    which read_target_mesh and get_target_hash resolve to the stack's rows.
+    """
     if target_mesh_path.is_file() and target_mesh_path.suffix == ".vtp":
-        target_meshes.append((target_mesh_path, read_vtp(target_mesh_path.as_posix())))
+        return [target_mesh_path]
+    elif is_stack(target_mesh_path):
+        return [target_mesh_path.joinpath(f"{name}.vtp") for name in read_names(target_mesh_path)]
     elif target_mesh_path.is_dir():
-        target_meshes = [(path, read_vtp(path.as_posix())) for path in target_mesh_path.glob("*.vtp")]
+        return sorted(target_mesh_path.glob("*.vtp"))
     else:
         raise FileNotFoundError(f"File not found: {target_mesh_path}")
-    source_mesh = read_vtp(config.source_mesh_file)
-    source_points_file = convert_mesh_points_to_text(source_mesh)
-    source_tri_file = convert_mesh_tris_to_text(source_mesh)
-
-    pretransform = create_pretransform(config)
-    for target_mesh_filename, target_mesh in target_meshes:
-        target_point_file = convert_mesh_points_to_text(target_mesh)
-
-        if np.isclose(config.tau, 0.0):
-            cli_args = [
-                f"{bcpd}",
-                f"-x{target_point_file}",
-                f"-y{source_points_file}",
-                f"-u{config.nrm}",
-                "-p",
-                "-h",
-            ]
+
+
+def read_target_mesh(target_mesh_path: Path) -> vtkPolyData:
+    if is_stack(target_mesh_path.parent):
+        return open_stack(target_mesh_path.parent).get_mesh(target_mesh_path.stem)
+    return read_vtp(target_mesh_path)
+
+
+def read_target_points(target_mesh_path: Path) -> np.ndarray:
+    if is_stack(target_mesh_path.parent):
+        return open_stack(target_mesh_path.parent).get_points(target_mesh_path.stem)
+    return vtk_to_numpy(read_vtp(target_mesh_path).GetPoints().GetData())
+
+
+def get_target_hash(target_mesh_path: Path) -> str:
+    if is_stack(target_mesh_path.parent):
+        return array_hash(open_stack(target_mesh_path.parent).get_points(target_mesh_path.stem))
+    return file_hash(target_mesh_path)
+
+
+def get_thread_allocation(jobs: int, threads: int | None, num_targets: int) -> tuple[int, int]:
+    """
+    Split the available cores between concurrent bcpd processes and their OpenMP threads.
+
+    :param jobs: Requested number of concurrent registrations.
+    :type jobs: int
+    :param threads: Requested number of OpenMP threads per registration (if None the available cores are split evenly).
+    :type threads: int | None
+    :param num_targets: Number of target meshes to register.
+    :type num_targets: int
+
+    :return: The number of concurrent registrations and the number of OpenMP threads for each.
+    :rtype: tuple[int, int]
+    """
+    jobs = max(1, min(jobs, num_targets))
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // jobs)
+    return jobs, threads
+
+
+def get_cli_args(config: GBCPDConfig, target_points_file: str, source_points_file: str, source_tri_file: str) -> list[str]:
+    cli_args = [
+        Path(bcpd).resolve().as_posix(),
+        f"-x{target_points_file}",
+        f"-y{source_points_file}",
+        f"-u{config.nrm}",
+    ]
+    if not np.isclose(config.tau, 0.0):
+        cli_args.append(f"-Ggeodesic,{config.tau},{source_tri_file}")
+    cli_args.extend(["-p", "-h"])
+    for key, value in CLI_LUT.items():
+        param = getattr(config, key)
+        if param is not None:
+            cli_args.append(f"{value}{param}")
+    return cli_args
+
+
+@dataclass
+class PreparedTarget:
+    path: Path
+    points: np.ndarray | None = None
+    work_dir: Path | None = None
+    points_file: str | None = None
+    coarse_points: list[np.ndarray] = field(default_factory=list)
+    # Warm start: the starting shape and whether the target is also registered from the template for comparison
+    initial_points: np.ndarray | None = None
+    check_cold: bool = False
+    iterations: int | None = None
+    cold_iterations: int | None = None
+    cold_difference: float | None = None
+    # Pre-alignment: the 4x4 matrix applied to the target, undone on the registered points
+    alignment: np.ndarray | None = None
+    # The exception raised while reading or preparing the target, which is then not registered
+    error: Exception | None = None
+
+
+def iter_prepared_targets(
+    target_mesh_paths: Iterable[Path], run_dir: Path, config: GBCPDConfig, align_to: np.ndarray | None = None
+) -> Iterator[PreparedTarget]:
+    """
+    Lazily read each target mesh and prepare it for the registration backend, so that only the targets
+    currently being prepared are held in memory. For the cli backend the points are converted to bcpd's
+    input format inside a scratch directory of their own; for the numpy backend they are kept as an array.
+    The decimated targets of the coarse resolution levels are computed here as well, after the target is aligned
+    onto the source if config.prealign is set. A target that cannot be read or prepared is yielded with its error,
+    so that it is reported as failed and the other targets go on.
+
+    :param target_mesh_paths: Paths to the target meshes.
+    :type target_mesh_paths: Iterable[Path]
+    :param run_dir: Directory in which the scratch directories are created.
+    :type run_dir: Path
+    :param config: The registration configuration.
+    :type config: GBCPDConfig
+    :param align_to: The decimated source points the targets are aligned onto (config.prealign only).
+    :type align_to: np.ndarray | None
+
+    :return: An iterator over the prepared targets.
+    :rtype: Iterator[PreparedTarget]
+    """
+    for target_mesh_path in target_mesh_paths:
+        try:
+            with telemetry.span("read", target=target_mesh_path.stem):
+                target_mesh = read_target_mesh(target_mesh_path)
+            target = prepare_target(target_mesh_path, target_mesh, run_dir, config, align_to)
+        except Exception as error:
+            target = PreparedTarget(target_mesh_path, error=error)
+        yield target
+
+
+def prepare_target(
+    target_mesh_path: Path, target_mesh: vtkPolyData, run_dir: Path, config: GBCPDConfig, align_to: np.ndarray | None = None
+) -> PreparedTarget:
+    alignment = None
+    if align_to is not None:
+        with telemetry.span("align", target=target_mesh_path.stem):
+            target_mesh, alignment = align_target(target_mesh, align_to, config)
+    with telemetry.span("convert", target=target_mesh_path.stem):
+        target = _prepare_target(target_mesh_path, target_mesh, run_dir, config)
+    target.alignment = alignment
+    return target
+
+
+def _prepare_target(target_mesh_path: Path, target_mesh: vtkPolyData, run_dir: Path, config: GBCPDConfig) -> PreparedTarget:
+    coarse_points = [coarsen(target_mesh, level.points, config.r)[0] for level in config.levels or []]
+    if config.backend == "numpy":
+        points = vtk_to_numpy(target_mesh.GetPoints().GetData())
+        return PreparedTarget(target_mesh_path, points=points, coarse_points=coarse_points)
+    else:
+        work_dir = Path(mkdtemp(prefix="bcpd_", dir=run_dir))
+        points_file = convert_mesh_points_to_text(target_mesh, work_dir)
+        return PreparedTarget(target_mesh_path, work_dir=work_dir, points_file=points_file, coarse_points=coarse_points)
+
+
+def get_alignment_points(config: GBCPDConfig, source_mesh: vtkPolyData) -> np.ndarray | None:
+    """
+    The decimated source points the targets are aligned onto, or None without config.prealign.
+    """
+    if config.prealign is None:
+        return None
+    return alignment_points(source_mesh, config.r)
+
+
+def align_target(target_mesh: vtkPolyData, align_to: np.ndarray, config: GBCPDConfig) -> tuple[vtkPolyData, np.ndarray]:
+    """
+    Rigidly (or with a uniform scale) align a target mesh onto the decimated source points, see align.py.
+
+    :return: The aligned target mesh and the 4x4 matrix that was applied to it.
+    :rtype: tuple[vtkPolyData, np.ndarray]
+    """
+    alignment = align_points(
+        alignment_points(target_mesh, config.r), align_to, config.prealign == "similarity", config.prealign_reflection
+    )
+    telemetry.record("alignment", rms=round(alignment.rms, 6), iterations=alignment.iterations, reflection=alignment.reflection)
+    return transform_mesh(target_mesh, alignment.matrix), alignment.matrix
+
+
+def run_bcpd(
+    config: GBCPDConfig, target_points_file: str, source_points_file: str, source_tri_file: str, work_dir: Path, threads: int
+) -> engine.BCPDResult:
+    cli_args = get_cli_args(config, target_points_file, source_points_file, source_tri_file)
+    env = os.environ | {"OMP_NUM_THREADS": str(threads), "OPENBLAS_NUM_THREADS": str(threads)}
+    subprocess.run(cli_args, cwd=work_dir, env=env, check=True)
+    # bcpd's iteration count and computing times, deleted with the scratch directory
+    outputs = {name: work_dir.joinpath(f"output_{name}.txt") for name in ("info", "comptime")}
+    reports = {name: telemetry.parse_bcpd_output(path) for name, path in outputs.items() if path.is_file()}
+    telemetry.record("bcpd", **reports)
+    loops = reports.get("info", {}).get("loops")
+    iterations = int(loops) if isinstance(loops, float) else None
+    return engine.BCPDResult(read_points(work_dir.joinpath("output_y.txt"), dtype=np.float64), iterations, None)
+
+
+def solve_points(
+    config: GBCPDConfig,
+    target_points: np.ndarray,
+    source_points: np.ndarray,
+    triangles: np.ndarray | None,
+    work_dir: Path | None,
+    threads: int,
+    template_points: np.ndarray | None = None,
+) -> engine.BCPDResult:
+    """
+    Register source points to target points with the configured backend. For the cli backend the points
+    and triangles are written to work_dir first. With the numpy backend, the geodesic distances are measured on
+    template_points if given, see engine.register.
+
+    :return: The deformed source points and the number of VB loops run.
+    :rtype: engine.BCPDResult
+    """
+    if np.isclose(config.tau, 0.0):
+        triangles = None
+    elif triangles is None:
+        raise ValueError("Source triangles are required for the geodesic kernel (tau > 0)")
+    if config.backend == "numpy":
+        result = engine.solve(target_points, source_points, config, triangles, template_points)
+        telemetry.record("engine", iterations=result.iterations, sigma2=result.sigma2)
+        return result
+    target_points_file = work_dir.joinpath("target_points.txt")
+    source_points_file = work_dir.joinpath("source_points.txt")
+    source_tri_file = work_dir.joinpath("source_tris.txt")
+    write_points(target_points_file, target_points)
+    write_points(source_points_file, source_points)
+    if triangles is not None:
+        write_triangles(source_tri_file, triangles)
+    return run_bcpd(config, target_points_file.as_posix(), source_points_file.as_posix(), source_tri_file.as_posix(), work_dir, threads)
+
+
+def register_coarse_levels(
+    config: GBCPDConfig, target: PreparedTarget, source_mesh: vtkPolyData, threads: int
+) -> np.ndarray:
+    """
+    Register decimated copies of the source and target at each coarse resolution level, coarsest first.
+    The displacement recovered at each level is interpolated onto the full-resolution source points,
+    which are the starting shape of the next level.
+
+    :return: The full-resolution source points deformed by the coarse levels.
+    :rtype: np.ndarray
+    """
+    points = vtk_to_numpy(source_mesh.GetPoints().GetData()).astype(np.float64)
+    for index, (level, target_points) in enumerate(zip(config.levels, target.coarse_points)):
+        with telemetry.span("level", level=index, points=level.points):
+            coarse_points, coarse_triangles = coarsen(create_mapped_mesh(source_mesh, points), level.points, config.r)
+            level_config = replace(config, n_max=level.n_max, n_min=level.n_min)
+            registered = solve_points(level_config, target_points, coarse_points, coarse_triangles, target.work_dir, threads)
+            points += interpolate_displacements(coarse_points, registered.points - coarse_points, points)
+    return points
+
+
+def solve_target(
+    config: GBCPDConfig,
+    target: PreparedTarget,
+    source_mesh: vtkPolyData,
+    source_points_file: str | None,
+    source_tri_file: str | None,
+    threads: int,
+    initial_points: np.ndarray | None = None,
+) -> engine.BCPDResult:
+    """
+    Register the source mesh to a prepared target, starting from initial_points if given, or else from the
+    source mesh deformed by the coarse resolution levels, if any. The target's scratch directory is kept.
+    """
+    if initial_points is not None:
+        source_points = initial_points
+    elif config.levels:
+        source_points = register_coarse_levels(config, target, source_mesh, threads)
+    else:
+        source_points = None
+
+    if config.backend == "numpy":
+        # Warm-started and level-refined source points are deformed copies of the template, whose geodesic
+        # distances are computed once and reused
+        template_points = vtk_to_numpy(source_mesh.GetPoints().GetData())
+        if source_points is None:
+            source_points = template_points
+        return solve_points(config, target.points, source_points, get_mesh_triangles(source_mesh), None, threads, template_points)
+    if source_points is not None:
+        source_points_file = target.work_dir.joinpath("source_points.txt").as_posix()
+        write_points(source_points_file, source_points)
+    return run_bcpd(config, target.points_file, source_points_file, source_tri_file, target.work_dir, threads)
+
+
+def register_target(
+    config: GBCPDConfig,
+    target: PreparedTarget,
+    source_mesh: vtkPolyData,
+    source_points_file: str | None,
+    source_tri_file: str | None,
+    threads: int,
+) -> vtkPolyData:
+    """
+    Register the source mesh to a single prepared target. With the cli backend bcpd is run inside the
+    target's scratch directory, which is removed afterwards, so that several registrations can run at
+    the same time. With the numpy backend the registration runs in-process on the point arrays.
+
+    With resolution levels configured, the coarse levels are registered first and the full-resolution
+    template, deformed by them, is refined with n_max and n_min. A warm-started target (with initial_points)
+    starts from its initial points instead, without the coarse levels; with check_cold it is registered from
+    the template as well, for comparison. The number of VB loops run is stored in the target. A pre-aligned
+    target is registered in its aligned frame, and the alignment is undone on the registered points. Only point
+    coordinates change, so the mapped mesh keeps the template's connectivity and InsertionID array exactly.
+
+    :param config: The registration configuration.
+    :type config: GBCPDConfig
+    :param target: The prepared target.
+    :type target: PreparedTarget
+    :param source_mesh: The source mesh. It is not modified.
+    :type source_mesh: vtkPolyData
+    :param source_points_file: Path to the source points in bcpd format (cli backend only).
+    :type source_points_file: str | None
+    :param source_tri_file: Path to the source triangles in bcpd format (cli backend only).
+    :type source_tri_file: str | None
+    :param threads: Number of OpenMP threads given to bcpd.
+    :type threads: int
+
+    :return: The source mesh mapped onto the target (before the pretransform is undone).
+    :rtype: vtkPolyData
+    """
+    initial_points = target.initial_points
+    unalign = None
+    if target.alignment is not None:
+        unalign = np.linalg.inv(target.alignment)
+        if initial_points is not None:
+            initial_points = apply_matrix(initial_points, target.alignment)
+    try:
+        with telemetry.span("solve", target=target.path.stem, warm=initial_points is not None):
+            result = solve_target(config, target, source_mesh, source_points_file, source_tri_file, threads, initial_points)
+        points = result.points if unalign is None else apply_matrix(result.points, unalign)
+        target.iterations = result.iterations
+        if target.check_cold:
+            with telemetry.span("cold", target=target.path.stem):
+                cold = solve_target(config, target, source_mesh, source_points_file, source_tri_file, threads)
+            cold_points = cold.points if unalign is None else apply_matrix(cold.points, unalign)
+            target.cold_iterations = cold.iterations
+            target.cold_difference = float(np.sqrt(np.mean(np.sum((points - cold_points) ** 2, axis=1))))
+        return create_mapped_mesh(source_mesh, points)
+    finally:
+        if target.work_dir is not None:
+            shutil.rmtree(target.work_dir, ignore_errors=True)
+
+
+def register_all(
+    config: GBCPDConfig,
+    source_mesh: vtkPolyData,
+    prepare_targets: Callable[[Path], Iterable[PreparedTarget]],
+    num_targets: int,
+    on_result: Callable[[Path, vtkPolyData | None, Exception | None], None],
+    warm_starts: WarmStarts | None = None,
+):
+    """
+    Register the source mesh to every prepared target, running up to config.jobs registrations at a time.
+    Targets are prepared ahead of the registrations in a background thread.
+
+    :param config: The registration configuration.
+    :type config: GBCPDConfig
+    :param source_mesh: The source mesh. It is not modified.
+    :type source_mesh: vtkPolyData
+    :param prepare_targets: Given the scratch directory of the run, returns an iterator over the prepared targets.
+    :type prepare_targets: Callable[[Path], Iterable[PreparedTarget]]
+    :param num_targets: Number of targets, used to split the cores between registrations.
+    :type num_targets: int
+    :param on_result: Called from the worker threads with each target's path and either its mapped mesh (before
+        the pretransform is undone) or the exception raised while reading, preparing or registering it.
+    :type on_result: Callable[[Path, vtkPolyData | None, Exception | None], None]
+    :param warm_starts: Starting shapes of the targets (if None every target starts from the source mesh).
+    :type warm_starts: WarmStarts | None
+    """
+    jobs, threads = get_thread_allocation(config.jobs, config.threads, num_targets)
+    scratch_dir = config.scratch_dir
+    if scratch_dir is None and config.backend == "cli":
+        # source files plus prefetched targets and an output_y.txt per concurrent job, assuming targets are no larger than the source
+        num_values = source_mesh.GetNumberOfPoints() * 3 * (1 + 2 * jobs + config.prefetch) + source_mesh.GetNumberOfCells() * 3
+        scratch_dir = scratch_root(estimate_text_size(num_values))
+
+    with (
+        TemporaryDirectory(prefix="kneemorph_", dir=scratch_dir) as run_dir,
+        BoundedExecutor(workers=jobs, name="bcpd") as solver,
+    ):
+        source_points_file, source_tri_file = None, None
+        if config.backend == "cli":
+            source_points_file = convert_mesh_points_to_text(source_mesh, run_dir)
+            source_tri_file = convert_mesh_tris_to_text(source_mesh, run_dir)
+
+        def process_target(target: PreparedTarget):
+            if target.error is not None:
+                on_result(target.path, None, target.error)
+                return
+            if warm_starts is not None:
+                target.initial_points, target.check_cold = warm_starts.start(target.path.stem)
+            try:
+                mapped_mesh = register_target(config, target, source_mesh, source_points_file, source_tri_file, threads)
+            except Exception as error:
+                on_result(target.path, None, error)
+            else:
+                if warm_starts is not None:
+                    points = vtk_to_numpy(mapped_mesh.GetPoints().GetData())
+                    warm_starts.finish(target.path.stem, points, target.iterations, target.cold_iterations, target.cold_difference)
+                on_result(target.path, mapped_mesh, None)
+
+        for target in prefetch(prepare_targets(Path(run_dir)), depth=config.prefetch):
+            solver.submit(process_target, target)
+
+
+def register_meshes(
+    config: GBCPDConfig, source_mesh: vtkPolyData, target_meshes: dict[str, vtkPolyData], pretransform_matrix: np.ndarray
+) -> dict[str, vtkPolyData]:
+    """
+    Register the source mesh to target meshes held in memory. Nothing is written to config.output_dir.
+
+    :param config: The registration configuration. The mesh paths are not used.
+    :type config: GBCPDConfig
+    :param source_mesh: The source mesh.
+    :type source_mesh: vtkPolyData
+    :param target_meshes: The target meshes by name.
+    :type target_meshes: dict[str, vtkPolyData]
+    :param pretransform_matrix: The 4x4 matrix that was applied to the targets, undone on the mapped meshes.
+    :type pretransform_matrix: np.ndarray
+
+    :return: The mapped meshes, named mapped_<target name> as they would be saved by main.
+    :rtype: dict[str, vtkPolyData]
+    """
+    inverse_matrix = np.linalg.inv(pretransform_matrix)
+    mapped_meshes = {}
+    errors = []
+
+    def on_result(target_mesh_filename: Path, mapped_mesh: vtkPolyData | None, error: Exception | None):
+        if error is not None:
+            errors.append(error)
         else:
-            cli_args = [
-                f"{bcpd}",
-                f"-x{target_point_file}",
-                f"-y{source_points_file}",
-                f"-u{config.nrm}",
-                f"-Ggeodesic,{config.tau},{source_tri_file}",
-                "-p",
-                "-h",
-            ]
-        for key, value in CLI_LUT.items():
-            param = getattr(config, key)
-            if param is not None:
-                cli_args.append(f"{value}{param}")
-
-        # Run the command
-        subprocess.run(" ".join(cli_args), shell=True)
-
-        mapped_mesh = map_source_mesh(source_mesh)
-        mapped_mesh = transform_polydata(mapped_mesh, pretransform)
-        mapped_mesh_path = output_dir.joinpath(f"mapped_{target_mesh_filename.stem}.vtp")
+            mapped_meshes[f"mapped_{target_mesh_filename.stem}"] = undo_pretransform(mapped_mesh, inverse_matrix)
+
+    align_to = get_alignment_points(config, source_mesh)
+
+    def prepare_targets(run_dir: Path) -> Iterator[PreparedTarget]:
+        for name, target_mesh in target_meshes.items():
+            try:
+                target = prepare_target(Path(f"{name}.vtp"), target_mesh, run_dir, config, align_to)
+            except Exception as error:
+                target = PreparedTarget(Path(f"{name}.vtp"), error=error)
+            yield target
+
+    register_all(config, source_mesh, prepare_targets, len(target_meshes), on_result)
+    if errors:
+        raise errors[0]
+    return dict(sorted(mapped_meshes.items()))
+
+
+def get_warm_starts(
+    config: GBCPDConfig,
+    target_mesh_paths: list[Path],
+    source_mesh: vtkPolyData,
+    load_previous: Callable[[str], np.ndarray | None] | None = None,
+) -> tuple[list[Path], WarmStarts]:
+    """
+    Order the targets of a warm-started registration by similarity, as a chain starting from the target most
+    similar to the source mesh, see warm_start.py.
+
+    :param config: The registration configuration.
+    :type config: GBCPDConfig
+    :param target_mesh_paths: Paths to the target meshes, whose points are read to describe their shape.
+    :type target_mesh_paths: list[Path]
+    :param source_mesh: The source mesh.
+    :type source_mesh: vtkPolyData
+    :param load_previous: Returns a target's registered points from a previous run, or None.
+    :type load_previous: Callable[[str], np.ndarray | None] | None
+
+    :return: The target mesh paths in registration order and the starting shapes of the targets.
+    :rtype: tuple[list[Path], WarmStarts]
+    """
+    descriptors = []
+    for path in target_mesh_paths:
+        with telemetry.span("describe", target=path.stem):
+            descriptors.append(shape_descriptor(read_target_points(path)))
+    start = shape_descriptor(vtk_to_numpy(source_mesh.GetPoints().GetData()))
+    order = order_targets(np.array(descriptors), start)
+    ordered_descriptors = {target_mesh_paths[i].stem: descriptors[i] for i in order}
+    warm_starts = WarmStarts(config.warm_start, ordered_descriptors, load_previous, config.warm_start_check)
+    return [target_mesh_paths[i] for i in order], warm_starts
+
+
+def save_mapped_mesh(
+    mapped_mesh: vtkPolyData,
+    mapped_mesh_path: Path,
+    insertion_points_path: Path | None = None,
+    stack_writer: StackWriter | None = None,
+):
+    """
+    Write a mapped mesh to its own file, or as the row mapped_mesh_path.stem of a deformation stack when a
+    stack writer is given, and optionally its insertion points.
+    """
+    if stack_writer is not None:
+        stack_writer.write(mapped_mesh_path.stem, vtk_to_numpy(mapped_mesh.GetPoints().GetData()))
+    else:
         save_vtp(mapped_mesh, mapped_mesh_path)
+    if insertion_points_path is not None:
+        save_vtp(extract_insertion_points(mapped_mesh), insertion_points_path)
+
+
+def mapped_mesh_path(output_dir: Path, target_mesh_filename: Path) -> Path:
+    return output_dir.joinpath(f"mapped_{target_mesh_filename.stem}.vtp")
 
+
+def insertion_points_path(config: GBCPDConfig, target_mesh_filename: Path) -> Path | None:
+    """
+    Path of a target's insertion points, or None without config.extract_insertions.
+    """
+    if not config.extract_insertions:
+        return None
+    elif Path(config.target_mesh_path).is_dir():
+        return Path(config.output_dir).joinpath(f"insertions_points_{target_mesh_filename.stem}.vtp")
+    else:
+        return Path(config.output_dir).joinpath("insertions_points.vtp")
+
+
+def restore_cached_result(
+    cache: ResultCache,
+    key: str,
+    mapped_mesh_path: Path,
+    insertion_points_path: Path | None = None,
+    stack_writer: StackWriter | None = None,
+):
+    if stack_writer is not None:
+        save_mapped_mesh(read_vtp(cache.path(key)), mapped_mesh_path, insertion_points_path, stack_writer)
+        return
+    cache.fetch(key, mapped_mesh_path)
+    if insertion_points_path is not None:
+        save_vtp(extract_insertion_points(read_vtp(mapped_mesh_path)), insertion_points_path)
+
+
+def main(config: GBCPDConfig):
+    output_dir = Path(config.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    target_mesh_path = Path(config.target_mesh_path)
+    target_mesh_paths = get_target_mesh_paths(target_mesh_path)
+
+    def get_insertion_points_path(target_mesh_filename: Path) -> Path | None:
+        return insertion_points_path(config, target_mesh_filename)
+
+    def get_mapped_mesh_path(target_mesh_filename: Path) -> Path:
+        return mapped_mesh_path(output_dir, target_mesh_filename)
+
+    def get_output_paths(target_mesh_filename: Path) -> list[Path]:
+        if stack_writer is not None:
+            outputs = [output_dir.joinpath(POINTS_FILE)]
+        else:
+            outputs = [get_mapped_mesh_path(target_mesh_filename)]
         if config.extract_insertions:
-            insertion_points = extract_insertion_points(mapped_mesh)
-            insertion_points_path = output_dir.joinpath("insertions_points.vtp")
-            save_vtp(insertion_points, insertion_points_path)
+            outputs.append(get_insertion_points_path(target_mesh_filename))
+        return outputs
+
+    # In stack format the mapped meshes are the rows of a stack in output_dir sharing the source mesh's connectivity.
+    # Rows not filled yet, e.g. all those of a newly created stack, are registered whatever the manifest says
+    source_mesh = None
+    stack_writer = None
+    if config.output_format == "stack":
+        source_mesh = read_vtp(config.source_mesh_file)
+        stack_writer = StackWriter(output_dir, source_mesh, [get_mapped_mesh_path(path).stem for path in target_mesh_paths])
+
+    # Targets registered with the same inputs, parameters and backend by a previous run, or found in the
+    # result cache, are not registered again
+    cache = ResultCache(config.cache_dir) if config.cache_dir is not None else None
+    manifest = Manifest(output_dir.joinpath("manifest.json"), config)
+    source_hash = file_hash(config.source_mesh_file)
+    version = backend_version(config, bcpd)
+    pretransform_matrix = load_pretransform_matrix(config)
+    inverse_matrix = np.linalg.inv(pretransform_matrix)
+    keys = {}
+    pending = []
+    for path in target_mesh_paths:
+        key = result_key(source_hash, get_target_hash(path), config, pretransform_matrix, version)
+        keys[path] = key
+        outputs = get_output_paths(path)
+        resumable = stack_writer is None or stack_writer.is_filled(get_mapped_mesh_path(path).stem)
+        if resumable and manifest.is_completed(path.stem, key) and all(output.is_file() for output in outputs):
+            continue
+        elif cache is not None and cache.contains(key):
+            with telemetry.span("restore", target=path.stem):
+                restore_cached_result(cache, key, get_mapped_mesh_path(path), get_insertion_points_path(path), stack_writer)
+            manifest.completed(path.stem, key, path, outputs, cached=True)
+        else:
+            pending.append(path)
+    if not pending:
+        if stack_writer is not None:
+            stack_writer.close()
+        manifest.compact()
+        return
+
+    if source_mesh is None:
+        source_mesh = read_vtp(config.source_mesh_file)
+
+    # Previous results are read back in the registration frame, before the pretransform was undone
+    def load_previous(name: str) -> np.ndarray | None:
+        previous_path = get_mapped_mesh_path(Path(name))
+        if not manifest.has_result(name):
+            return None
+        elif stack_writer is not None:
+            points = stack_writer.read(previous_path.stem) if stack_writer.is_filled(previous_path.stem) else None
+        elif previous_path.is_file():
+            points = vtk_to_numpy(read_vtp(previous_path).GetPoints().GetData())
+        else:
+            points = None
+        return None if points is None else apply_matrix(points, pretransform_matrix)
+
+    align_to = get_alignment_points(config, source_mesh)
+    warm_starts = None
+    if config.warm_start is not None:
+        pending, warm_starts = get_warm_starts(config, pending, source_mesh, load_previous)
+
+    # A failed target is recorded in the manifest and does not stop the others
+    def write_target(target_mesh_filename: Path, mapped_mesh: vtkPolyData):
+        key = keys[target_mesh_filename]
+        outputs = get_output_paths(target_mesh_filename)
+        try:
+            with telemetry.span("map", target=target_mesh_filename.stem):
+                mapped_mesh = undo_pretransform(mapped_mesh, inverse_matrix)
+            with telemetry.span("write", target=target_mesh_filename.stem):
+                save_mapped_mesh(
+                    mapped_mesh, get_mapped_mesh_path(target_mesh_filename), get_insertion_points_path(target_mesh_filename), stack_writer
+                )
+                if cache is not None and stack_writer is not None:
+                    cache.store_mesh(key, mapped_mesh)
+                elif cache is not None:
+                    cache.store(key, outputs[0])
+        except Exception as error:
+            manifest.failed(target_mesh_filename.stem, key, target_mesh_filename, error)
+        else:
+            manifest.completed(target_mesh_filename.stem, key, target_mesh_filename, outputs)
+
+    # Results are written behind the registrations
+    with BoundedExecutor(workers=1, backlog=config.prefetch, name="writer") as writer:
+
+        def on_result(target_mesh_filename: Path, mapped_mesh: vtkPolyData | None, error: Exception | None):
+            if error is not None:
+                manifest.failed(target_mesh_filename.stem, keys[target_mesh_filename], target_mesh_filename, error)
+            else:
+                writer.submit(write_target, target_mesh_filename, mapped_mesh)
+
+        register_all(
+            config,
+            source_mesh,
+            lambda run_dir: iter_prepared_targets(pending, run_dir, config, align_to),
+            len(pending),
+            on_result,
+            warm_starts,
+        )
+    if stack_writer is not None:
+        stack_writer.close()
+    if warm_starts is not None:
+        report = warm_starts.report()
+        save_json(report, output_dir.joinpath(WARM_START_FILE))
+        telemetry.record("warm_start", **report["summary"])
 
-        for f in ("output_info.txt", "output_comptime.txt", "output_y.txt"):
-            filepath = Path(f)
-            if filepath.exists() and filepath.is_file():
-                filepath.unlink()
+    manifest.compact()
+    failures = manifest.failures([path.stem for path in pending])
+    if failures:
+        raise RuntimeError(f"Registration failed for {len(failures)} target(s), see {manifest.filepath}: {', '.join(failures)}")
 
 
 if __name__ == "__main__":
@@ -167,7 +771,11 @@ if __name__ == "__main__":
     )
 
     parser.add_argument("config", type=str, help="JSON configuration file")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of targets registered concurrently (overrides the configuration)")
     args = parser.parse_args()
     with open(args.config, "r") as f:
         config = GBCPDConfig(**json.load(f))
-    main(config)
+    if args.jobs is not None:
+        config.jobs = args.jobs
+    with telemetry.session(config.telemetry_log, "register", config.profile):
+        main(config)
@@ -0,0 +1,282 @@
+"""
+Content-addressed cache of registration results and the manifest of a batch registration run.
+
+A result is keyed by everything that determines it: the source and target mesh files, the registration
+parameters, the pretransform and the version of the registration backend. Registering the same pair again
+with the same settings copies the cached mapped mesh instead of running bcpd, so an interrupted batch resumes
+where it stopped and a parameter change only costs the targets it affects.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from dataclasses import asdict
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
+from tempfile import mkstemp
+
+import numpy as np
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+from config import GBCPDConfig
+from utils import save_vtp
+
+# Size of the blocks in which files are read while hashing
+HASH_BLOCK_SIZE = 1 << 20
+# Configuration fields that do not change the registered points
+NON_RESULT_FIELDS = {
+    "source_mesh_file",
+    "target_mesh_path",
+    "output_dir",
+    "pretransform_file",
+    "extract_insertions",
+    "cache_dir",
+    "jobs",
+    "threads",
+    "prefetch",
+    "scratch_dir",
+    "output_format",
+    "telemetry_log",
+    "profile",
+    "warm_start_check",
+}
+# Sources of the in-process engine, whose contents identify the numpy backend
+NUMPY_BACKEND_SOURCES = ("engine.py", "geodesic.py")
+
+
+def file_hash(filepath: Path | str) -> str:
+    """
+    SHA-256 of the contents of a file.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def array_hash(array: np.ndarray) -> str:
+    """
+    SHA-256 of the contents of an array, e.g. a row of a deformation stack.
+    """
+    return hashlib.sha256(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _cached_file_hash(filepath: str, size: int, mtime_ns: int) -> str:
+    return file_hash(filepath)
+
+
+def backend_version(config: GBCPDConfig, bcpd_path: Path | str) -> str:
+    """
+    Identifies the registration backend: the content hash of the bcpd executable for the cli backend,
+    or of the in-process engine's sources (engine.py and geodesic.py) for the numpy backend.
+
+    :param config: The registration configuration.
+    :type config: GBCPDConfig
+    :param bcpd_path: Path to the bcpd executable.
+    :type bcpd_path: Path | str
+
+    :return: A string that changes whenever the backend does.
+    :rtype: str
+    """
+    if config.backend == "numpy":
+        filepaths = [Path(__file__).with_name(name) for name in NUMPY_BACKEND_SOURCES]
+    else:
+        filepaths = [Path(bcpd_path)]
+        if not filepaths[0].is_file():
+            raise FileNotFoundError(f"File not found: {filepaths[0]}")
+    hashes = []
+    for filepath in filepaths:
+        stat = filepath.stat()
+        hashes.append(_cached_file_hash(filepath.resolve().as_posix(), stat.st_size, stat.st_mtime_ns))
+    if len(hashes) == 1:
+        return f"{config.backend}-{hashes[0]}"
+    return f"{config.backend}-{hashlib.sha256(''.join(hashes).encode()).hexdigest()}"
+
+
+def result_parameters(config: GBCPDConfig) -> dict:
+    """
+    The configuration fields that determine the registered points, i.e. every field except paths and
+    execution settings.
+    """
+    return {key: value for key, value in asdict(config).items() if key not in NON_RESULT_FIELDS}
+
+
+def result_key(
+    source_hash: str, target_hash: str, config: GBCPDConfig, pretransform_matrix: np.ndarray, version: str
+) -> str:
+    """
+    Cache key of the registration of one source mesh to one target mesh.
+
+    :param source_hash: Content hash of the source mesh file.
+    :type source_hash: str
+    :param target_hash: Content hash of the target mesh file.
+    :type target_hash: str
+    :param config: The registration configuration.
+    :type config: GBCPDConfig
+    :param pretransform_matrix: The 4x4 pretransform matrix.
+    :type pretransform_matrix: np.ndarray
+    :param version: Version of the registration backend, see backend_version.
+    :type version: str
+
+    :return: Hexadecimal SHA-256 key.
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    digest.update(source_hash.encode())
+    digest.update(target_hash.encode())
+    digest.update(json.dumps(result_parameters(config), sort_keys=True).encode())
+    digest.update(np.ascontiguousarray(pretransform_matrix, dtype=np.float64).tobytes())
+    digest.update(version.encode())
+    return digest.hexdigest()
+
+
+def _atomic_copy(source: Path, destination: Path):
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    fid, filename = mkstemp(suffix=destination.suffix, dir=destination.parent)
+    os.close(fid)
+    try:
+        shutil.copyfile(source, filename)
+        os.replace(filename, destination)
+    except BaseException:
+        Path(filename).unlink(missing_ok=True)
+        raise
+
+
+class ResultCache:
+    """
+    Mapped meshes stored under cache_dir/results, one file per key. Entries are written atomically, so
+    concurrent runs sharing a cache directory never see a partial file.
+    """
+
+    def __init__(self, cache_dir: Path | str):
+        self.directory = Path(cache_dir).joinpath("results")
+
+    def path(self, key: str) -> Path:
+        return self.directory.joinpath(key[:2], f"{key}.vtp")
+
+    def contains(self, key: str) -> bool:
+        return self.path(key).is_file()
+
+    def fetch(self, key: str, destination: Path):
+        _atomic_copy(self.path(key), destination)
+
+    def store(self, key: str, source: Path):
+        _atomic_copy(source, self.path(key))
+
+    def store_mesh(self, key: str, mesh: vtkPolyData):
+        """
+        Store a mapped mesh that was not written to a file of its own.
+        """
+        destination = self.path(key)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        fid, filename = mkstemp(suffix=destination.suffix, dir=destination.parent)
+        os.close(fid)
+        try:
+            save_vtp(mesh, Path(filename))
+            os.replace(filename, destination)
+        except BaseException:
+            Path(filename).unlink(missing_ok=True)
+            raise
+
+
+def manifest_record(key: str, target_path: Path, status: str, **fields) -> dict:
+    """
+    Record of one target in the manifest: its path, cache key, status ("completed" or "failed"), the time and
+    further fields such as its outputs or error.
+    """
+    return {
+        "target": target_path.as_posix(),
+        "key": key,
+        "status": status,
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    } | fields
+
+
+class Manifest:
+    """
+    Record of a batch registration kept in output_dir/manifest.json: for each target its cache key and
+    whether it completed or failed. Each update is appended as a line of JSON to a journal next to it, so that
+    recording a target does not rewrite the records of the others; compact merges the journal into manifest.json,
+    atomically. A journal left by an interrupted run is merged when the manifest is opened again.
+    """
+
+    def __init__(self, filepath: Path | str, config: GBCPDConfig):
+        self.filepath = Path(filepath)
+        self.journal = self.filepath.with_suffix(".jsonl")
+        self._lock = threading.Lock()
+        self.targets = {}
+        if self.filepath.is_file():
+            with open(self.filepath, "r") as f:
+                self.targets = json.load(f).get("targets", {})
+        self.parameters = result_parameters(config)
+        if self.journal.is_file():
+            with open(self.journal, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line of an interrupted run may be incomplete
+                        break
+                    self.targets[entry["name"]] = entry["record"]
+            self.compact()
+
+    def is_completed(self, name: str, key: str) -> bool:
+        """
+        Whether the target was registered with the same key by a previous run.
+        """
+        with self._lock:
+            record = self.targets.get(name)
+            return record is not None and record["status"] == "completed" and record["key"] == key
+
+    def has_result(self, name: str) -> bool:
+        """
+        Whether the last registration of the target completed, whatever its settings.
+        """
+        with self._lock:
+            record = self.targets.get(name)
+            return record is not None and record["status"] == "completed"
+
+    def completed(self, name: str, key: str, target_path: Path, outputs: list[Path], cached: bool = False):
+        self._update(name, key, target_path, "completed", outputs=[p.as_posix() for p in outputs], cached=cached)
+
+    def failed(self, name: str, key: str, target_path: Path, error: BaseException):
+        self._update(name, key, target_path, "failed", error=f"{type(error).__name__}: {error}")
+
+    def failures(self, names: list[str]) -> list[str]:
+        """
+        The given targets whose last registration failed.
+        """
+        with self._lock:
+            return [name for name in names if name in self.targets and self.targets[name]["status"] == "failed"]
+
+    def update(self, records: dict[str, dict]):
+        """
+        Add records made by manifest_record, e.g. by the workers of a distributed registration.
+        """
+        lines = "".join(json.dumps({"name": name, "record": record}) + "\n" for name, record in records.items())
+        with self._lock:
+            self.targets |= records
+            with open(self.journal, "a") as f:
+                f.write(lines)
+
+    def _update(self, name: str, key: str, target_path: Path, status: str, **fields):
+        self.update({name: manifest_record(key, target_path, status, **fields)})
+
+    def compact(self):
+        """
+        Rewrite manifest.json with every record and remove the journal, if anything was recorded since.
+        """
+        with self._lock:
+            if not self.journal.is_file():
+                return
+            data = {"parameters": self.parameters, "targets": self.targets}
+            fid, filename = mkstemp(suffix=".json", dir=self.filepath.parent)
+            with os.fdopen(fid, "w") as f:
+                json.dump(data, f, indent=4)
+            os.replace(filename, self.filepath)
+            self.journal.unlink(missing_ok=True)
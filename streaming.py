@@ -0,0 +1,143 @@
+import queue
+import threading
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_DONE = object()
+
+
+def prefetch(iterable: Iterable[T], depth: int = 1) -> Iterator[T]:
+    """
+    Iterate over an iterable in a background thread, keeping up to depth items ready ahead of the consumer.
+
+    Exceptions raised while producing items are re-raised in the consumer. Closing the returned iterator
+    stops the background thread after the item it is currently producing.
+
+    :param iterable: The items to produce, typically a generator doing I/O.
+    :type iterable: Iterable[T]
+    :param depth: Maximum number of produced items waiting to be consumed.
+    :type depth: int
+
+    :return: An iterator over the same items in the same order.
+    :rtype: Iterator[T]
+    """
+    items = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as error:
+            put((_DONE, error))
+        else:
+            put((_DONE, None))
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def bounded_map(executor: Executor, fn: Callable[[T], R], items: Iterable[T], backlog: int) -> Iterator[R]:
+    """
+    Like executor.map, but with at most backlog tasks submitted ahead of the result being consumed, so that
+    neither the items nor the results of a long iterable pile up in memory. Results are yielded in order.
+
+    :param executor: The thread or process pool running fn.
+    :type executor: Executor
+    :param fn: The function applied to each item.
+    :type fn: Callable[[T], R]
+    :param items: The items.
+    :type items: Iterable[T]
+    :param backlog: Maximum number of submitted tasks whose result has not been consumed.
+    :type backlog: int
+
+    :return: An iterator over fn(item) for each item.
+    :rtype: Iterator[R]
+    """
+    futures = deque()
+    try:
+        for item in items:
+            futures.append(executor.submit(fn, item))
+            if len(futures) >= max(1, backlog):
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+class BoundedExecutor:
+    """
+    Thread pool whose submit blocks once workers + backlog tasks are in flight, so that producers cannot
+    run ahead of the workers and hold an unbounded number of results in memory.
+
+    The first exception raised by a task is re-raised by the next submit or when the executor is closed.
+    """
+
+    def __init__(self, workers: int = 1, backlog: int = 0, name: str = "worker"):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max(1, workers) + max(0, backlog))
+        self._errors = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> Future[T]:
+        self.raise_error()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future: Future):
+        self._slots.release()
+        if future.exception() is not None:
+            with self._lock:
+                self._errors.append(future.exception())
+
+    def raise_error(self):
+        with self._lock:
+            if self._errors:
+                raise self._errors[0]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,390 @@
+"""
+Runs the stages of a study (preprocess, augment, register, postprocess) in a single process.
+
+Each stage is configured exactly as for its own script. A stage depends on another when it reads a path the
+other produces; the meshes and arrays it needs are then handed over in memory instead of being written and read
+back. Every stage is keyed by its configuration, its code and the content (or key) of its inputs; a stage whose
+key is unchanged since the last run is skipped unless a stage that needs its outputs has to run and they are not
+on disk.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from graphlib import TopologicalSorter
+from pathlib import Path
+from tempfile import mkstemp
+from typing import Any
+
+import numpy as np
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+import augment
+import postprocess
+import preprocess
+import register_gbcpd
+from config import AugmentConfig, GBCPDConfig, PostValidationConfig, PreprocessConfig, StudyConfig, StudyStage
+from deformation_stack import DeformationStack, StackWriter, is_stack, save_stack
+from result_cache import backend_version, file_hash
+from utils import read_vtp
+
+CONFIG_TYPES = {
+    "preprocess": PreprocessConfig,
+    "augment": AugmentConfig,
+    "register": GBCPDConfig,
+    "postprocess": PostValidationConfig,
+}
+MODULES = {
+    "preprocess": preprocess,
+    "augment": augment,
+    "register": register_gbcpd,
+    "postprocess": postprocess,
+}
+# Configuration fields that only affect how a stage runs, not what it produces
+EXECUTION_FIELDS = {"cache_dir", "jobs", "threads", "prefetch", "scratch_dir", "writers", "telemetry_log", "profile", "warm_start_check"}
+STATE_FILE = "study_state.json"
+
+
+@dataclass
+class Stage:
+    name: str
+    kind: str
+    config: Any
+    inputs: dict[str, Path]
+    outputs: list[Path]
+    key: str | None = None
+    dependencies: set[str] = field(default_factory=set)
+
+
+def _resolve(path: str | Path) -> Path:
+    return Path(path).resolve()
+
+
+def load_stage_config(study_stage: StudyStage):
+    config = study_stage.config
+    if isinstance(config, str):
+        with open(config, "r") as f:
+            config = json.load(f)
+    return CONFIG_TYPES[study_stage.stage](**config)
+
+
+def get_stage_name(study_stage: StudyStage, index: int) -> str:
+    if study_stage.name is not None:
+        return study_stage.name
+    elif isinstance(study_stage.config, str):
+        return Path(study_stage.config).stem
+    else:
+        return f"{index}_{study_stage.stage}"
+
+
+def create_stage(study_stage: StudyStage, index: int) -> Stage:
+    """
+    Describe a study stage by the paths it reads and produces.
+
+    :param study_stage: The stage as given in the study manifest.
+    :type study_stage: StudyStage
+    :param index: Position of the stage in the manifest.
+    :type index: int
+
+    :return: The stage with its loaded configuration, inputs and outputs.
+    :rtype: Stage
+    """
+    config = load_stage_config(study_stage)
+    kind = study_stage.stage
+    if kind == "preprocess":
+        inputs = {"bone": config.bone}
+        for ligament, filepath in (config.ligament_insertions or {}).items():
+            inputs[f"insertions_{ligament}"] = filepath
+        output_dir = Path(config.output_dir)
+        outputs = [output_dir.joinpath("mesh.vtp"), output_dir.joinpath("transform.npy"), output_dir.joinpath("ligament_ids.json")]
+    elif kind == "augment":
+        inputs = {"base_mesh": config.base_mesh_file}
+        outputs = [augment.get_output_dir(config)]
+    elif kind == "register":
+        inputs = {"source": config.source_mesh_file, "target": config.target_mesh_path}
+        if config.pretransform_file is not None:
+            inputs["pretransform"] = config.pretransform_file
+        outputs = [Path(config.output_dir)]
+    elif kind == "postprocess":
+        inputs = {"template": config.template_mesh_file, "truth": config.ground_truth_path, "result": config.result_path}
+        outputs = [Path(config.output_dir)]
+    else:
+        raise ValueError(f"Unsupported stage: {kind}")
+    return Stage(
+        get_stage_name(study_stage, index),
+        kind,
+        config,
+        {role: _resolve(path) for role, path in inputs.items()},
+        [_resolve(path) for path in outputs],
+    )
+
+
+def link_stages(stages: list[Stage]) -> list[Stage]:
+    """
+    Find the dependencies of each stage and order the stages so that every stage follows those it depends on.
+
+    :return: The stages in dependency order.
+    :rtype: list[Stage]
+    """
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers:
+                raise ValueError(f"{output} is produced by both {producers[output].name} and {stage.name}")
+            producers[output] = stage
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Stage names must be unique: {names}")
+    for stage in stages:
+        stage.dependencies = {producers[path].name for path in stage.inputs.values() if path in producers}
+    by_name = {stage.name: stage for stage in stages}
+    order = TopologicalSorter({stage.name: stage.dependencies for stage in stages}).static_order()
+    return [by_name[name] for name in order]
+
+
+def _content_hash(path: Path) -> str:
+    if path.is_file():
+        return file_hash(path)
+    elif path.is_dir():
+        digest = hashlib.sha256()
+        for filepath in sorted(p for p in path.iterdir() if p.is_file()):
+            digest.update(filepath.name.encode())
+            digest.update(file_hash(filepath).encode())
+        return digest.hexdigest()
+    else:
+        raise FileNotFoundError(f"File not found: {path}")
+
+
+def stage_key(stage: Stage, producers: dict[Path, Stage]) -> str:
+    """
+    Key of a stage: changes whenever its configuration, its code, its external input files or the key of a
+    stage it depends on changes.
+    """
+    digest = hashlib.sha256()
+    digest.update(stage.kind.encode())
+    config = {key: value for key, value in asdict(stage.config).items() if key not in EXECUTION_FIELDS}
+    digest.update(json.dumps(config, sort_keys=True).encode())
+    digest.update(file_hash(MODULES[stage.kind].__file__).encode())
+    if stage.kind == "register":
+        digest.update(backend_version(stage.config, register_gbcpd.bcpd).encode())
+    for role, path in sorted(stage.inputs.items()):
+        digest.update(role.encode())
+        digest.update(path.as_posix().encode())
+        if path in producers:
+            digest.update(producers[path].key.encode())
+        else:
+            digest.update(_content_hash(path).encode())
+    return digest.hexdigest()
+
+
+def load_state(output_dir: Path) -> dict:
+    state_file = output_dir.joinpath(STATE_FILE)
+    if state_file.is_file():
+        with open(state_file, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state: dict, output_dir: Path):
+    fid, filename = mkstemp(suffix=".json", dir=output_dir)
+    with os.fdopen(fid, "w") as f:
+        json.dump(state, f, indent=4)
+    os.replace(filename, output_dir.joinpath(STATE_FILE))
+
+
+def is_persisted(stage: Stage, state: dict) -> bool:
+    """
+    Whether the outputs of the stage, computed with its current key, are on disk.
+    """
+    record = state.get(stage.name)
+    return (
+        record is not None
+        and record["key"] == stage.key
+        and bool(record["files"])
+        and all(Path(filepath).exists() for filepath in record["files"])
+    )
+
+
+def plan(stages: list[Stage], state: dict, write_intermediates: bool, force: bool = False) -> set[str]:
+    """
+    Decide which stages have to run, walking the stages from the last to the first.
+
+    A stage runs when its key has changed, when its outputs are not on disk although they are final (not read by
+    another stage) or requested with write_intermediates, or when a stage that reads them runs and they are
+    not on disk.
+
+    :return: The names of the stages to run.
+    :rtype: set[str]
+    """
+    consumers = {stage.name: [other.name for other in stages if stage.name in other.dependencies] for stage in stages}
+    to_run = set()
+    for stage in reversed(stages):
+        record = state.get(stage.name)
+        persisted = is_persisted(stage, state)
+        if force or record is None or record["key"] != stage.key:
+            to_run.add(stage.name)
+        elif not persisted and (not consumers[stage.name] or write_intermediates):
+            to_run.add(stage.name)
+        elif not persisted and any(name in to_run for name in consumers[stage.name]):
+            to_run.add(stage.name)
+    return to_run
+
+
+def read_mesh(path: Path) -> vtkPolyData:
+    return preprocess.read_bone(path)
+
+
+def read_meshes(path: Path) -> dict[str, vtkPolyData]:
+    if is_stack(path):
+        return dict(DeformationStack(path).iter_meshes())
+    elif path.is_dir():
+        return {filepath.stem: read_vtp(filepath) for filepath in sorted(path.glob("*.vtp"))}
+    return {path.stem: read_mesh(path)}
+
+
+class Artifacts:
+    """
+    The outputs of the stages that ran, by path, falling back to the files on disk for the others.
+    """
+
+    def __init__(self):
+        self._items: dict[Path, Any] = {}
+
+    def __setitem__(self, path: Path, value: Any):
+        self._items[path] = value
+
+    def discard(self, paths: list[Path]):
+        for path in paths:
+            self._items.pop(path, None)
+
+    def mesh(self, path: Path) -> vtkPolyData:
+        return self._items[path] if path in self._items else read_mesh(path)
+
+    def meshes(self, path: Path) -> dict[str, vtkPolyData]:
+        if path not in self._items:
+            return read_meshes(path)
+        value = self._items[path]
+        return value if isinstance(value, dict) else {path.stem: value}
+
+    def array(self, path: Path) -> np.ndarray:
+        return self._items[path] if path in self._items else np.load(path)
+
+
+def run_stage(stage: Stage, artifacts: Artifacts) -> dict[Path, Any]:
+    """
+    Run a stage on its inputs.
+
+    :return: The outputs of the stage by path.
+    :rtype: dict[Path, Any]
+    """
+    config = stage.config
+    if stage.kind == "preprocess":
+        bone_poly, transform_matrix, ligament_lut = preprocess.preprocess_bone(artifacts.mesh(stage.inputs["bone"]), config)
+        mesh_path, transform_path, lut_path = stage.outputs
+        return {mesh_path: bone_poly, transform_path: transform_matrix, lut_path: ligament_lut}
+    elif stage.kind == "augment":
+        mesh = artifacts.mesh(stage.inputs["base_mesh"])
+        meshes = augment.elastic_deformation(mesh, config.control_point_perturbation, config.num_perturbations, config.seed)
+        return {stage.outputs[0]: dict(zip(augment.get_mesh_names(len(meshes)), meshes))}
+    elif stage.kind == "register":
+        source_mesh = artifacts.mesh(stage.inputs["source"])
+        target_meshes = artifacts.meshes(stage.inputs["target"])
+        pretransform_matrix = artifacts.array(stage.inputs["pretransform"]) if "pretransform" in stage.inputs else np.eye(4)
+        mapped_meshes = register_gbcpd.register_meshes(config, source_mesh, target_meshes, pretransform_matrix)
+        return {stage.outputs[0]: mapped_meshes}
+    else:
+        truth_meshes = artifacts.meshes(stage.inputs["truth"])
+        result_meshes = artifacts.meshes(stage.inputs["result"])
+        accumulator, store = postprocess.evaluate_meshes(truth_meshes, result_meshes)
+        template_mesh = artifacts.mesh(stage.inputs["template"])
+        surface = None
+        if config.surface_metrics:
+            triangles = register_gbcpd.get_mesh_triangles(template_mesh)
+            surface = postprocess.evaluate_surfaces(truth_meshes, result_meshes, triangles, config.surface_tolerance, config.jobs)
+        return {stage.outputs[0]: (template_mesh, accumulator, store, surface)}
+
+
+def save_stage(stage: Stage, outputs: dict[Path, Any], artifacts: Artifacts) -> list[Path]:
+    """
+    Write the outputs of a stage as its own script would. A register stack takes its connectivity from the source
+    mesh, read from the artifacts.
+
+    :return: The files and directories written.
+    :rtype: list[Path]
+    """
+    config = stage.config
+    if stage.kind == "preprocess":
+        mesh_path, transform_path, lut_path = stage.outputs
+        preprocess.save_outputs(mesh_path.parent, outputs[mesh_path], outputs[transform_path], outputs[lut_path])
+    elif stage.kind == "augment":
+        augmented_meshes = outputs[stage.outputs[0]]
+        if config.output_format == "stack":
+            save_stack(stage.outputs[0], list(augmented_meshes), augmented_meshes.values())
+        else:
+            augment.save_meshes(augmented_meshes.values(), len(augmented_meshes), stage.outputs[0], config.writers, config.points_only)
+    elif stage.kind == "register":
+        output_dir = stage.outputs[0]
+        output_dir.mkdir(parents=True, exist_ok=True)
+        mapped_meshes = outputs[output_dir]
+        stack_writer = None
+        if config.output_format == "stack":
+            stack_writer = StackWriter(output_dir, artifacts.mesh(stage.inputs["source"]), list(mapped_meshes))
+        for name, mapped_mesh in mapped_meshes.items():
+            insertion_points_path = None
+            if config.extract_insertions:
+                suffix = "" if stage.inputs["target"].suffix == ".vtp" else f"_{name.removeprefix('mapped_')}"
+                insertion_points_path = output_dir.joinpath(f"insertions_points{suffix}.vtp")
+            register_gbcpd.save_mapped_mesh(mapped_mesh, output_dir.joinpath(f"{name}.vtp"), insertion_points_path, stack_writer)
+        if stack_writer is not None:
+            stack_writer.close()
+    else:
+        template_mesh, accumulator, store, surface = outputs[stage.outputs[0]]
+        postprocess.save_statistics(template_mesh, accumulator, store, stage.outputs[0], stage.config.plot, surface)
+    return [path for path in stage.outputs if path.exists()]
+
+
+def main(config: StudyConfig, force: bool = False):
+    output_dir = Path(config.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stages = link_stages([create_stage(study_stage, i) for i, study_stage in enumerate(config.stages)])
+    producers = {path: stage for stage in stages for path in stage.outputs}
+    for stage in stages:
+        stage.key = stage_key(stage, producers)
+
+    state = load_state(output_dir)
+    to_run = plan(stages, state, config.write_intermediates, force)
+    consumers = {stage.name: {other.name for other in stages if stage.name in other.dependencies} & to_run for stage in stages}
+    stages_by_name = {stage.name: stage for stage in stages}
+    artifacts = Artifacts()
+    for stage in stages:
+        if stage.name not in to_run:
+            continue
+        outputs = run_stage(stage, artifacts)
+        files = []
+        if config.write_intermediates or not consumers[stage.name]:
+            files = save_stage(stage, outputs, artifacts)
+        state[stage.name] = {"stage": stage.kind, "key": stage.key, "files": [path.as_posix() for path in files]}
+        save_state(state, output_dir)
+        # Outputs are kept in memory only until the last stage that reads them has run
+        if consumers[stage.name]:
+            for path, value in outputs.items():
+                artifacts[path] = value
+        for dependency in stage.dependencies:
+            consumers[dependency].discard(stage.name)
+            if not consumers[dependency]:
+                artifacts.discard(stages_by_name[dependency].outputs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the preprocess, augment, register and postprocess stages of a study in a single process.")
+    parser.add_argument("config", type=str, help="JSON study manifest")
+    parser.add_argument("--write-intermediates", action="store_true", help="Write the outputs of every stage (overrides the manifest)")
+    parser.add_argument("--force", action="store_true", help="Run every stage, even if its inputs have not changed")
+    args = parser.parse_args()
+    with open(args.config, "r") as f:
+        config = StudyConfig(**json.load(f))
+    if args.write_intermediates:
+        config.write_intermediates = True
+    main(config, force=args.force)
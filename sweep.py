@@ -0,0 +1,271 @@
+"""
+Search of the registration parameters (GBCPDConfig fields such as lambda_, beta, gamma, tau, K and J) on the
+augmented validation set: every configuration registers the template to the augmented meshes and is scored by
+the insertion errors of postprocess.py, the mean distance of the template's insertion nodes from where the
+augmentation put them.
+
+The configurations are every combination of the listed values (grid search) or drawn at random from values and
+ranges (random search). With min_targets, successive halving stops poor configurations early: every
+configuration is first registered to min_targets targets, and after each round only the best 1/eta go on to eta
+times as many targets, until the survivors have been registered to every target. Targets already registered
+by a configuration are not registered again in later rounds.
+
+The results are written after every round to output_dir/sweep_results.json and output_dir/sweep_results.csv,
+ranked by the mean error of the configurations registered to the most targets, with their time per target.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import math
+import time
+from dataclasses import dataclass, field, fields, replace
+from pathlib import Path
+
+import numpy as np
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+import postprocess
+import register_gbcpd
+import telemetry
+from config import GBCPDConfig, SweepConfig
+from postprocess import ErrorAccumulator
+from utils import read_vtp, save_json
+
+RESULTS_FILE = "sweep_results.json"
+TABLE_FILE = "sweep_results.csv"
+# GBCPDConfig fields naming the inputs and outputs of a registration, which the sweep sets itself
+NON_PARAMETER_FIELDS = {"source_mesh_file", "target_mesh_path", "output_dir", "pretransform_file"}
+
+
+@dataclass
+class Candidate:
+    """
+    :param name: Name of the configuration in the results
+    :type name: str
+    :param parameters: The searched fields and their values
+    :type parameters: dict
+    :param config: The registration configuration
+    :type config: GBCPDConfig
+    :param accumulator: Insertion errors of the targets registered so far
+    :type accumulator: ErrorAccumulator
+    :param target_errors: Mean insertion error of each target registered so far
+    :type target_errors: list[float]
+    :param seconds: Time spent registering the targets
+    :type seconds: float
+    :param rounds: Number of rounds the configuration took part in
+    :type rounds: int
+    :param error: The exception raised while registering or evaluating, if any
+    :type error: str | None
+    """
+
+    name: str
+    parameters: dict
+    config: GBCPDConfig
+    accumulator: ErrorAccumulator = field(default_factory=ErrorAccumulator)
+    target_errors: list[float] = field(default_factory=list)
+    seconds: float = 0.0
+    rounds: int = 0
+    error: str | None = None
+
+    @property
+    def score(self) -> float:
+        if self.error is not None or not self.target_errors:
+            return math.inf
+        return float(np.mean(self.target_errors))
+
+
+def load_register_config(register: str | dict) -> GBCPDConfig:
+    if isinstance(register, dict):
+        return GBCPDConfig(**register)
+    with open(register, "r") as f:
+        return GBCPDConfig(**json.load(f))
+
+
+def check_parameters(parameters: dict[str, list | dict]):
+    names = {f.name for f in fields(GBCPDConfig)} - NON_PARAMETER_FIELDS
+    unknown = sorted(set(parameters) - names)
+    if unknown:
+        raise ValueError(f"Not registration parameters: {', '.join(unknown)}")
+    empty = [name for name, values in parameters.items() if isinstance(values, list) and not values]
+    if empty:
+        raise ValueError(f"No values given for: {', '.join(empty)}")
+
+
+def grid_configurations(parameters: dict[str, list | dict]) -> list[dict]:
+    """
+    Every combination of the listed values, in the order of the lists.
+    """
+    ranges = [name for name, values in parameters.items() if not isinstance(values, list)]
+    if ranges:
+        raise ValueError(f"Grid search needs a list of values, not a range, for: {', '.join(ranges)}")
+    names = list(parameters)
+    return [dict(zip(names, values)) for values in itertools.product(*parameters.values())]
+
+
+def sample_value(values: list | dict, rng: np.random.Generator):
+    """
+    A value drawn uniformly from a list of values, or from a range {"low": ..., "high": ..., "log": ...}, on a
+    logarithmic scale with log. A range with integer bounds gives integers, other ranges values rounded to six
+    significant digits.
+    """
+    if isinstance(values, list):
+        return values[rng.integers(len(values))]
+    low, high = values["low"], values["high"]
+    if values.get("log", False):
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+    else:
+        value = rng.uniform(low, high)
+    if isinstance(low, int) and isinstance(high, int):
+        return int(round(value))
+    return float(f"{value:.6g}")
+
+
+def random_configurations(parameters: dict[str, list | dict], samples: int, rng: np.random.Generator) -> list[dict]:
+    return [{name: sample_value(values, rng) for name, values in parameters.items()} for _ in range(samples)]
+
+
+def get_rounds(num_targets: int, min_targets: int | None, eta: int) -> list[int]:
+    """
+    Number of targets registered by the configurations that reach each round of successive halving, the last
+    round covering every target.
+
+    :rtype: list[int]
+    """
+    if eta < 2:
+        raise ValueError(f"eta must be at least 2, not {eta}")
+    rounds = []
+    count = min_targets or num_targets
+    while count < num_targets:
+        rounds.append(count)
+        count *= eta
+    return rounds + [num_targets]
+
+
+def evaluate(
+    candidate: Candidate,
+    source_mesh: vtkPolyData,
+    target_meshes: dict[str, vtkPolyData],
+    pretransform_matrix: np.ndarray,
+):
+    """
+    Register the source mesh to further targets with a configuration and add their insertion errors to its
+    results. An exception is recorded in the candidate instead of being raised.
+    """
+    try:
+        start = time.perf_counter()
+        with telemetry.span("register", configuration=candidate.name, targets=len(target_meshes)):
+            mapped_meshes = register_gbcpd.register_meshes(candidate.config, source_mesh, target_meshes, pretransform_matrix)
+        candidate.seconds += time.perf_counter() - start
+        with telemetry.span("evaluate", configuration=candidate.name):
+            accumulator, store = postprocess.evaluate_meshes(target_meshes, mapped_meshes)
+    except Exception as error:
+        candidate.error = f"{type(error).__name__}: {error}"
+        return
+    candidate.accumulator.merge(accumulator)
+    # (targets, insertion nodes of all ligaments)
+    errors = np.concatenate([np.asarray(ligament_errors) for ligament_errors in store.errors.values()], axis=1)
+    candidate.target_errors.extend(errors.mean(axis=1).tolist())
+
+
+def rank(candidates: list[Candidate]) -> list[Candidate]:
+    """
+    Configurations registered to more targets first, then by mean error. Failed configurations come last.
+    """
+    return sorted(candidates, key=lambda candidate: (candidate.error is not None, -len(candidate.target_errors), candidate.score))
+
+
+def get_row(candidate: Candidate, position: int) -> dict:
+    row = {"rank": position, "name": candidate.name, "parameters": candidate.parameters}
+    row |= {"targets": len(candidate.target_errors), "rounds": candidate.rounds}
+    if candidate.target_errors and candidate.error is None:
+        row |= {
+            "mean_error": round(candidate.score, 6),
+            "std_error": round(float(np.std(candidate.target_errors)), 6),
+            "ligaments": {str(int(id)): round(float(mean), 6) for id, mean, _, _ in candidate.accumulator.aggregate_stats()},
+            "seconds_per_target": round(candidate.seconds / len(candidate.target_errors), 4),
+        }
+    if candidate.error is not None:
+        row["error"] = candidate.error
+    return row
+
+
+def save_results(output_dir: Path, config: SweepConfig, rounds: list[int], rows: list[dict]):
+    save_json({"search": config.search, "parameters": config.parameters, "rounds": rounds, "results": rows}, output_dir.joinpath(RESULTS_FILE))
+    names = list(config.parameters)
+    with open(output_dir.joinpath(TABLE_FILE), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["rank", "name", *names, "targets", "mean_error", "std_error", "seconds_per_target", "error"])
+        for row in rows:
+            values = [json.dumps(row["parameters"][name]) for name in names]
+            results = [row.get(column, "") for column in ("targets", "mean_error", "std_error", "seconds_per_target", "error")]
+            writer.writerow([row["rank"], row["name"], *values, *results])
+
+
+def print_table(rows: list[dict], names: list[str]):
+    widths = [max(len(name), 8) for name in names]
+    header = " ".join(f"{name:>{width}}" for name, width in zip(names, widths))
+    print(f"{'rank':>4} {'name':<6} {header} {'targets':>7} {'error':>10} {'std':>10} {'s/target':>9}")
+    for row in rows:
+        values = " ".join(f"{json.dumps(row['parameters'][name]):>{width}}" for name, width in zip(names, widths))
+        if "error" in row:
+            results = f"failed: {row['error']}"
+        else:
+            results = f"{row['mean_error']:>10.4f} {row['std_error']:>10.4f} {row['seconds_per_target']:>9.3f}"
+        print(f"{row['rank']:>4} {row['name']:<6} {values} {row['targets']:>7} {results}")
+
+
+def main(config: SweepConfig) -> list[dict]:
+    output_dir = Path(config.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    base_config = replace(load_register_config(config.register), jobs=config.jobs)
+    check_parameters(config.parameters)
+    rng = np.random.default_rng(config.seed)
+    if config.search == "grid":
+        parameter_sets = grid_configurations(config.parameters)
+    else:
+        parameter_sets = random_configurations(config.parameters, config.samples, rng)
+    candidates = [
+        Candidate(f"c{index:03d}", parameters, replace(base_config, **parameters)) for index, parameters in enumerate(parameter_sets)
+    ]
+
+    # Targets are taken in a random order, so that every round registers a random subset of the validation set
+    target_mesh_paths = register_gbcpd.get_target_mesh_paths(Path(base_config.target_mesh_path))
+    target_mesh_paths = [target_mesh_paths[i] for i in rng.permutation(len(target_mesh_paths))]
+    target_mesh_paths = target_mesh_paths[: config.max_targets]
+    rounds = get_rounds(len(target_mesh_paths), config.min_targets, config.eta)
+
+    source_mesh = read_vtp(base_config.source_mesh_file)
+    pretransform_matrix = register_gbcpd.load_pretransform_matrix(base_config)
+    active = candidates
+    registered = 0
+    rows = []
+    for index, count in enumerate(rounds):
+        with telemetry.span("read", round=index):
+            target_meshes = {path.stem: register_gbcpd.read_target_mesh(path) for path in target_mesh_paths[registered:count]}
+        for candidate in active:
+            evaluate(candidate, source_mesh, target_meshes, pretransform_matrix)
+            candidate.rounds = index + 1
+        registered = count
+        active = [candidate for candidate in rank(active) if candidate.error is None]
+        if index < len(rounds) - 1:
+            active = active[: max(1, math.ceil(len(active) / config.eta))]
+        rows = [get_row(candidate, position) for position, candidate in enumerate(rank(candidates), start=1)]
+        save_results(output_dir, config, rounds, rows)
+        telemetry.record("round", round=index, targets=count, configurations=len(active))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Searches registration parameters on the augmented validation set.")
+    parser.add_argument("config", type=str, help="JSON configuration file")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of targets registered concurrently (overrides the configuration)")
+    args = parser.parse_args()
+    with open(args.config, "r") as f:
+        config = SweepConfig(**json.load(f))
+    if args.jobs is not None:
+        config.jobs = args.jobs
+    with telemetry.session(config.telemetry_log, "sweep", config.profile):
+        rows = main(config)
+    print_table(rows, list(config.parameters))
@@ -0,0 +1,205 @@
+"""
+Timings and resource use of a run, recorded as JSON lines.
+
+A script enables recording for the duration of its run with session(). Code then times its steps with
+span("read", target=...) and adds records (e.g. bcpd's own timing output) with record(); spans inherit the
+target of the span they run in. Outside a session both are no-ops. When the session ends, a summary record with
+the count, total, p50 and p95 duration of every stage, the peak resident memory and the I/O volume is appended
+to the log and also written next to it as <log>_summary.json.
+
+With profile set to "cprofile" the main thread is profiled into <log>.prof; with "tracemalloc" the largest
+allocation sites are written to <log>_tracemalloc.txt.
+"""
+
+import cProfile
+import json
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; the peak memory is then not recorded
+    resource = None
+
+# Number of allocation sites written by the tracemalloc profile
+TRACEMALLOC_TOP = 25
+
+_recorder: "Recorder | None" = None
+_target: ContextVar[str | None] = ContextVar("target", default=None)
+
+
+class Recorder:
+    """
+    Appends records to a JSON-lines file and keeps the durations of every stage for the summary. Records may be
+    added from any thread.
+    """
+
+    def __init__(self, log_path: Path, run: str):
+        self.log_path = log_path
+        self.run = run
+        self.start = time.perf_counter()
+        self.durations: dict[str, list[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(log_path, "a")
+
+    def record(self, event: str, **fields):
+        data = {"time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), "run": self.run, "event": event}
+        data |= {key: value for key, value in fields.items() if value is not None}
+        line = json.dumps(data, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def add_span(self, stage: str, seconds: float, **fields):
+        with self._lock:
+            self.durations[stage].append(seconds)
+        self.record("span", stage=stage, seconds=round(seconds, 6), **fields)
+
+    def summary(self) -> dict:
+        stages = {}
+        with self._lock:
+            for stage, durations in self.durations.items():
+                p50, p95 = np.percentile(durations, [50, 95])
+                stages[stage] = {
+                    "count": len(durations),
+                    "total": round(sum(durations), 6),
+                    "p50": round(float(p50), 6),
+                    "p95": round(float(p95), 6),
+                    "max": round(max(durations), 6),
+                }
+        return {"seconds": round(time.perf_counter() - self.start, 6), "stages": stages} | resource_usage()
+
+    def close(self) -> dict:
+        summary = self.summary()
+        self.record("summary", **summary)
+        self._file.close()
+        with open(self.log_path.with_name(f"{self.log_path.stem}_summary.json"), "w") as f:
+            json.dump({"run": self.run} | summary, f, indent=4)
+        return summary
+
+
+def resource_usage() -> dict:
+    """
+    Peak resident memory of this process and of its largest finished child process (e.g. bcpd), and the bytes
+    this process read and wrote, where the platform reports them.
+    """
+    usage = {}
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux
+        usage["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        usage["peak_child_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    io_file = Path("/proc/self/io")
+    if io_file.is_file():
+        counters = dict(line.split(": ") for line in io_file.read_text().splitlines())
+        usage["read_bytes"] = int(counters["rchar"])
+        usage["write_bytes"] = int(counters["wchar"])
+    return usage
+
+
+@contextmanager
+def session(log_file: str | None, run: str, profile: Literal["cprofile", "tracemalloc"] | None = None) -> Iterator[None]:
+    """
+    Record the spans of a run into log_file. Nothing is recorded if log_file is None.
+
+    :param log_file: Path to the JSON-lines log, appended to (if None nothing is recorded).
+    :type log_file: str | None
+    :param run: Name of the run in every record, e.g. the script name.
+    :type run: str
+    :param profile: Profiler run for the duration of the session, its output written next to log_file.
+    :type profile: Literal["cprofile", "tracemalloc"] | None
+    """
+    global _recorder
+    if log_file is None:
+        yield
+        return
+    log_path = Path(log_file)
+    _recorder = Recorder(log_path, run)
+    profiler = None
+    if profile == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile == "tracemalloc":
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(log_path.with_suffix(".prof"))
+        elif profile == "tracemalloc":
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = [f"Peak traced memory: {peak / 2**20:.1f} MB"]
+            lines.extend(str(statistic) for statistic in snapshot.statistics("lineno")[:TRACEMALLOC_TOP])
+            log_path.with_name(f"{log_path.stem}_tracemalloc.txt").write_text("\n".join(lines) + "\n")
+        recorder, _recorder = _recorder, None
+        recorder.close()
+
+
+def enabled() -> bool:
+    return _recorder is not None
+
+
+@contextmanager
+def span(stage: str, target: str | None = None, **fields) -> Iterator[None]:
+    """
+    Time the enclosed block as one occurrence of stage. Records and spans inside it inherit its target.
+    """
+    if _recorder is None:
+        yield
+        return
+    token = _target.set(target) if target is not None else None
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as exception:
+        error = type(exception).__name__
+        raise
+    finally:
+        if token is not None:
+            _target.reset(token)
+        _recorder.add_span(stage, time.perf_counter() - start, target=target or _target.get(), error=error, **fields)
+
+
+def add_span(stage: str, seconds: float, target: str | None = None, **fields):
+    """
+    Record a duration measured elsewhere, e.g. in a worker process.
+    """
+    if _recorder is not None:
+        _recorder.add_span(stage, seconds, target=target or _target.get(), **fields)
+
+
+def record(event: str, **fields):
+    if _recorder is not None:
+        _recorder.record(event, target=fields.pop("target", None) or _target.get(), **fields)
+
+
+def parse_bcpd_output(filepath: Path) -> dict[str, float | str]:
+    """
+    Key-value lines of bcpd's output_info.txt or output_comptime.txt. A line's last field is its value and the
+    fields before it its key.
+    """
+    values = {}
+    for line in filepath.read_text().splitlines():
+        fields = line.replace(":", " ").split()
+        if len(fields) < 2:
+            continue
+        key = " ".join(fields[:-1])
+        try:
+            values[key] = float(fields[-1])
+        except ValueError:
+            values[key] = fields[-1]
+    return values
@@ -1,13 +1,21 @@
 import json
 from pathlib import Path
 
-import vtkmodules.all as vtk
+import numpy as np
+from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+from vtkmodules.vtkCommonCore import VTK_ID_TYPE, vtkDataArray, vtkPoints
+from vtkmodules.vtkCommonDataModel import vtkCellArray, vtkPolyData
+from vtkmodules.vtkIOGeometry import vtkSTLReader
+from vtkmodules.vtkIOXML import vtkXMLPolyDataReader, vtkXMLPolyDataWriter
+
+# Rows transformed at a time by transform_points, which bounds the size of its scratch buffer
+TRANSFORM_BLOCK = 65536
 
 
 def read_stl(filepath: Path | str):
     if not Path(filepath).exists():
         raise FileNotFoundError(f"File not found: {filepath}")
-    reader = vtk.vtkSTLReader()
+    reader = vtkSTLReader()
     reader.SetFileName(Path(filepath).as_posix())
     reader.Update()
     return reader.GetOutput()
@@ -16,14 +24,14 @@ def read_stl(filepath: Path | str):
 def read_vtp(filepath: Path | str):
     if not Path(filepath).exists():
         raise FileNotFoundError(f"File not found: {filepath}")
-    reader = vtk.vtkXMLPolyDataReader()
+    reader = vtkXMLPolyDataReader()
     reader.SetFileName(Path(filepath).as_posix())
     reader.Update()
     return reader.GetOutput()
 
 
-def save_vtp(poly: vtk.vtkPolyData, filepath: Path | str):
-    writer = vtk.vtkXMLPolyDataWriter()
+def save_vtp(poly: vtkPolyData, filepath: Path | str):
+    writer = vtkXMLPolyDataWriter()
     writer.SetFileName(Path(filepath).as_posix())
     writer.SetInputData(poly)
     writer.Write()
@@ -32,3 +40,139 @@ def save_vtp(poly: vtk.vtkPolyData, filepath: Path | str):
 def save_json(data: dict, filepath: Path | str):
     with open(Path(filepath).as_posix(), "w") as f:
         json.dump(data, f, indent=4)
+
+
+def numpy_to_points(points: np.ndarray) -> vtkPoints:
+    """
+    vtkPoints sharing the memory of an (N, 3) float32 or float64 array, which is copied only if it is not contiguous.
+    """
+    vtk_points = vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(np.ascontiguousarray(points), deep=False))
+    return vtk_points
+
+
+def numpy_to_cells(connectivity: np.ndarray) -> vtkCellArray:
+    """
+    Cell array of (C, K) cells of K points each, e.g. K=1 for vertices or K=3 for triangles, set from offset and
+    connectivity arrays in one call.
+    """
+    connectivity = np.ascontiguousarray(connectivity, dtype=np.int64)
+    num_cells, cell_size = connectivity.shape
+    offsets = np.arange(0, (num_cells + 1) * cell_size, cell_size, dtype=np.int64)
+    cells = vtkCellArray()
+    cells.SetData(
+        numpy_to_vtk(offsets, deep=False, array_type=VTK_ID_TYPE),
+        numpy_to_vtk(connectivity.ravel(), deep=False, array_type=VTK_ID_TYPE),
+    )
+    return cells
+
+
+def numpy_to_array(values: np.ndarray, name: str) -> vtkDataArray:
+    """
+    Named VTK array sharing the memory of a NumPy array. Integer arrays become vtkIdType arrays, like InsertionID.
+    """
+    values = np.ascontiguousarray(values)
+    if np.issubdtype(values.dtype, np.integer):
+        array = numpy_to_vtk(values.astype(np.int64, copy=False), deep=False, array_type=VTK_ID_TYPE)
+    else:
+        array = numpy_to_vtk(values, deep=False)
+    array.SetName(name)
+    return array
+
+
+def numpy_to_polydata(
+    points: np.ndarray,
+    verts: bool = False,
+    triangles: np.ndarray | None = None,
+    point_data: dict[str, np.ndarray] | None = None,
+) -> vtkPolyData:
+    """
+    Polydata built from NumPy arrays without per-point calls.
+
+    :param points: (N, 3) points.
+    :type points: np.ndarray
+    :param verts: Whether to add a vertex cell per point, e.g. for point clouds.
+    :type verts: bool
+    :param triangles: (F, 3) zero-based triangles (if None the polydata has no polygons).
+    :type triangles: np.ndarray | None
+    :param point_data: Point data arrays by name, each with a value (or row of values) per point.
+    :type point_data: dict[str, np.ndarray] | None
+
+    :return: The polydata.
+    :rtype: vtkPolyData
+    """
+    poly = vtkPolyData()
+    poly.SetPoints(numpy_to_points(points))
+    if verts:
+        poly.SetVerts(numpy_to_cells(np.arange(points.shape[0]).reshape(-1, 1)))
+    if triangles is not None:
+        poly.SetPolys(numpy_to_cells(triangles))
+    for name, values in (point_data or {}).items():
+        poly.GetPointData().AddArray(numpy_to_array(values, name))
+    return poly
+
+
+def apply_matrix(points: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """
+    (N, 3) points transformed by a 4x4 homogeneous matrix, without a projective part.
+    """
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def transform_points(points: np.ndarray, matrix: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    """
+    (N, 3) points transformed by a 4x4 homogeneous matrix, without a projective part, written to out, which may be
+    points itself. The points go through a float64 scratch buffer TRANSFORM_BLOCK rows at a time, so that no
+    temporary array the size of the points is allocated.
+
+    :param points: (N, 3) points.
+    :type points: np.ndarray
+    :param matrix: The 4x4 matrix.
+    :type matrix: np.ndarray
+    :param out: (N, 3) array receiving the result (if None a new array of the points' type).
+    :type out: np.ndarray | None
+
+    :return: out.
+    :rtype: np.ndarray
+    """
+    if out is None:
+        out = np.empty_like(points)
+    rotation, translation = matrix[:3, :3].T, matrix[:3, 3]
+    scratch = np.empty((min(points.shape[0], TRANSFORM_BLOCK), 3), dtype=np.float64)
+    for start in range(0, points.shape[0], TRANSFORM_BLOCK):
+        stop = min(start + TRANSFORM_BLOCK, points.shape[0])
+        block = scratch[: stop - start]
+        np.matmul(points[start:stop], rotation, out=block)
+        block += translation
+        out[start:stop] = block
+    return out
+
+
+def transform_mesh(poly: vtkPolyData, matrix: np.ndarray, inplace: bool = False) -> vtkPolyData:
+    """
+    Mesh with its points transformed by a 4x4 homogeneous matrix. Unlike vtkTransformPolyDataFilter, which copies
+    the mesh and every point data array, only the coordinates are written; vector point data such as normals are
+    not transformed.
+
+    :param poly: The mesh.
+    :type poly: vtkPolyData
+    :param matrix: The 4x4 matrix.
+    :type matrix: np.ndarray
+    :param inplace: Whether to overwrite the points of the mesh, which is returned (and left as it is by an
+        identity matrix). Otherwise the result is a shallow copy of the mesh, sharing its connectivity and point
+        data, with a new points array of the same type.
+    :type inplace: bool
+
+    :return: The transformed mesh.
+    :rtype: vtkPolyData
+    """
+    points = vtk_to_numpy(poly.GetPoints().GetData())
+    if inplace:
+        if not np.array_equal(matrix, np.eye(4)):
+            transform_points(points, matrix, out=points)
+            poly.GetPoints().Modified()
+        return poly
+    mesh = vtkPolyData()
+    mesh.ShallowCopy(poly)
+    mesh.SetPoints(numpy_to_points(transform_points(points, matrix)))
+    return mesh
@@ -0,0 +1,198 @@
+"""
+Warm starts of a batch registration: each target is registered starting from the template already deformed
+onto a similar target, instead of from the undeformed template, so that the VB loop has less left to do.
+
+The targets are ordered by a cheap shape descriptor, as a chain of nearest neighbours starting from the target
+most similar to the template, so that each target follows one it resembles. Depending on the mode, a target
+starts from:
+
+- "sequential": the result of the target before it in that order.
+- "nearest": the result of the most similar target registered so far.
+- "previous": its own result from a previous run in the output directory, e.g. with other parameters.
+
+When that result is not available (a target whose predecessor is still being registered by another job, or one
+without a previous result), the most similar of the recently registered targets is used instead, and the
+undeformed template when there is none.
+"""
+
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Literal
+
+import numpy as np
+
+# Number of registered results kept in memory as starting shapes
+WARM_START_POOL = 16
+
+
+def shape_descriptor(points: np.ndarray) -> np.ndarray:
+    """
+    Descriptor of the position, extent and orientation of a point set, in its length units: its centroid, the
+    signed square roots of the entries of its covariance and the deciles of the distances from the centroid.
+    It does not depend on the number or order of the points.
+
+    :param points: (N, 3) points.
+    :type points: np.ndarray
+
+    :return: The (18,) descriptor.
+    :rtype: np.ndarray
+    """
+    points = np.asarray(points, dtype=np.float64)
+    centroid = points.mean(axis=0)
+    centered = points - centroid
+    covariance = (centered.T @ centered / points.shape[0])[np.triu_indices(3)]
+    deciles = np.percentile(np.linalg.norm(centered, axis=1), np.arange(10, 100, 10))
+    return np.concatenate([centroid, np.sign(covariance) * np.sqrt(np.abs(covariance)), deciles])
+
+
+def order_targets(descriptors: np.ndarray, start: np.ndarray) -> list[int]:
+    """
+    Order targets as a chain of nearest neighbours: the target nearest to start first, then repeatedly the
+    nearest remaining target to the last one.
+
+    :param descriptors: (T, D) descriptors of the targets.
+    :type descriptors: np.ndarray
+    :param start: (D,) descriptor the chain starts from, e.g. the template's.
+    :type start: np.ndarray
+
+    :return: The indices of the targets in chain order.
+    :rtype: list[int]
+    """
+    remaining = np.ones(len(descriptors), dtype=bool)
+    order = []
+    current = start
+    for _ in range(len(descriptors)):
+        distances = np.linalg.norm(descriptors - current, axis=1)
+        distances[~remaining] = np.inf
+        index = int(np.argmin(distances))
+        order.append(index)
+        remaining[index] = False
+        current = descriptors[index]
+    return order
+
+
+class WarmStarts:
+    """
+    Starting shapes for the targets of a batch registration, taken from the results registered so far, and the
+    record of how each target started and how many VB loops it took. Targets are started and finished from the
+    registration threads.
+
+    :param mode: Which result a target starts from, see the module documentation.
+    :type mode: Literal["previous", "nearest", "sequential"]
+    :param descriptors: Shape descriptors of the targets by name, in registration order.
+    :type descriptors: dict[str, np.ndarray]
+    :param load_previous: Returns a target's result from a previous run, or None ("previous" mode only).
+    :type load_previous: Callable[[str], np.ndarray | None] | None
+    :param check: Number of warm-started targets also registered from the template, to measure the loops saved
+        and the difference between warm and cold results.
+    :type check: int
+    """
+
+    def __init__(
+        self,
+        mode: Literal["previous", "nearest", "sequential"],
+        descriptors: dict[str, np.ndarray],
+        load_previous: Callable[[str], np.ndarray | None] | None = None,
+        check: int = 0,
+    ):
+        self.mode = mode
+        self.descriptors = descriptors
+        self.load_previous = load_previous
+        self.checks_left = check
+        names = list(descriptors)
+        self.predecessors = dict(zip(names[1:], names[:-1]))
+        self.results: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.records: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def _find(self, name: str) -> tuple[np.ndarray | None, str | None]:
+        if self.mode == "previous" and self.load_previous is not None:
+            points = self.load_previous(name)
+            if points is not None:
+                return points, "previous"
+        descriptor = self.descriptors[name]
+        with self._lock:
+            predecessor = self.predecessors.get(name)
+            if self.mode == "sequential" and predecessor in self.results:
+                source = predecessor
+            elif self.results:
+                source = min(self.results, key=lambda other: np.linalg.norm(self.descriptors[other] - descriptor))
+            else:
+                return None, None
+            return self.results[source], source
+
+    def start(self, name: str) -> tuple[np.ndarray | None, bool]:
+        """
+        The starting shape of a target.
+
+        :return: The (M, 3) starting points, or None to start from the template, and whether the target should
+            also be registered from the template for comparison.
+        :rtype: tuple[np.ndarray | None, bool]
+        """
+        points, source = self._find(name)
+        record = {"start": source or "template"}
+        if source not in (None, "previous"):
+            record["descriptor_distance"] = round(float(np.linalg.norm(self.descriptors[source] - self.descriptors[name])), 6)
+        with self._lock:
+            check = points is not None and self.checks_left > 0
+            self.checks_left -= check
+            self.records[name] = record
+        return points, check
+
+    def finish(
+        self,
+        name: str,
+        points: np.ndarray,
+        iterations: int | None,
+        cold_iterations: int | None = None,
+        cold_difference: float | None = None,
+    ):
+        """
+        Record the registration of a target and keep its registered points (before the pretransform is undone)
+        as a starting shape.
+
+        :param name: Name of the target.
+        :type name: str
+        :param points: (M, 3) registered points.
+        :type points: np.ndarray
+        :param iterations: Number of VB loops run, if known.
+        :type iterations: int | None
+        :param cold_iterations: Number of VB loops run from the template, for checked targets.
+        :type cold_iterations: int | None
+        :param cold_difference: Root mean square distance between the warm and cold results, for checked targets.
+        :type cold_difference: float | None
+        """
+        if cold_difference is not None:
+            cold_difference = round(cold_difference, 6)
+        fields = {"iterations": iterations, "cold_iterations": cold_iterations, "cold_difference": cold_difference}
+        with self._lock:
+            self.records[name] |= {key: value for key, value in fields.items() if value is not None}
+            self.results[name] = np.array(points, dtype=np.float32)
+            while len(self.results) > WARM_START_POOL:
+                self.results.popitem(last=False)
+
+    def report(self) -> dict:
+        """
+        How each target started and the loops it took, with a summary: the mean loops of warm- and cold-started
+        targets and, over the checked targets, the loops saved and the differences from the cold results.
+        """
+        with self._lock:
+            records = {name: dict(record) for name, record in self.records.items()}
+        warm = [record for record in records.values() if record["start"] != "template"]
+        cold = [record for record in records.values() if record["start"] == "template"]
+        checked = [record for record in warm if "cold_iterations" in record and "iterations" in record]
+        summary = {"mode": self.mode, "warm_started": len(warm), "cold_started": len(cold)}
+        for label, group in (("warm", warm), ("cold", cold)):
+            iterations = [record["iterations"] for record in group if "iterations" in record]
+            if iterations:
+                summary[f"mean_{label}_iterations"] = round(float(np.mean(iterations)), 2)
+        if checked:
+            differences = [record["cold_difference"] for record in checked]
+            summary |= {
+                "checked": len(checked),
+                "iterations_saved": int(sum(record["cold_iterations"] - record["iterations"] for record in checked)),
+                "mean_cold_difference": round(float(np.mean(differences)), 6),
+                "max_cold_difference": round(float(np.max(differences)), 6),
+            }
+        return {"summary": summary, "targets": records}
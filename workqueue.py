@@ -0,0 +1,496 @@
+"""
+Distributed batch registration: any number of worker processes, on any nodes sharing a file system (e.g. NFS),
+register the targets of one register.py configuration by claiming them from a queue kept in its output directory.
+Each target is registered by one worker, and its outputs are written to output_dir exactly as register.py writes
+them. The queue is kept in output_dir/queue:
+
+- claims/<target>.claim: the worker registering the target. Claims are created with a hard link, which is atomic
+  on NFS as well, so only one worker gets each target. A worker touches its claims every heartbeat seconds. A claim
+  that has not been touched for stale_after seconds belongs to a worker that died, and the next worker that finds it
+  takes the target over. Ages are measured on the file server's clock, so the clocks of the nodes need not agree.
+- done/<target>.json: the manifest record of a completed or failed target, written atomically.
+- workers/<worker>.json: the host, process and counts of each worker, touched with its claims, and when it stopped.
+
+A worker stops once every target is done, waiting for the targets claimed by other workers so that it can take
+them over if their worker dies. The status command reports the progress of the queue, and the collect command
+merges the done records into output_dir/manifest.json, from which register.py resumes.
+"""
+
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+from collections.abc import Iterator
+from datetime import datetime, timezone
+from pathlib import Path
+from tempfile import mkstemp
+
+import numpy as np
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+import telemetry
+from config import GBCPDConfig
+from register_gbcpd import (
+    bcpd,
+    get_alignment_points,
+    get_target_hash,
+    get_target_mesh_paths,
+    insertion_points_path,
+    iter_prepared_targets,
+    load_pretransform_matrix,
+    mapped_mesh_path,
+    register_all,
+    restore_cached_result,
+    save_mapped_mesh,
+    undo_pretransform,
+)
+from result_cache import Manifest, ResultCache, backend_version, file_hash, manifest_record, result_key
+from streaming import BoundedExecutor
+from utils import read_vtp
+
+QUEUE_DIR = "queue"
+# Seconds between the touches of a worker's claims
+HEARTBEAT = 30.0
+# Seconds after the last touch at which a claim is taken over
+STALE_AFTER = 300.0
+
+
+def _write_json(data: dict, filepath: Path):
+    # Written next to its destination and renamed, so that readers never see a partial file
+    fid, filename = mkstemp(suffix=".tmp", dir=filepath.parent)
+    with os.fdopen(fid, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(filename, filepath)
+
+
+def _read_json(filepath: Path) -> dict | None:
+    try:
+        with open(filepath, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def default_worker() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    The claims, done records and worker records of a queue directory, as seen by one worker, with a background
+    thread touching the worker's claims while it is used as a context manager.
+
+    :param directory: The queue directory.
+    :type directory: Path
+    :param worker: Name of this worker, unique across the nodes.
+    :type worker: str
+    :param heartbeat: Seconds between the touches of the worker's claims.
+    :type heartbeat: float
+    """
+
+    def __init__(self, directory: Path, worker: str, heartbeat: float = HEARTBEAT):
+        self.directory = Path(directory)
+        self.worker = worker
+        self.heartbeat = heartbeat
+        self.claims_dir = self.directory.joinpath("claims")
+        self.done_dir = self.directory.joinpath("done")
+        self.workers_dir = self.directory.joinpath("workers")
+        for directory in (self.claims_dir, self.done_dir, self.workers_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+        self.worker_file = self.workers_dir.joinpath(f"{worker}.json")
+        self.info = {
+            "worker": worker,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "completed": 0,
+            "failed": 0,
+            "cached": 0,
+        }
+        self.held: set[str] = set()
+        self.lost: set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        _write_json(self.info, self.worker_file)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._beat, name="heartbeat", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        for name in list(self.held):
+            self.release(name)
+        with self._lock:
+            self.info["stopped"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+            info = dict(self.info)
+        _write_json(info, self.worker_file)
+
+    def claim_path(self, name: str) -> Path:
+        return self.claims_dir.joinpath(f"{name}.claim")
+
+    def done_path(self, name: str) -> Path:
+        return self.done_dir.joinpath(f"{name}.json")
+
+    def now(self) -> float:
+        """
+        The current time on the file server's clock, read back from the worker file after touching it.
+        """
+        os.utime(self.worker_file)
+        return self.worker_file.stat().st_mtime
+
+    def _link(self, filepath: Path) -> bool:
+        """
+        Create a file holding this worker's name, unless it exists.
+        """
+        temporary = filepath.with_name(f".{filepath.name}.{self.worker}.tmp")
+        temporary.write_text(json.dumps({"worker": self.worker, "host": self.info["host"], "pid": self.info["pid"]}))
+        try:
+            os.link(temporary, filepath)
+            return True
+        except FileExistsError:
+            return False
+        except OSError:
+            # Over NFS a link can succeed although its reply was lost, which the link count shows
+            return temporary.stat().st_nlink == 2
+        finally:
+            temporary.unlink(missing_ok=True)
+
+    def _is_stale(self, filepath: Path, stale_after: float) -> bool:
+        try:
+            return self.now() - filepath.stat().st_mtime > stale_after
+        except FileNotFoundError:
+            return False
+
+    def claim(self, name: str, stale_after: float = STALE_AFTER) -> bool:
+        """
+        Claim a target for this worker, taking it over if its claim is stale.
+
+        :return: Whether the worker now holds the claim.
+        :rtype: bool
+        """
+        filepath = self.claim_path(name)
+        claimed = self._link(filepath)
+        if not claimed and self._is_stale(filepath, stale_after):
+            # The workers finding a stale claim agree on which of them replaces it through a second, short-lived claim
+            takeover = filepath.with_suffix(".takeover")
+            if self._link(takeover) or self._is_stale(takeover, stale_after):
+                try:
+                    if self._is_stale(filepath, stale_after):
+                        filepath.unlink(missing_ok=True)
+                        claimed = self._link(filepath)
+                finally:
+                    takeover.unlink(missing_ok=True)
+        if claimed:
+            with self._lock:
+                self.held.add(name)
+                self.lost.discard(name)
+        return claimed
+
+    def owns(self, name: str) -> bool:
+        """
+        Whether this worker still holds its claim of a target, i.e. it was not taken over.
+        """
+        record = _read_json(self.claim_path(name))
+        with self._lock:
+            return name in self.held and name not in self.lost and record is not None and record["worker"] == self.worker
+
+    def release(self, name: str):
+        if self.owns(name):
+            self.claim_path(name).unlink(missing_ok=True)
+        with self._lock:
+            self.held.discard(name)
+
+    def finish(self, name: str, record: dict):
+        """
+        Record a target as done and release its claim.
+        """
+        _write_json(record | {"worker": self.worker}, self.done_path(name))
+        self.release(name)
+        with self._lock:
+            if record.get("cached"):
+                self.info["cached"] += 1
+            else:
+                self.info[record["status"]] += 1
+            info = dict(self.info)
+        _write_json(info, self.worker_file)
+
+    def done_record(self, name: str) -> dict | None:
+        return _read_json(self.done_path(name))
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            os.utime(self.worker_file)
+            with self._lock:
+                held = list(self.held)
+            for name in held:
+                record = _read_json(self.claim_path(name))
+                if record is None or record["worker"] != self.worker:
+                    with self._lock:
+                        self.lost.add(name)
+                    continue
+                try:
+                    os.utime(self.claim_path(name))
+                except FileNotFoundError:
+                    with self._lock:
+                        self.lost.add(name)
+
+
+def get_run_key(config: GBCPDConfig) -> str:
+    """
+    Key of everything but the target that determines a registration result, stored in the done records so that
+    records of another configuration are not counted as done.
+    """
+    return result_key(file_hash(config.source_mesh_file), "", config, load_pretransform_matrix(config), backend_version(config, bcpd))
+
+
+def is_done(record: dict | None, key: str, retry_failed: bool = False) -> bool:
+    if record is None or record["key"] != key:
+        return False
+    return record["status"] == "completed" or not retry_failed
+
+
+def run_worker(
+    config: GBCPDConfig,
+    worker: str,
+    heartbeat: float = HEARTBEAT,
+    stale_after: float = STALE_AFTER,
+    retry_failed: bool = False,
+) -> dict:
+    """
+    Register the targets of a configuration claimed from its queue until every target is done.
+
+    :param config: The registration configuration, shared by all workers.
+    :type config: GBCPDConfig
+    :param worker: Name of this worker, unique across the nodes.
+    :type worker: str
+    :param heartbeat: Seconds between the touches of the worker's claims, and between its scans for targets
+        claimed by other workers.
+    :type heartbeat: float
+    :param stale_after: Seconds after the last touch at which the claim of another worker is taken over.
+    :type stale_after: float
+    :param retry_failed: Whether to register targets that failed again.
+    :type retry_failed: bool
+
+    :return: The numbers of targets this worker completed, failed and restored from the cache.
+    :rtype: dict
+    """
+    if config.output_format != "vtp":
+        raise ValueError("Distributed registration writes one mesh file per target, output_format must be 'vtp'")
+    if config.warm_start is not None:
+        raise ValueError("Distributed registration does not support warm_start")
+    output_dir = Path(config.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    target_mesh_paths = get_target_mesh_paths(Path(config.target_mesh_path))
+    cache = ResultCache(config.cache_dir) if config.cache_dir is not None else None
+    source_hash = file_hash(config.source_mesh_file)
+    version = backend_version(config, bcpd)
+    pretransform_matrix = load_pretransform_matrix(config)
+    inverse_matrix = np.linalg.inv(pretransform_matrix)
+    run_key = get_run_key(config)
+    source_mesh = read_vtp(config.source_mesh_file)
+    align_to = get_alignment_points(config, source_mesh)
+    keys = {}
+    # Targets claimed by this worker, which it does not register twice, even with retry_failed
+    attempted = set()
+
+    def get_outputs(target_mesh_filename: Path) -> list[Path]:
+        outputs = [mapped_mesh_path(output_dir, target_mesh_filename)]
+        if config.extract_insertions:
+            outputs.append(insertion_points_path(config, target_mesh_filename))
+        return outputs
+
+    def get_record(target_mesh_filename: Path, status: str, **fields) -> dict:
+        return manifest_record(keys[target_mesh_filename], target_mesh_filename, status, run=run_key, **fields)
+
+    with WorkQueue(output_dir.joinpath(QUEUE_DIR), worker, heartbeat) as queue:
+
+        def claim_targets() -> Iterator[Path]:
+            while True:
+                waiting = False
+                for path in target_mesh_paths:
+                    if path not in keys:
+                        keys[path] = result_key(source_hash, get_target_hash(path), config, pretransform_matrix, version)
+                    if path in attempted or is_done(queue.done_record(path.stem), keys[path], retry_failed):
+                        continue
+                    elif not queue.claim(path.stem, stale_after):
+                        waiting = True
+                        continue
+                    attempted.add(path)
+                    # Another worker may have finished the target between the check and the claim
+                    if is_done(queue.done_record(path.stem), keys[path], retry_failed):
+                        queue.release(path.stem)
+                    elif cache is not None and cache.contains(keys[path]):
+                        with telemetry.span("restore", target=path.stem):
+                            restore_cached_result(cache, keys[path], get_outputs(path)[0], insertion_points_path(config, path))
+                        queue.finish(path.stem, get_record(path, "completed", outputs=[p.as_posix() for p in get_outputs(path)], cached=True))
+                    else:
+                        yield path
+                if not waiting:
+                    return
+                time.sleep(heartbeat)
+
+        def write_target(target_mesh_filename: Path, mapped_mesh: vtkPolyData):
+            name = target_mesh_filename.stem
+            # A target taken over by another worker is written by that worker
+            if not queue.owns(name):
+                queue.release(name)
+                return
+            outputs = get_outputs(target_mesh_filename)
+            try:
+                with telemetry.span("map", target=name):
+                    mapped_mesh = undo_pretransform(mapped_mesh, inverse_matrix)
+                with telemetry.span("write", target=name):
+                    save_mapped_mesh(mapped_mesh, outputs[0], insertion_points_path(config, target_mesh_filename))
+                    if cache is not None:
+                        cache.store(keys[target_mesh_filename], outputs[0])
+            except Exception as error:
+                queue.finish(name, get_record(target_mesh_filename, "failed", error=f"{type(error).__name__}: {error}"))
+            else:
+                queue.finish(name, get_record(target_mesh_filename, "completed", outputs=[p.as_posix() for p in outputs], cached=False))
+
+        with BoundedExecutor(workers=1, backlog=config.prefetch, name="writer") as writer:
+
+            def on_result(target_mesh_filename: Path, mapped_mesh: vtkPolyData | None, error: Exception | None):
+                if error is None:
+                    writer.submit(write_target, target_mesh_filename, mapped_mesh)
+                elif queue.owns(target_mesh_filename.stem):
+                    queue.finish(target_mesh_filename.stem, get_record(target_mesh_filename, "failed", error=f"{type(error).__name__}: {error}"))
+
+            register_all(
+                config,
+                source_mesh,
+                lambda run_dir: iter_prepared_targets(claim_targets(), run_dir, config, align_to),
+                len(target_mesh_paths),
+                on_result,
+            )
+        return {key: queue.info[key] for key in ("completed", "failed", "cached")}
+
+
+def queue_status(config: GBCPDConfig, stale_after: float = STALE_AFTER) -> dict:
+    """
+    Progress of the queue of a configuration: the number of targets completed, failed, being registered, held by
+    stale claims and not yet claimed, the failed targets and the workers. Done records of another configuration
+    count as pending.
+
+    :rtype: dict
+    """
+    output_dir = Path(config.output_dir)
+    queue_dir = output_dir.joinpath(QUEUE_DIR)
+    run_key = get_run_key(config)
+    names = [path.stem for path in get_target_mesh_paths(Path(config.target_mesh_path))]
+    # The file server's clock, read from a file touched in the queue directory
+    queue_dir.mkdir(parents=True, exist_ok=True)
+    fid, clock_file = mkstemp(dir=queue_dir)
+    os.close(fid)
+    now = os.stat(clock_file).st_mtime
+    os.unlink(clock_file)
+
+    counts = dict.fromkeys(["completed", "failed", "running", "stale", "pending"], 0)
+    failures = {}
+    for name in names:
+        record = _read_json(queue_dir.joinpath("done", f"{name}.json"))
+        if record is not None and record.get("run") == run_key:
+            counts[record["status"]] += 1
+            if record["status"] == "failed":
+                failures[name] = record.get("error")
+            continue
+        try:
+            age = now - queue_dir.joinpath("claims", f"{name}.claim").stat().st_mtime
+        except FileNotFoundError:
+            counts["pending"] += 1
+        else:
+            counts["stale" if age > stale_after else "running"] += 1
+    workers = []
+    for filepath in sorted(queue_dir.joinpath("workers").glob("*.json")):
+        info = _read_json(filepath)
+        if info is not None:
+            seen = now - filepath.stat().st_mtime
+            workers.append(info | {"last_seen": round(seen, 1), "alive": "stopped" not in info and seen <= stale_after})
+    return {"targets": len(names), **counts, "failures": failures, "workers": workers}
+
+
+def collect(config: GBCPDConfig) -> list[str]:
+    """
+    Merge the done records of a configuration into output_dir/manifest.json.
+
+    :return: The targets that failed.
+    :rtype: list[str]
+    """
+    output_dir = Path(config.output_dir)
+    run_key = get_run_key(config)
+    records = {}
+    for path in get_target_mesh_paths(Path(config.target_mesh_path)):
+        record = _read_json(output_dir.joinpath(QUEUE_DIR, "done", f"{path.stem}.json"))
+        if record is not None and record.get("run") == run_key:
+            records[path.stem] = record
+    manifest = Manifest(output_dir.joinpath("manifest.json"), config)
+    manifest.update(records)
+    manifest.compact()
+    return manifest.failures(list(records))
+
+
+def print_status(status: dict):
+    print(
+        f"{status['completed']}/{status['targets']} completed, {status['failed']} failed, {status['running']} running, "
+        f"{status['stale']} stale, {status['pending']} pending"
+    )
+    if status["workers"]:
+        print(f"{'worker':<32} {'alive':>5} {'seen (s)':>9} {'completed':>9} {'failed':>6} {'cached':>6}")
+    for worker in status["workers"]:
+        print(
+            f"{worker['worker']:<32} {'yes' if worker['alive'] else 'no':>5} {worker['last_seen']:>9.1f} "
+            f"{worker['completed']:>9} {worker['failed']:>6} {worker['cached']:>6}"
+        )
+    for name, error in status["failures"].items():
+        print(f"failed {name}: {error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Registers the targets of a configuration with workers on several nodes sharing a file system.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    worker_parser = subparsers.add_parser("worker", help="Register targets claimed from the queue until every target is done")
+    worker_parser.add_argument("config", type=str, help="JSON configuration file of register.py")
+    worker_parser.add_argument("--worker", type=str, default=None, help="Name of the worker (default: <host>-<pid>)")
+    worker_parser.add_argument("--jobs", type=int, default=None, help="Number of targets registered concurrently (overrides the configuration)")
+    worker_parser.add_argument("--heartbeat", type=float, default=HEARTBEAT, help="Seconds between the touches of the worker's claims")
+    worker_parser.add_argument("--stale-after", type=float, default=STALE_AFTER, help="Seconds after which a claim is taken over")
+    worker_parser.add_argument("--retry-failed", action="store_true", help="Register failed targets again")
+    status_parser = subparsers.add_parser("status", help="Report the progress of the queue")
+    status_parser.add_argument("config", type=str, help="JSON configuration file of register.py")
+    status_parser.add_argument("--stale-after", type=float, default=STALE_AFTER, help="Seconds after which a claim is stale")
+    status_parser.add_argument("--watch", type=float, default=None, help="Report again every WATCH seconds until every target is done")
+    collect_parser = subparsers.add_parser("collect", help="Merge the done records into manifest.json")
+    collect_parser.add_argument("config", type=str, help="JSON configuration file of register.py")
+    args = parser.parse_args()
+    with open(args.config, "r") as f:
+        config = GBCPDConfig(**json.load(f))
+
+    if args.command == "worker":
+        worker = args.worker or default_worker()
+        if args.jobs is not None:
+            config.jobs = args.jobs
+        # One log per worker, as workers on different nodes cannot append to one file safely
+        log_file = config.telemetry_log
+        if log_file is not None:
+            log_file = Path(log_file).with_stem(f"{Path(log_file).stem}_{worker}").as_posix()
+        with telemetry.session(log_file, "worker", config.profile):
+            counts = run_worker(config, worker, args.heartbeat, args.stale_after, args.retry_failed)
+        print(f"{worker}: {counts['completed']} completed, {counts['failed']} failed, {counts['cached']} restored from the cache")
+    elif args.command == "status":
+        while True:
+            status = queue_status(config, args.stale_after)
+            print_status(status)
+            if args.watch is None or status["completed"] + status["failed"] == status["targets"]:
+                break
+            time.sleep(args.watch)
+    else:
+        failures = collect(config)
+        if failures:
+            raise RuntimeError(f"Registration failed for {len(failures)} target(s): {', '.join(failures)}")